@@ -26,6 +26,10 @@ router = APIRouter(prefix="/auth/otp", tags=["Auth OTP"])
 
 # ========== Pydantic Schemas ==========
 
+# Алфавит base32 (RFC 4648) - как у otp_service при OTP_ALPHABET=base32
+_BASE32_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ234567")
+
+
 class SendOTPRequest(BaseModel):
     """Запрос на отправку OTP кода"""
     phone: str = Field(..., min_length=10, max_length=20, description="Номер телефона в международном формате")
@@ -47,7 +51,12 @@ class SendOTPRequest(BaseModel):
 class VerifyOTPRequest(BaseModel):
     """Запрос на верификацию OTP кода"""
     phone: str = Field(..., min_length=10, max_length=20)
-    code: str = Field(..., min_length=6, max_length=6, description="6-значный OTP код")
+    code: str = Field(
+        ...,
+        min_length=settings.OTP_CODE_LENGTH,
+        max_length=settings.OTP_CODE_LENGTH,
+        description="OTP код (длина OTP_CODE_LENGTH)"
+    )
 
     @field_validator("phone")
     @classmethod
@@ -60,7 +69,13 @@ class VerifyOTPRequest(BaseModel):
     @field_validator("code")
     @classmethod
     def validate_code(cls, v: str) -> str:
-        if not v.isdigit():
+        if settings.OTP_ALPHABET == "base32":
+            v = v.upper()
+            if not _BASE32_CHARS.issuperset(v):
+                raise ValueError("Код должен содержать только буквы A-Z и цифры 2-7")
+            return v
+        # isdigit() пропускает и не-ASCII цифры
+        if not (v.isascii() and v.isdigit()):
             raise ValueError("Код должен содержать только цифры")
         return v
 
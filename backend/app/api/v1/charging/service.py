@@ -86,7 +86,7 @@ class ChargingService:
             return client
         
         # 2. Проверка станции и тарифов
-        station_info = self._validate_station(station_id, connector_id, client_id)
+        station_info = await self._validate_station(station_id, connector_id, client_id)
         if not station_info['success']:
             return station_info
         
@@ -214,7 +214,7 @@ class ChargingService:
             "status": client_status
         }
     
-    def _validate_station(self, station_id: str, connector_id: Optional[int] = None, client_id: Optional[str] = None) -> Dict[str, Any]:
+    async def _validate_station(self, station_id: str, connector_id: Optional[int] = None, client_id: Optional[str] = None) -> Dict[str, Any]:
         """Проверка станции и получение динамического тарифа"""
         # Проверяем и административный статус (active) и доступность (is_available)
         result = self.db.execute(text("""
@@ -252,7 +252,7 @@ class ChargingService:
         
         # Получаем динамические тарифы через улучшенный PricingService
         try:
-            pricing_result = self.pricing_service.calculate_pricing(
+            pricing_result = await self.pricing_service.calculate_pricing_async(
                 station_id=station_id,
                 connector_type=result[4],  # connector_type из таблицы connectors (VARCHAR)
                 power_kw=result[5],
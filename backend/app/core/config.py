@@ -85,6 +85,12 @@ class Settings(BaseSettings):
     OBANK_CERT_PATH: str = os.getenv("OBANK_CERT_PATH", "")  # Path to PKCS12 certificate
     OBANK_CERT_PASSWORD: str = os.getenv("OBANK_CERT_PASSWORD", "")  # Certificate password (ОБЯЗАТЕЛЬНО для production!)
     OBANK_USE_PRODUCTION: bool = os.getenv("OBANK_USE_PRODUCTION", "false").lower() == "true"
+    OBANK_H2H_ENDPOINT: str = os.getenv("OBANK_H2H_ENDPOINT", "")  # Путь H2H платежа относительно API URL (подбор: probe_obank_endpoints.py)
+    # Пул соединений к OBANK: keep-alive не короче таймаута сервера (nginx по умолчанию 75с),
+    # иначе каждый повторный запрос платит полный mTLS handshake
+    OBANK_HTTP_MAX_CONNECTIONS: int = int(os.getenv("OBANK_HTTP_MAX_CONNECTIONS", "50"))
+    OBANK_HTTP_MAX_KEEPALIVE: int = int(os.getenv("OBANK_HTTP_MAX_KEEPALIVE", "20"))
+    OBANK_HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("OBANK_HTTP_KEEPALIVE_EXPIRY", "75"))
     
     # OBANK Production настройки
     OBANK_PROD_POINT_ID: str = os.getenv("OBANK_PROD_POINT_ID", "")
@@ -144,6 +150,7 @@ class Settings(BaseSettings):
 
     # OTP Settings
     OTP_CODE_LENGTH: int = int(os.getenv("OTP_CODE_LENGTH", "6"))
+    OTP_ALPHABET: str = os.getenv("OTP_ALPHABET", "digits")  # digits | base32 (A-Z, 2-7)
     OTP_TTL_SECONDS: int = int(os.getenv("OTP_TTL_SECONDS", "300"))  # 5 minutes
     OTP_MAX_ATTEMPTS: int = int(os.getenv("OTP_MAX_ATTEMPTS", "3"))
     OTP_RATE_LIMIT_SECONDS: int = int(os.getenv("OTP_RATE_LIMIT_SECONDS", "60"))  # 1 code per minute
@@ -152,6 +159,10 @@ class Settings(BaseSettings):
     PUSH_NOTIFICATIONS_ENABLED: bool = os.getenv("PUSH_NOTIFICATIONS_ENABLED", "true").lower() == "true"
     PUSH_MAX_RETRIES: int = int(os.getenv("PUSH_MAX_RETRIES", "3"))
     PUSH_TTL: int = int(os.getenv("PUSH_TTL", "86400"))  # 24 hours in seconds
+
+    # Pricing L2 Cache (Redis, shared by workers)
+    PRICING_REDIS_CACHE_ENABLED: bool = os.getenv("PRICING_REDIS_CACHE_ENABLED", "true").lower() == "true"
+    PRICING_REDIS_CACHE_TTL: int = int(os.getenv("PRICING_REDIS_CACHE_TTL", "60"))  # seconds
     
     @property
     def is_production(self) -> bool:
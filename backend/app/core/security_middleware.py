@@ -396,44 +396,71 @@ class SecurityMiddleware:
         
         return False
 
+class CircuitOpenError(HTTPException):
+    """Circuit breaker разомкнут - внешний сервис временно недоступен"""
+
+    def __init__(self):
+        super().__init__(status_code=503, detail="Service temporarily unavailable")
+
 class CircuitBreaker:
     """Circuit breaker для внешних сервисов"""
     
-    def __init__(self, failure_threshold: int = 5, timeout: int = 60):
+    def __init__(self, failure_threshold: int = 5, timeout: int = 60,
+                 expected_exceptions: tuple = (Exception,)):
         self.failure_threshold = failure_threshold
         self.timeout = timeout
+        # Только эти исключения считаются отказом сервиса (ошибки в нашем коде - нет)
+        self.expected_exceptions = expected_exceptions
         self.failure_count = 0
         self.last_failure_time = None
         self.state = "closed"  # closed, open, half_open
     
-    def call(self, func, *args, **kwargs):
-        """Выполняет функцию с circuit breaker protection"""
+    def _before_call(self):
         if self.state == "open":
             if time.time() - self.last_failure_time > self.timeout:
                 self.state = "half_open"
                 logger.info("Circuit breaker moving to half-open state")
             else:
-                raise HTTPException(status_code=503, detail="Service temporarily unavailable")
+                raise CircuitOpenError()
+    
+    def _on_success(self):
+        if self.state == "half_open":
+            self.state = "closed"
+            logger.info("Circuit breaker closed - service recovered")
+        # Считаем только подряд идущие отказы
+        self.failure_count = 0
+    
+    def _on_failure(self, e: Exception):
+        if not isinstance(e, self.expected_exceptions):
+            return
+        self.failure_count += 1
+        self.last_failure_time = time.time()
         
+        if self.state == "half_open" or self.failure_count >= self.failure_threshold:
+            self.state = "open"
+            logger.error(f"Circuit breaker opened due to {self.failure_count} failures")
+    
+    def call(self, func, *args, **kwargs):
+        """Выполняет функцию с circuit breaker protection"""
+        self._before_call()
         try:
             result = func(*args, **kwargs)
-            
-            if self.state == "half_open":
-                self.state = "closed"
-                self.failure_count = 0
-                logger.info("Circuit breaker closed - service recovered")
-            
-            return result
-            
         except Exception as e:
-            self.failure_count += 1
-            self.last_failure_time = time.time()
-            
-            if self.failure_count >= self.failure_threshold:
-                self.state = "open"
-                logger.error(f"Circuit breaker opened due to {self.failure_count} failures")
-            
-            raise e
+            self._on_failure(e)
+            raise
+        self._on_success()
+        return result
+    
+    async def call_async(self, func, *args, **kwargs):
+        """Асинхронный вариант call() для корутин"""
+        self._before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        self._on_success()
+        return result
 
 # Глобальные circuit breakers для внешних сервисов
 payment_circuit_breaker = CircuitBreaker(failure_threshold=3, timeout=30)
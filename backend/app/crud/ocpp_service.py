@@ -448,6 +448,12 @@ class OCPPConfigurationService:
 
 import httpx
 import hmac
+try:
+    # HTTP/2 в httpx требует пакет h2 (httpx[http2])
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    _HTTP2_AVAILABLE = False
 import hashlib
 import time
 from typing import Dict, Any, Optional
@@ -467,6 +473,36 @@ class ODengiService:
         self._use_production = None
         self.api_version = 1005  # Версия API из документации
         self._initialized = False
+        # Общий HTTP клиент: keep-alive вместо TLS handshake на каждый запрос
+        self._client: Optional[httpx.AsyncClient] = None
+        # Внешний клиент (set_client) закрывает его владелец, а не сервис
+        self._owns_client = True
+        # Ключ подписи webhook в байтах, кодируется один раз
+        self._webhook_key: Optional[bytes] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Общий HTTP клиент, создается при первом запросе"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=30.0,
+                follow_redirects=True,
+                # Параллельные запросы мультиплексируются в одном TLS соединении
+                http2=_HTTP2_AVAILABLE
+            )
+            self._owns_client = True
+        return self._client
+
+    def set_client(self, client: httpx.AsyncClient) -> None:
+        """Использовать общий HTTP клиент приложения вместо собственного"""
+        self._client = client
+        self._owns_client = False
+
+    async def aclose(self) -> None:
+        """Закрывает общий HTTP клиент (остановка приложения)"""
+        if self._client is not None:
+            client, self._client = self._client, None
+            if self._owns_client:
+                await client.aclose()
     
     def _ensure_initialized(self):
         """Ленивая инициализация настроек"""
@@ -608,31 +644,30 @@ class ODengiService:
         request_data["hash"] = self.generate_hash(request_data)
         
         try:
-            async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-                response = await client.post(
-                    self.api_url,
-                    json=request_data,
-                    headers={"Content-Type": "application/json; charset=utf-8"}
-                )
-                response.raise_for_status()
-                
-                result = response.json()
-                logger.info(f"📱 ODENGI createInvoice ПОЛНЫЙ ОТВЕТ: {result}")
-                
-                # Логируем структуру ответа для диагностики
-                if 'data' in result:
-                    data = result['data']
-                    logger.info(f"📱 ODENGI data.keys(): {list(data.keys()) if isinstance(data, dict) else 'не словарь'}")
-                    if isinstance(data, dict):
-                        for key in ['qr', 'qr_url', 'link_app', 'app_link', 'invoice_id']:
-                            if key in data:
-                                value = data[key]
-                                if key == 'qr' and isinstance(value, str):
-                                    logger.info(f"📱 ODENGI {key}: {value[:100]}..." if len(value) > 100 else f"📱 ODENGI {key}: {value}")
-                                else:
-                                    logger.info(f"📱 ODENGI {key}: {value}")
-                
-                return result
+            response = await self._get_client().post(
+                self.api_url,
+                json=request_data,
+                headers={"Content-Type": "application/json; charset=utf-8"}
+            )
+            response.raise_for_status()
+            
+            result = response.json()
+            logger.info(f"📱 ODENGI createInvoice ПОЛНЫЙ ОТВЕТ: {result}")
+            
+            # Логируем структуру ответа для диагностики
+            if 'data' in result:
+                data = result['data']
+                logger.info(f"📱 ODENGI data.keys(): {list(data.keys()) if isinstance(data, dict) else 'не словарь'}")
+                if isinstance(data, dict):
+                    for key in ['qr', 'qr_url', 'link_app', 'app_link', 'invoice_id']:
+                        if key in data:
+                            value = data[key]
+                            if key == 'qr' and isinstance(value, str):
+                                logger.info(f"📱 ODENGI {key}: {value[:100]}..." if len(value) > 100 else f"📱 ODENGI {key}: {value}")
+                            else:
+                                logger.info(f"📱 ODENGI {key}: {value}")
+            
+            return result
                 
         except Exception as e:
             logger.error(f"O!Dengi createInvoice error: {e}")
@@ -661,18 +696,17 @@ class ODengiService:
         request_data["hash"] = self.generate_hash(request_data)
         
         try:
-            async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-                response = await client.post(
-                    self.api_url,
-                    json=request_data,
-                    headers={"Content-Type": "application/json; charset=utf-8"}
-                )
-                response.raise_for_status()
-                
-                result = response.json()
-                logger.info(f"O!Dengi statusPayment response: {result}")
-                
-                return result
+            response = await self._get_client().post(
+                self.api_url,
+                json=request_data,
+                headers={"Content-Type": "application/json; charset=utf-8"}
+            )
+            response.raise_for_status()
+            
+            result = response.json()
+            logger.info(f"O!Dengi statusPayment response: {result}")
+            
+            return result
                 
         except Exception as e:
             logger.error(f"O!Dengi statusPayment error: {e}")
@@ -684,8 +718,11 @@ class ODengiService:
             logger.warning("ODENGI_WEBHOOK_SECRET not configured, skipping signature verification")
             return True
         
+        if self._webhook_key is None:
+            self._webhook_key = settings.ODENGI_WEBHOOK_SECRET.encode('utf-8')
+        
         expected_signature = hmac.new(
-            settings.ODENGI_WEBHOOK_SECRET.encode('utf-8'),
+            self._webhook_key,
             payload,
             hashlib.sha256
         ).hexdigest()
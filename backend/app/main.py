@@ -3,6 +3,13 @@ import os
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, status, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+try:
+    # orjson сериализует ответы в C - в разы быстрее stdlib json
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:
+    DefaultResponse = JSONResponse
 from contextlib import asynccontextmanager
 import logging
 import uvicorn
@@ -21,6 +28,10 @@ from ocpp_ws_server.redis_manager import redis_manager
 from app.api import mobile  # Импорт mobile API (будет постепенно заменен)
 from app.api.v1 import router as v1_router  # Новая модульная структура
 from app.services.station_status_manager import StationStatusManager
+from app.services.obank_service import obank_service
+from app.services.push_service import push_service
+from app.services.pricing_service import listen_pricing_history_changes
+from app.crud.ocpp_service import odengi_service
 from app.db.session import get_db
 from app.db.session import get_session_local
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -192,6 +203,8 @@ async def lifespan(app: FastAPI):
     # Очистка идемпотентности
     idem_cleanup_task_ref = asyncio.create_task(cleanup_idempotency_keys_task())
     logger.info("🧹 Idempotency keys cleanup task started (ежедневно)")
+    # Сброс кэша аналитики тарифов по NOTIFY из pricing_history
+    pricing_listen_task_ref = asyncio.create_task(listen_pricing_history_changes())
     
     # Запуск scheduler для обновления статусов станций
     scheduler = AsyncIOScheduler()
@@ -281,6 +294,12 @@ async def lifespan(app: FastAPI):
     # Отмена background tasks при остановке
     payment_cleanup_task_ref.cancel()
     idem_cleanup_task_ref.cancel()
+    pricing_listen_task_ref.cancel()
+    
+    # Закрываем пулы соединений платежных провайдеров и push-сервисов
+    await obank_service.aclose()
+    await odengi_service.aclose()
+    await push_service.aclose()
     logger.info("🛑 Shutting down OCPP WebSocket Server...")
     logger.info("✅ Application shutdown complete")
 
@@ -290,6 +309,7 @@ app = FastAPI(
     description="Минимальный OCPP 1.6 WebSocket сервер только для ЭЗС. HTTP endpoints реализованы в FlutterFlow.",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=DefaultResponse,
     docs_url=("/docs" if settings.ENABLE_SWAGGER else None),
     redoc_url=("/redoc" if settings.ENABLE_SWAGGER else None)
 )
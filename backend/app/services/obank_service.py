@@ -1,403 +1,588 @@
 """
 OBANK payment service implementation with proper client SSL certificate authentication
 """
+import certifi
 import httpx
-import xml.etree.ElementTree as ET
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Optional, Tuple
 import asyncio
+import hashlib
+import re
 from datetime import datetime
-import uuid
 import logging
 import ssl
+import threading
 import tempfile
 import os
 from pathlib import Path
 
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.serialization import pkcs12
+from sqlalchemy import text
+
+try:
+    # C-парсер libxml2: быстрее и с лимитами на раскрытие сущностей
+    from lxml import etree as ET
+    _LXML_AVAILABLE = True
+except ImportError:  # pragma: no cover - lxml опционален
+    import xml.etree.ElementTree as ET
+    _LXML_AVAILABLE = False
+
+# Ответы OBANK маленькие и без DTD: сущности не раскрываем, огромные деревья запрещены
+_PARSER_OPTIONS = {"resolve_entities": False, "huge_tree": False, "recover": False} if _LXML_AVAILABLE else {}
+
+try:
+    # HTTP/2 в httpx требует пакет h2 (httpx[http2])
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    _HTTP2_AVAILABLE = False
 
 from app.core.config import settings
+from app.db.session import get_async_session_local
 
 logger = logging.getLogger(__name__)
 
+
+def _now_str() -> str:
+    """Current time as OBANK date string (%Y-%m-%dT%H:%M:%S+0600)"""
+    n = datetime.now()
+    # Формат фиксирован - собираем строку напрямую, минуя strftime
+    return f"{n.year:04d}-{n.month:02d}-{n.day:02d}T{n.hour:02d}:{n.minute:02d}:{n.second:02d}+0600"
+
+
+# Ответ на запрос статуса имеет фиксированную структуру - атрибуты <result> достаем регуляркой
+_RESULT_TAG_RE = re.compile(rb'<result\b([^>]*)>')
+_ATTR_RE = re.compile(rb'(\w+)="([^"]*)"')
+
+
+# Шаблоны XML запросов: разбираются один раз, на запрос выполняется только format_map
+_H2H_TMPL = """<?xml version="1.0" encoding="UTF-8"?>
+<request point="{point}">
+    <payment
+        id="{id}"
+        sum="{sum}"
+        check="0"
+        service="{service}"
+        date="{date}"
+        account="{card_pan}">
+        <attribute name="amount_currency" value="417"/>
+        <attribute name="notify_url" value="{notify_url}"/>
+        <attribute name="redirect_url" value="{redirect_url}"/>
+        <attribute name="card_pan" value="{card_pan}"/>
+        <attribute name="card_name" value="{card_name}"/>
+        <attribute name="card_cvv" value="{card_cvv}"/>
+        <attribute name="card_year" value="{card_year}"/>
+        <attribute name="card_month" value="{card_month}"/>
+        <attribute name="email" value="{email}"/>
+        <attribute name="phone_number" value="{phone}"/>
+        <attribute name="city" value="BISHKEK"/>
+        <attribute name="country_code" value="KGZ"/>
+    </payment>
+</request>"""
+
+_TOKEN_TMPL = """<?xml version="1.0" encoding="UTF-8"?>
+<request point="{point}">
+    <advanced service="{service}" function="stored-cards">
+        <attribute name="days" value="{days}"/>
+    </advanced>
+</request>"""
+
+_TOKEN_PAYMENT_TMPL = """<?xml version="1.0" encoding="UTF-8"?>
+<request point="{point}">
+    <payment
+        id="{id}"
+        sum="{sum}"
+        check="0"
+        service="{service}"
+        date="{date}"
+        account="">
+        <attribute name="amount_currency" value="417"/>
+        <attribute name="notify_url" value="{notify_url}"/>
+        <attribute name="redirect_url" value="{redirect_url}"/>
+        <attribute name="email" value="test@evpower.kg"/>
+        <attribute name="card-token" value="{card_token}"/>
+    </payment>
+</request>"""
+
+
+# SSL контексты с клиентским сертификатом, общие для всех экземпляров сервиса в процессе.
+# Ключ - (путь к сертификату, sha256 пароля), пароль в открытом виде не хранится
+_SSL_CTX_CACHE: Dict[Tuple[str, str], ssl.SSLContext] = {}
+_SSL_CTX_LOCK = threading.Lock()
+
+
+def _load_pkcs12_certificate(cert_path: Path, cert_password: str) -> bytes:
+    """Load PKCS12 certificate and return cert + key as a single PEM bundle"""
+    try:
+        if not cert_path.exists():
+            logger.error(f"🚨 SSL certificate NOT FOUND: {cert_path}")
+            logger.error(f"🚨 Certificate directory contents:")
+            cert_dir = cert_path.parent
+            if cert_dir.exists():
+                for file in cert_dir.iterdir():
+                    logger.error(f"🚨   - {file.name}")
+            else:
+                logger.error(f"🚨 Certificate directory does not exist: {cert_dir}")
+            raise FileNotFoundError(f"SSL certificate not found: {cert_path}")
+
+        logger.debug("✅ SSL certificate found: %s", cert_path)
+
+        with open(cert_path, 'rb') as cert_file:
+            p12_data = cert_file.read()
+
+        logger.debug("✅ PKCS12 data read: %d bytes", len(p12_data))
+
+        # Parse PKCS12
+        p12 = pkcs12.load_pkcs12(p12_data, cert_password.encode('utf-8'))
+
+        logger.debug("✅ PKCS12 parsed successfully")
+
+        # Сертификат и ключ одним PEM - OpenSSL разбирает их за одну загрузку
+        bundle_pem = p12.cert.certificate.public_bytes(serialization.Encoding.PEM) + p12.key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+
+        logger.debug("✅ Certificate converted to PEM format")
+
+        return bundle_pem
+
+    except Exception as e:
+        logger.error(f"🚨 Failed to load PKCS12 certificate: {e}")
+        logger.error(f"🚨 Exception type: {type(e).__name__}")
+        raise
+
+
+def _get_ssl_context(cert_path: Path, cert_password: str) -> ssl.SSLContext:
+    """Return the shared client SSL context for a certificate, building it on first use"""
+    key = (str(cert_path), hashlib.sha256(cert_password.encode("utf-8")).hexdigest())
+    ssl_ctx = _SSL_CTX_CACHE.get(key)
+    if ssl_ctx is not None:
+        return ssl_ctx
+
+    with _SSL_CTX_LOCK:
+        ssl_ctx = _SSL_CTX_CACHE.get(key)
+        if ssl_ctx is None:
+            ssl_ctx = _build_ssl_context(cert_path, cert_password)
+            _SSL_CTX_CACHE[key] = ssl_ctx
+    return ssl_ctx
+
+
+def _build_ssl_context(cert_path: Path, cert_password: str) -> ssl.SSLContext:
+    """Build client SSL context from PKCS12 certificate"""
+    # Проверяем наличие сертификата (обязательно для PCI DSS Requirement 4.1)
+    if not cert_path.exists():
+        error_msg = (
+            f"🚨 SSL certificate required at {cert_path}. "
+            "HTTP fallback disabled for PCI DSS compliance. "
+            "Please configure OBANK_CERT_PATH and OBANK_CERT_PASSWORD."
+        )
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+
+    bundle_data = _load_pkcs12_certificate(cert_path, cert_password)
+
+    # load_cert_chain принимает только пути - PEM пишется один раз на процесс в приватный
+    # каталог (mkdtemp создает его с правами 0700) и удаляется сразу после загрузки
+    with tempfile.TemporaryDirectory(prefix="obank-") as cert_dir:
+        bundle_file_path = os.path.join(cert_dir, "client.pem")
+        fd = os.open(bundle_file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as bundle_file:
+            bundle_file.write(bundle_data)
+
+        # Стандартный контекст: проверка сертификата и hostname OBANK включены, не отключать.
+        # CA - bundle certifi, как у httpx по умолчанию (системный в slim образах может отсутствовать)
+        ssl_ctx = ssl.create_default_context(cafile=certifi.where())
+        ssl_ctx.load_cert_chain(bundle_file_path)
+
+    logger.info("✅ SSL context created: %s", cert_path)
+    return ssl_ctx
+
+
+# ID транзакций OBANK - из последовательности Postgres (migrations/010): уникальны
+# для всех воркеров и реплик и остаются 10-значными, как прежние ID по Unix времени
+_NEXT_TRANSACTION_ID_STMT = text("SELECT nextval('obank_transaction_id_seq')")
+
+
+async def _next_transaction_id() -> int:
+    """Следующий ID транзакции OBANK"""
+    async with get_async_session_local()() as session:
+        return (await session.execute(_NEXT_TRANSACTION_ID_STMT)).scalar_one()
+
+
 class OBankService:
+    # Заголовки одинаковы для всех запросов к OBANK
+    _REQUEST_HEADERS = {
+        "Content-Type": "application/xml; charset=utf-8",
+        "Accept": "application/xml"
+    }
+
     def __init__(self):
         self.base_url = settings.current_obank_api_url
         self.point_id = int(settings.current_obank_point_id)
         self.service_id = int(settings.current_obank_service_id)
+        self.h2h_endpoint = settings.OBANK_H2H_ENDPOINT
         self.cert_path = Path(settings.OBANK_CERT_PATH) if settings.OBANK_CERT_PATH else Path(__file__).parent.parent.parent / "certificates" / "obank_client.p12"
         self.cert_password = settings.OBANK_CERT_PASSWORD
+        # SSL контекст с клиентским сертификатом строится один раз при первом запросе
+        self._ssl_ctx: Optional[ssl.SSLContext] = None
+        self._ssl_lock = asyncio.Lock()
+        # Один XML парсер на сервис вместо создания нового на каждый ответ
+        self._xml_parser = ET.XMLParser(**_PARSER_OPTIONS) if _LXML_AVAILABLE else None
+        # Долгоживущий клиент: keep-alive соединения переиспользуются без повторного mTLS handshake
+        self._client: Optional[httpx.AsyncClient] = None
+        # Неизменяемые параметры XML шаблонов
+        self._notify_url = f"{settings.DOMAIN}/api/payment/obank/notify"
+        self._redirect_url = f"{settings.DOMAIN}/payment/success"
+        self._xml_params = {
+            "point": self.point_id,
+            "service": self.service_id,
+            "notify_url": self._notify_url,
+            "redirect_url": self._redirect_url,
+        }
+        # Запрос статуса - самый частый: неизменяемые части храним готовыми байтами
+        self._status_prefix = f'<?xml version="1.0" encoding="UTF-8"?>\n<request point="{self.point_id}">\n    <status id="'.encode()
+        self._status_suffix = b'"/>\n</request>'
         
-    def _load_pkcs12_certificate(self):
-        """Load PKCS12 certificate and extract cert + key"""
-        try:
-            if not self.cert_path.exists():
-                logger.error(f"🚨 SSL certificate NOT FOUND: {self.cert_path}")
-                logger.error(f"🚨 Certificate directory contents:")
-                cert_dir = self.cert_path.parent
-                if cert_dir.exists():
-                    for file in cert_dir.iterdir():
-                        logger.error(f"🚨   - {file.name}")
-                else:
-                    logger.error(f"🚨 Certificate directory does not exist: {cert_dir}")
-                raise FileNotFoundError(f"SSL certificate not found: {self.cert_path}")
-                
-            logger.info(f"✅ SSL certificate found: {self.cert_path}")
-            
-            with open(self.cert_path, 'rb') as cert_file:
-                p12_data = cert_file.read()
-            
-            logger.info(f"✅ PKCS12 data read: {len(p12_data)} bytes")
-            
-            # Parse PKCS12
-            private_key, certificate, additional_certificates = pkcs12.load_key_and_certificates(
-                p12_data, 
-                self.cert_password.encode('utf-8')
-            )
-            
-            logger.info(f"✅ PKCS12 parsed successfully")
-            
-            # Convert to PEM format
-            cert_pem = certificate.public_bytes(serialization.Encoding.PEM)
-            key_pem = private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            )
-            
-            logger.info(f"✅ Certificate converted to PEM format")
-            
-            return cert_pem, key_pem
-            
-        except Exception as e:
-            logger.error(f"🚨 Failed to load PKCS12 certificate: {e}")
-            logger.error(f"🚨 Exception type: {type(e).__name__}")
-            raise
+    async def _get_ssl_context(self) -> ssl.SSLContext:
+        """Build the client SSL context once and reuse it for every request"""
+        if self._ssl_ctx is None:
+            # Первый запрос: конкурентные вызовы ждут одну загрузку сертификата,
+            # расшифровка PKCS12 выполняется в потоке и не блокирует event loop
+            async with self._ssl_lock:
+                if self._ssl_ctx is None:
+                    # Контекст общий для всех экземпляров с тем же сертификатом
+                    self._ssl_ctx = await asyncio.to_thread(_get_ssl_context, self.cert_path, self.cert_password)
+        return self._ssl_ctx
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared HTTP client, creating it on first use"""
+        if self._client is None:
+            ssl_ctx = await self._get_ssl_context()
+            if self._client is None:
+                self._client = httpx.AsyncClient(
+                    verify=ssl_ctx,  # SSL verification включен для production безопасности
+                    timeout=httpx.Timeout(connect=5.0, read=25.0, write=10.0, pool=5.0),
+                    limits=httpx.Limits(
+                        max_keepalive_connections=settings.OBANK_HTTP_MAX_KEEPALIVE,
+                        max_connections=settings.OBANK_HTTP_MAX_CONNECTIONS,
+                        keepalive_expiry=settings.OBANK_HTTP_KEEPALIVE_EXPIRY
+                    ),
+                    # HTTP/2: параллельные запросы мультиплексируются в одном TLS соединении,
+                    # если сервер не согласует h2 - httpx прозрачно использует HTTP/1.1
+                    http2=_HTTP2_AVAILABLE
+                )
+        return self._client
 
-    async def _make_request(self, endpoint: str, xml_data: str) -> Dict[str, Any]:
+    async def aclose(self) -> None:
+        """Close the shared HTTP client (application shutdown)"""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    async def _make_request(
+        self,
+        endpoint: str,
+        xml_data: bytes,
+        fast_parser: Optional[Callable[[bytes], Optional[Dict[str, Any]]]] = None
+    ) -> Dict[str, Any]:
         """
         Make authenticated request to OBANK API with client SSL certificate
+
+        fast_parser: optional parser for the raw body; if it returns None the full XML parser is used
         """
-        import tempfile
-        import os
-        
-        cert_file_path = None
-        key_file_path = None
-        
         try:
-            logger.info(f"🔍 OBANK request: {self.base_url}{endpoint}")
-            logger.info(f"🔍 SSL cert path: {self.cert_path}")
-            logger.info(f"🔍 SSL cert exists: {self.cert_path.exists()}")
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                logger.debug("🔍 OBANK request: %s%s", self.base_url, endpoint)
+                logger.debug("🔍 SSL cert path: %s", self.cert_path)
             
-            # Проверяем наличие сертификата (обязательно для PCI DSS Requirement 4.1)
-            if not self.cert_path.exists():
-                error_msg = (
-                    f"🚨 SSL certificate required at {self.cert_path}. "
-                    "HTTP fallback disabled for PCI DSS compliance. "
-                    "Please configure OBANK_CERT_PATH and OBANK_CERT_PASSWORD."
-                )
-                logger.error(error_msg)
-                raise ValueError(error_msg)
-
-            # Сертификат найден, продолжаем
-            if True:
-                logger.info(f"✅ SSL certificate found: {self.cert_path}")
-                
-                # Загружаем сертификат и ключ
-                cert_data, key_data = self._load_pkcs12_certificate()
-                
-                logger.info(f"🔍 SSL cert loaded: {len(cert_data)} bytes")
-                logger.info(f"🔍 SSL key loaded: {len(key_data)} bytes")
+            # Общий клиент с SSL сертификатом и пулом соединений
+            client = await self._get_client()
+            
+            # Ответ читается потоком и сразу скармливается XML парсеру
+            async with client.stream(
+                "POST",
+                f"{self.base_url}{endpoint}",
+                content=xml_data,
+                headers=self._REQUEST_HEADERS
+            ) as response:
+                if debug:
+                    logger.debug("🔍 OBANK response status: %s", response.status_code)
+                    logger.debug("🔍 OBANK response headers: %s", dict(response.headers))
                 
-                # ✅ ИСПРАВЛЕНО: Создаём временные файлы для httpx
-                with tempfile.NamedTemporaryFile(mode='wb', suffix='.crt', delete=False) as cert_file:
-                    cert_file.write(cert_data)
-                    cert_file_path = cert_file.name
-                    
-                with tempfile.NamedTemporaryFile(mode='wb', suffix='.key', delete=False) as key_file:
-                    key_file.write(key_data)
-                    key_file_path = key_file.name
+                if response.status_code != 200:
+                    body = await response.aread()
+                    logger.error(f"❌ OBANK API error: {response.status_code} ({len(body)} bytes)")
+                    if debug:
+                        logger.debug("🔍 OBANK response: '%s'", response.text)
+                        logger.debug("🔍 OBANK headers: %s", dict(response.headers))
+                    return {"error": f"HTTP {response.status_code}", "details": response.text}
                 
-                logger.info(f"🔍 Created temp cert file: {cert_file_path}")
-                logger.info(f"🔍 Created temp key file: {key_file_path}")
+                if fast_parser is not None:
+                    body = await response.aread()
+                    result = fast_parser(body)
+                    if result is not None:
+                        return result
+                    return self._parse_xml_response(body)
                 
-                # ✅ ДИАГНОСТИКА ОТКЛЮЧЕНА: Рабочий endpoint найден - base URL
-                logger.info(f"🔍 Using confirmed working endpoint: {self.base_url}{endpoint}")
+                return await self._parse_xml_stream(response)
                 
-                # Основной запрос с SSL сертификатом
-                async with httpx.AsyncClient(
-                    cert=(cert_file_path, key_file_path),
-                    verify=True,  # SSL verification включен для production безопасности
-                    timeout=30.0
-                ) as client:
-                    response = await client.post(
-                        f"{self.base_url}{endpoint}",
-                        content=xml_data,
-                        headers={
-                            "Content-Type": "application/xml; charset=utf-8",
-                            "Accept": "application/xml"
-                        }
-                    )
-                    
-                    logger.info(f"🔍 OBANK response status: {response.status_code}")
-                    logger.info(f"🔍 OBANK response headers: {dict(response.headers)}")
-                    logger.info(f"🔍 OBANK response content: '{response.text}'")
-                    logger.info(f"🔍 OBANK response length: {len(response.text)} chars")
-                    
-                    if response.status_code != 200:
-                        logger.error(f"❌ OBANK API error: {response.status_code}")
-                        logger.error(f"❌ OBANK response: '{response.text}'")
-                        logger.error(f"❌ OBANK headers: {dict(response.headers)}")
-                        return {"error": f"HTTP {response.status_code}", "details": response.text}
-                    
-                    return self._parse_xml_response(response.text)
-                    
         except Exception as e:
             logger.error(f"❌ OBANK request failed: {str(e)}")
             return {"error": str(e)}
-        finally:
-            # ✅ ОЧИСТКА: Удаляем временные файлы
-            try:
-                if cert_file_path and os.path.exists(cert_file_path):
-                    os.unlink(cert_file_path)
-                    logger.info(f"🧹 Cleaned up temp cert file: {cert_file_path}")
-                if key_file_path and os.path.exists(key_file_path):
-                    os.unlink(key_file_path)
-                    logger.info(f"🧹 Cleaned up temp key file: {key_file_path}")
-            except Exception as cleanup_error:
-                logger.warning(f"⚠️ Cleanup failed: {str(cleanup_error)}")
-
-    def _parse_xml_response(self, xml_text: str) -> Dict[str, Any]:
-        """Parse XML response from OBANK API"""
-        import xml.etree.ElementTree as ET
-        
+
+    async def _parse_xml_stream(self, response: httpx.Response) -> Dict[str, Any]:
+        """Parse streamed XML response from OBANK API without building the full tree"""
         try:
-            root = ET.fromstring(xml_text)
+            parser = ET.XMLPullParser(events=("end",), **_PARSER_OPTIONS)
             result = {}
             
-            # Парсинг result элемента
-            result_elem = root.find("result")
-            if result_elem is not None:
-                result.update(result_elem.attrib)
-                
-                # Парсинг data элементов
-                data_elem = result_elem.find("data")
-                if data_elem is not None:
-                    result["data"] = []
-                    for input_elem in data_elem.findall("input"):
-                        result["data"].append(input_elem.attrib)
+            async for chunk in response.aiter_bytes():
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    if elem.tag == "result" and not result:
+                        result = self._parse_result_element(elem)
+                        elem.clear()
             
+            parser.close()
+            logger.debug("🔍 OBANK response length: %d bytes", response.num_bytes_downloaded)
             return result
         except Exception as e:
             logger.error(f"❌ XML parsing failed: {str(e)}")
             return {"error": "XML parsing failed", "details": str(e)}
+
+    def _parse_xml_response(self, xml_data: bytes) -> Dict[str, Any]:
+        """Parse XML response from OBANK API"""
+        try:
+            root = ET.fromstring(xml_data, self._xml_parser)
+            
+            # Парсинг result элемента
+            result_elem = root.find("result")
+            if result_elem is None:
+                return {}
+            return self._parse_result_element(result_elem)
+        except Exception as e:
+            logger.error(f"❌ XML parsing failed: {str(e)}")
+            return {"error": "XML parsing failed", "details": str(e)}
+
+    def _parse_status_fast(self, body: bytes) -> Optional[Dict[str, Any]]:
+        """Extract <result> attributes from a status response without XML parsing, None if not applicable"""
+        match = _RESULT_TAG_RE.search(body)
+        # Строки data и экранированные значения разбирает полноценный парсер
+        if match is None or b"&" in match.group(1) or b"<data" in body:
+            return None
+        attrs = {name.decode(): value.decode() for name, value in _ATTR_RE.findall(match.group(1))}
+        if "state" not in attrs:
+            return None
+        get = attrs.get
+        return {
+            "id": get("id"),
+            "state": get("state"),
+            "trans": get("trans"),
+            "final": get("final"),
+            "code": get("code"),
+            "data": [],
+        }
+
+    def _parse_result_element(self, result_elem) -> Dict[str, Any]:
+        """Extract the fields callers use and data rows from <result> element"""
+        # ✅ Читаем только нужные атрибуты через get(), без копирования всего attrib
+        get = result_elem.get
+        return {
+            "id": get("id"),
+            "state": get("state"),
+            "trans": get("trans"),
+            "final": get("final"),
+            "code": get("code"),
+            "data": [dict(input_elem.attrib) for input_elem in result_elem.iterfind("data/input")],
+        }
     
-    def _create_h2h_xml(self, amount_tyiyn: int, client_id: str, card_data: Dict[str, str]) -> str:
+    def _create_h2h_xml(
+        self, transaction_id: int, amount_tyiyn: int, client_id: str, card_data: Dict[str, str]
+    ) -> bytes:
         """Create XML for H2H payment request"""
-        transaction_id = int(datetime.now().timestamp())
-        current_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S+0600")
+        current_time = _now_str()
         
         # Используем переданные email и phone или значения по умолчанию
-        email = card_data.get('email', 'test@evpower.kg')
-        phone = card_data.get('phone', '+996700000000')
-        
-        xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<request point="{self.point_id}">
-    <payment
-        id="{transaction_id}"
-        sum="{amount_tyiyn}"
-        check="0"
-        service="{self.service_id}"
-        date="{current_time}"
-        account="{card_data['number']}">
-        <attribute name="amount_currency" value="417"/>
-        <attribute name="notify_url" value="{settings.DOMAIN}/api/payment/obank/notify"/>
-        <attribute name="redirect_url" value="{settings.DOMAIN}/payment/success"/>
-        <attribute name="card_pan" value="{card_data['number']}"/>
-        <attribute name="card_name" value="{card_data['holder_name']}"/>
-        <attribute name="card_cvv" value="{card_data['cvv']}"/>
-        <attribute name="card_year" value="{card_data['exp_year']}"/>
-        <attribute name="card_month" value="{card_data['exp_month']}"/>
-        <attribute name="email" value="{email}"/>
-        <attribute name="phone_number" value="{phone}"/>
-        <attribute name="city" value="BISHKEK"/>
-        <attribute name="country_code" value="KGZ"/>
-    </payment>
-</request>"""
-        
-        return xml
+        return _H2H_TMPL.format_map({
+            **self._xml_params,
+            "id": transaction_id,
+            "sum": amount_tyiyn,
+            "date": current_time,
+            "card_pan": card_data['number'],
+            "card_name": card_data['holder_name'],
+            "card_cvv": card_data['cvv'],
+            "card_year": card_data['exp_year'],
+            "card_month": card_data['exp_month'],
+            "email": card_data.get('email', 'test@evpower.kg'),
+            "phone": card_data.get('phone', '+996700000000'),
+        }).encode("utf-8")
     
-    def _create_token_xml(self, days: int = 14) -> str:
+    def _create_token_xml(self, days: int = 14) -> bytes:
         """Create XML for card tokenization request"""
-        xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<request point="{self.point_id}">
-    <advanced service="{self.service_id}" function="stored-cards">
-        <attribute name="days" value="{days}"/>
-    </advanced>
-</request>"""
-        
-        return xml
+        return _TOKEN_TMPL.format_map({**self._xml_params, "days": days}).encode("utf-8")
     
-    def _create_token_payment_xml(self, amount_tyiyn: int, client_id: str, card_token: str) -> str:
+    def _create_token_payment_xml(
+        self, transaction_id: int, amount_tyiyn: int, client_id: str, card_token: str
+    ) -> bytes:
         """Create XML for token payment request"""
-        transaction_id = int(datetime.now().timestamp())
-        current_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S+0600")
-        
-        xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<request point="{self.point_id}">
-    <payment
-        id="{transaction_id}"
-        sum="{amount_tyiyn}"
-        check="0"
-        service="{self.service_id}"
-        date="{current_time}"
-        account="">
-        <attribute name="amount_currency" value="417"/>
-        <attribute name="notify_url" value="{settings.DOMAIN}/api/payment/obank/notify"/>
-        <attribute name="redirect_url" value="{settings.DOMAIN}/payment/success"/>
-        <attribute name="email" value="test@evpower.kg"/>
-        <attribute name="card-token" value="{card_token}"/>
-    </payment>
-</request>"""
+        current_time = _now_str()
         
-        return xml
+        return _TOKEN_PAYMENT_TMPL.format_map({
+            **self._xml_params,
+            "id": transaction_id,
+            "sum": amount_tyiyn,
+            "date": current_time,
+            "card_token": card_token,
+        }).encode("utf-8")
     
-    def _create_status_xml(self, transaction_id: str) -> str:
+    def _create_status_xml(self, transaction_id: str) -> bytes:
         """Create XML for status check request"""
-        xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<request point="{self.point_id}">
-    <status id="{transaction_id}"/>
-</request>"""
-        
-        return xml
+        return self._status_prefix + str(transaction_id).encode() + self._status_suffix
 
-    async def create_h2h_payment(self, amount_kgs: float, client_id: str, card_data: Dict[str, str]) -> Dict[str, Any]:
+    async def _dispatch(
+        self,
+        operation: str,
+        endpoint: str,
+        build_xml: Callable[..., bytes],
+        mapper: Callable[[Dict[str, Any]], Dict[str, Any]],
+        fast_parser: Optional[Callable[[bytes], Optional[Dict[str, Any]]]] = None,
+        new_transaction: bool = False
+    ) -> Dict[str, Any]:
         """
-        Create Host-to-Host card payment
+        Build request XML, send it to OBANK and map the parsed result for callers.
+        With new_transaction build_xml receives a fresh transaction id
         """
         try:
-            amount_tyiyn = int(amount_kgs * 100)  # KGS to tyiyn
-            
-            xml_data = self._create_h2h_xml(amount_tyiyn, client_id, card_data)
-            
-            # ✅ PCI DSS COMPLIANT: Логируем только метаданные, БЕЗ данных карт
-            # ЗАПРЕЩЕНО логировать: номера карт, CVV, email, phone, holder_name
-            logger.info(
-                "H2H payment initiated",
-                extra={
-                    "client_id": client_id,
-                    "amount_kgs": amount_kgs,
-                    "has_card_data": bool(card_data),
-                    "has_email": bool(card_data.get('email')),
-                    "has_phone": bool(card_data.get('phone'))
-                }
-            )
-            
-            # ✅ ИСПРАВЛЕНО: Используем base URL (диагностика показала что endpoint = "")
-            result = await self._make_request("", xml_data)
+            args = (await _next_transaction_id(),) if new_transaction else ()
+            result = await self._make_request(endpoint, build_xml(*args), fast_parser)
+            return mapper(result)
+        except Exception as e:
+            logger.error(f"{operation} failed: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    @staticmethod
+    def _map_h2h(result: Dict[str, Any]) -> Dict[str, Any]:
+        if "error" not in result:
+            logger.info("✅ H2H payment successful!")
             
-            if "error" not in result:
-                logger.info(f"✅ H2H payment successful!")
-                
-                # ✅ ИСПРАВЛЕНО: Правильные поля для mobile.py
-                # OBANK возвращает: id, trans, state, code, final
-                # Mobile API ожидает: auth_key, transaction_id, status
-                payment_id = result.get("id")  # ID платежа
-                trans_id = result.get("trans")  # Транзакционный ID банка
-                state = result.get("state", "0")  # Статус платежа
-                
-                return {
-                    "success": True,
-                    "auth_key": payment_id,  # ID платежа как auth_key для invoice_id
-                    "transaction_id": trans_id,  # Банковский transaction ID
-                    "payment_id": payment_id,  # Дублируем для совместимости
-                    "status": "processing" if state == "0" else "completed",
-                    "message": "H2H payment created successfully",
-                    "result": result
-                }
-            else:
-                logger.error(f"❌ H2H payment failed: {result.get('error')}")
-                return {
-                    "success": False,
-                    "auth_key": None,
-                    "transaction_id": None,
-                    "payment_id": None,
-                    "status": "failed",
-                    "message": result.get('error', 'H2H payment failed'),
-                    "result": result
-                }
+            # ✅ ИСПРАВЛЕНО: Правильные поля для mobile.py
+            # OBANK возвращает: id, trans, state, code, final
+            # Mobile API ожидает: auth_key, transaction_id, status
+            payment_id = result.get("id")  # ID платежа
+            trans_id = result.get("trans")  # Транзакционный ID банка
+            state = result.get("state") or "0"  # Статус платежа
             
-        except Exception as e:
-            logger.error(f"H2H payment failed: {str(e)}")
             return {
-                "success": False, 
-                "auth_key": None,
-                "transaction_id": None,
-                "error": str(e)
+                "success": True,
+                "auth_key": payment_id,  # ID платежа как auth_key для invoice_id
+                "transaction_id": trans_id,  # Банковский transaction ID
+                "payment_id": payment_id,  # Дублируем для совместимости
+                "status": "processing" if state == "0" else "completed",
+                "message": "H2H payment created successfully",
+                "result": result
+            }
+        
+        logger.error(f"❌ H2H payment failed: {result.get('error')}")
+        return {
+            "success": False,
+            "auth_key": None,
+            "transaction_id": None,
+            "payment_id": None,
+            "status": "failed",
+            "message": result.get('error', 'H2H payment failed'),
+            "result": result
+        }
+
+    @staticmethod
+    def _map_token_payment(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "success": "error" not in result,
+            "payment_id": result.get("id"),
+            "status": result.get("state"),
+            "result": result
+        }
+
+    @staticmethod
+    def _map_token(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "success": "error" not in result,
+            "result": result
+        }
+
+    @staticmethod
+    def _map_status(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "success": "error" not in result,
+            "status": result.get("state"),
+            "final": result.get("final") == "1",
+            "result": result
+        }
+
+    async def create_h2h_payment(self, amount_kgs: float, client_id: str, card_data: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Create Host-to-Host card payment
+        """
+        # ✅ PCI DSS COMPLIANT: Логируем только метаданные, БЕЗ данных карт
+        # ЗАПРЕЩЕНО логировать: номера карт, CVV, email, phone, holder_name
+        logger.info(
+            "H2H payment initiated",
+            extra={
+                "client_id": client_id,
+                "amount_kgs": amount_kgs,
+                "has_card_data": bool(card_data),
+                "has_email": bool(card_data and card_data.get('email')),
+                "has_phone": bool(card_data and card_data.get('phone'))
             }
+        )
+        
+        # ✅ Эндпоинт H2H задается конфигурацией (по умолчанию base URL, endpoint = "")
+        return await self._dispatch(
+            "H2H payment",
+            self.h2h_endpoint,
+            lambda transaction_id: self._create_h2h_xml(
+                transaction_id, int(amount_kgs * 100), client_id, card_data  # KGS to tyiyn
+            ),
+            self._map_h2h,
+            new_transaction=True
+        )
 
     async def create_token_payment(self, amount_kgs: float, client_id: str, card_token: str) -> Dict[str, Any]:
         """
         Create payment using saved card token
         """
-        try:
-            amount_tyiyn = int(amount_kgs * 100)  # KGS to tyiyn
-            
-            xml_data = self._create_token_payment_xml(amount_tyiyn, client_id, card_token)
-            
-            # ✅ Используем правильный эндпоинт для токен платежей
-            result = await self._make_request("/token-payment", xml_data)
-            
-            return {
-                "success": "error" not in result,
-                "payment_id": result.get("id"),
-                "status": result.get("state"),
-                "result": result
-            }
-            
-        except Exception as e:
-            logger.error(f"Token payment failed: {str(e)}")
-            return {"success": False, "error": str(e)}
+        # ✅ Используем правильный эндпоинт для токен платежей
+        return await self._dispatch(
+            "Token payment",
+            "/token-payment",
+            lambda transaction_id: self._create_token_payment_xml(
+                transaction_id, int(amount_kgs * 100), client_id, card_token  # KGS to tyiyn
+            ),
+            self._map_token_payment,
+            new_transaction=True
+        )
     
     async def create_token(self, days: int = 14) -> Dict[str, Any]:
         """
         Create card storage token
         """
-        try:
-            xml_data = self._create_token_xml(days)
-            
-            # ✅ Используем правильный эндпоинт для создания токена
-            result = await self._make_request("/token-Create", xml_data)
-            
-            return {
-                "success": "error" not in result,
-                "result": result
-            }
-            
-        except Exception as e:
-            logger.error(f"Token creation failed: {str(e)}")
-            return {"success": False, "error": str(e)}
+        # ✅ Используем правильный эндпоинт для создания токена
+        return await self._dispatch("Token creation", "/token-Create", lambda: self._create_token_xml(days), self._map_token)
 
     async def check_h2h_status(self, transaction_id: str) -> Dict[str, Any]:
         """
         Check H2H payment status
         """
-        try:
-            xml_data = self._create_status_xml(transaction_id)
-            
-            # ✅ Используем правильный эндпоинт для проверки статуса H2H
-            result = await self._make_request("/h2hstatus", xml_data)
-            
-            return {
-                "success": "error" not in result,
-                "status": result.get("state"),
-                "final": result.get("final") == "1",
-                "result": result
-            }
-            
-        except Exception as e:
-            logger.error(f"Status check failed: {str(e)}")
-            return {"success": False, "error": str(e)}
+        # ✅ Используем правильный эндпоинт для проверки статуса H2H
+        return await self._dispatch(
+            "Status check",
+            "/h2hstatus",
+            lambda: self._create_status_xml(transaction_id),
+            self._map_status,
+            self._parse_status_fast
+        )
 
 # Global instance
 obank_service = OBankService() 
\ No newline at end of file
@@ -1,14 +1,23 @@
 """
 OTP Service
 Сервис для генерации и верификации OTP кодов
+
+Горячие запросы опираются на индексы из migrations/004_add_otp_codes_indexes.sql,
+при изменении сохраняйте форму фильтров и сортировки:
+- rate limit: WHERE phone ORDER BY created_at DESC LIMIT 1 -> (phone, created_at DESC)
+- verify: WHERE phone AND purpose AND verified_at IS NULL ORDER BY created_at DESC LIMIT 1
+  -> (phone, purpose, created_at DESC) WHERE verified_at IS NULL
+- cleanup: WHERE created_at < ... -> (created_at)
 """
+import asyncio
+import base64
 import logging
 import secrets
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Tuple
+from typing import Optional, Set, Tuple
 from uuid import uuid4
 
-from sqlalchemy import text
+from sqlalchemy import Integer, bindparam, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.config import settings
@@ -16,25 +25,114 @@ from app.services.wappi_service import wappi_service
 
 logger = logging.getLogger(__name__)
 
+# SQL запросы создаются один раз при импорте модуля
+
+# Rate limit: остаток окна в секундах по последнему коду номера
+_Q_RATE_LIMIT = text("""
+    SELECT CAST(:rate_limit AS integer) - EXTRACT(EPOCH FROM (NOW() - created_at)) AS remaining
+    FROM otp_codes
+    WHERE phone = :phone
+    ORDER BY created_at DESC
+    LIMIT 1
+""").bindparams(bindparam("rate_limit", type_=Integer))
+
+# Сохранение нового кода
+_Q_INSERT = text("""
+    INSERT INTO otp_codes (id, phone, code, purpose, max_attempts, expires_at, created_at)
+    VALUES (:id, :phone, :code, :purpose, :max_attempts, :expires_at, NOW())
+""")
+
+# Верификация одним запросом: находим действительный код (с блокировкой строки), увеличиваем
+# счетчик попыток и при совпадении помечаем код использованным.
+# attempts в ответе - значение ДО этой попытки
+_Q_VERIFY = text("""
+    WITH cand AS (
+        SELECT id, code, attempts, max_attempts
+        FROM otp_codes
+        WHERE phone = :phone
+          AND purpose = :purpose
+          AND verified_at IS NULL
+          AND expires_at > NOW()
+        ORDER BY created_at DESC
+        LIMIT 1
+        FOR UPDATE
+    ),
+    upd AS (
+        UPDATE otp_codes o
+        SET attempts = o.attempts + 1,
+            verified_at = CASE WHEN c.code = :code THEN NOW() ELSE NULL END
+        FROM cand c
+        WHERE o.id = c.id
+          AND c.attempts < c.max_attempts
+        RETURNING o.id
+    )
+    SELECT c.attempts, c.max_attempts, c.code = :code AS matched
+    FROM cand c
+""")
+
+# Очистка кодов старше 24 часов одной пачкой
+_Q_CLEANUP = text("""
+    DELETE FROM otp_codes
+    WHERE id IN (
+        SELECT id FROM otp_codes
+        WHERE created_at < NOW() - INTERVAL '24 hours'
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+""").bindparams(bindparam("batch_size", type_=Integer))
+
+# Ссылки на фоновые отправки, чтобы задачи не собрал GC до завершения
+_send_tasks: Set[asyncio.Task] = set()
+
+
+def _on_otp_sent(task: asyncio.Task, phone: str) -> None:
+    """Логирование результата фоновой отправки OTP"""
+    _send_tasks.discard(task)
+    if task.cancelled():
+        logger.warning(f"[OTP] Отправка кода на {phone} отменена")
+    elif task.exception() is not None:
+        logger.error(f"[OTP] Ошибка отправки кода на {phone}: {task.exception()}")
+    elif task.result():
+        logger.info(f"[OTP] Код отправлен на {phone}")
+    else:
+        # Код все равно сохранен в БД, можно переотправить
+        logger.warning(f"[OTP] Не удалось отправить код на {phone}")
+
 
 class OTPService:
     """Сервис для работы с OTP кодами"""
 
+    # Размер пачки при удалении истекших кодов
+    CLEANUP_BATCH_SIZE = 5000
+
+    # Таблица удаления для ASCII: оставляем только цифры и "+"
+    _PHONE_TABLE = str.maketrans("", "", "".join(chr(i) for i in range(128) if chr(i) not in "0123456789+"))
+
     def __init__(self):
         self.code_length = settings.OTP_CODE_LENGTH
         self.ttl_seconds = settings.OTP_TTL_SECONDS
         self.max_attempts = settings.OTP_MAX_ATTEMPTS
         self.rate_limit_seconds = settings.OTP_RATE_LIMIT_SECONDS
+        self.alphabet = settings.OTP_ALPHABET
+        # Код = одно случайное число [0, 10^n), дополненное нулями до n знаков
+        self._code_mod = 10 ** self.code_length
+        self._code_fmt = f"{{:0{self.code_length}d}}"
 
     def _generate_code(self) -> str:
         """Генерация случайного 6-значного кода"""
-        # Используем secrets для криптографически безопасной генерации
-        return "".join(secrets.choice("0123456789") for _ in range(self.code_length))
+        # Используем secrets для криптографически безопасной генерации (одно обращение к CSPRNG)
+        if self.alphabet == "base32":
+            # Каждый символ base32 - ровно 5 случайных бит, распределение равномерное
+            return base64.b32encode(secrets.token_bytes((self.code_length * 5 + 7) // 8)).decode()[:self.code_length]
+        return self._code_fmt.format(secrets.randbelow(self._code_mod))
 
     def _normalize_phone(self, phone: str) -> str:
         """Нормализация номера телефона"""
-        # Убираем пробелы и дефисы
-        phone = "".join(c for c in phone if c.isdigit() or c == "+")
+        # Убираем пробелы и дефисы (translate выполняется в C, без цикла по символам)
+        if phone.isascii():
+            phone = phone.translate(self._PHONE_TABLE)
+        else:
+            phone = "".join(c for c in phone if c.isdigit() or c == "+")
         # Добавляем + если нет
         if not phone.startswith("+"):
             phone = "+" + phone
@@ -49,32 +147,14 @@ class OTPService:
         """
         phone = self._normalize_phone(phone)
 
-        query = text("""
-            SELECT created_at
-            FROM otp_codes
-            WHERE phone = :phone
-            ORDER BY created_at DESC
-            LIMIT 1
-        """)
-
-        result = await db.execute(query, {"phone": phone})
+        # Остаток окна считает Postgres: в Python не тянем timestamp и не правим timezone
+        result = await db.execute(_Q_RATE_LIMIT, {"phone": phone, "rate_limit": self.rate_limit_seconds})
         row = result.fetchone()
 
-        if not row:
+        if not row or row[0] <= 0:
             return True, None
 
-        last_created = row[0]
-        if last_created.tzinfo is None:
-            last_created = last_created.replace(tzinfo=timezone.utc)
-
-        now = datetime.now(timezone.utc)
-        elapsed = (now - last_created).total_seconds()
-
-        if elapsed < self.rate_limit_seconds:
-            remaining = int(self.rate_limit_seconds - elapsed)
-            return False, remaining
-
-        return True, None
+        return False, int(row[0])
 
     async def create(self, db: AsyncSession, phone: str, purpose: str = "auth") -> Tuple[bool, str]:
         """
@@ -101,13 +181,8 @@ class OTPService:
 
         # Сохранение в БД
         try:
-            insert_query = text("""
-                INSERT INTO otp_codes (id, phone, code, purpose, max_attempts, expires_at, created_at)
-                VALUES (:id, :phone, :code, :purpose, :max_attempts, :expires_at, NOW())
-            """)
-
             await db.execute(
-                insert_query,
+                _Q_INSERT,
                 {
                     "id": str(uuid4()),
                     "phone": phone,
@@ -119,16 +194,12 @@ class OTPService:
             )
             await db.commit()
 
-            # Отправка через WhatsApp
-            sent = await wappi_service.send_otp(phone, code)
+            # Отправка через WhatsApp в фоне: код уже сохранен в БД, клиент не ждет Wappi
+            task = asyncio.create_task(wappi_service.send_otp(phone, code))
+            _send_tasks.add(task)
+            task.add_done_callback(lambda t: _on_otp_sent(t, phone))
 
-            if sent:
-                logger.info(f"[OTP] Код отправлен на {phone}")
-                return True, "Код отправлен в WhatsApp"
-            else:
-                logger.warning(f"[OTP] Не удалось отправить код на {phone}")
-                # Код все равно сохранен в БД, можно переотправить
-                return True, "Код создан (проверьте WhatsApp)"
+            return True, "Код отправлен в WhatsApp"
 
         except Exception as e:
             await db.rollback()
@@ -152,56 +223,31 @@ class OTPService:
         """
         phone = self._normalize_phone(phone)
 
-        # Найти действительный код
-        query = text("""
-            SELECT id, code, attempts, max_attempts, expires_at
-            FROM otp_codes
-            WHERE phone = :phone
-              AND purpose = :purpose
-              AND verified_at IS NULL
-              AND expires_at > NOW()
-            ORDER BY created_at DESC
-            LIMIT 1
-        """)
-
-        result = await db.execute(query, {"phone": phone, "purpose": purpose})
+        # Одним запросом: проверка, учет попытки и отметка об использовании
+        result = await db.execute(_Q_VERIFY, {"phone": phone, "purpose": purpose, "code": code})
         row = result.fetchone()
 
         if not row:
+            await db.rollback()
             return False, "Код не найден или истек. Запросите новый код."
 
-        otp_id, stored_code, attempts, max_attempts, expires_at = row
+        attempts, max_attempts, matched = row
 
-        # Проверка количества попыток
+        # Проверка количества попыток (строка не обновлялась)
         if attempts >= max_attempts:
+            await db.rollback()
             return False, "Превышено количество попыток. Запросите новый код."
 
-        # Увеличиваем счетчик попыток
-        update_attempts = text("""
-            UPDATE otp_codes
-            SET attempts = attempts + 1
-            WHERE id = :id
-        """)
-        await db.execute(update_attempts, {"id": otp_id})
+        await db.commit()
 
         # Проверка кода
-        if code != stored_code:
+        if not matched:
             remaining = max_attempts - attempts - 1
-            await db.commit()
             if remaining > 0:
                 return False, f"Неверный код. Осталось попыток: {remaining}"
             else:
                 return False, "Неверный код. Превышено количество попыток."
 
-        # Код верный - помечаем как использованный
-        mark_verified = text("""
-            UPDATE otp_codes
-            SET verified_at = NOW()
-            WHERE id = :id
-        """)
-        await db.execute(mark_verified, {"id": otp_id})
-        await db.commit()
-
         logger.info(f"[OTP] Код успешно верифицирован для {phone}")
         return True, "Код подтвержден"
 
@@ -213,16 +259,18 @@ class OTPService:
             Количество удаленных записей
         """
         try:
-            # Удаляем коды старше 24 часов (независимо от статуса)
-            delete_query = text("""
-                DELETE FROM otp_codes
-                WHERE created_at < NOW() - INTERVAL '24 hours'
-            """)
-
-            result = await db.execute(delete_query)
-            await db.commit()
+            # Удаляем коды старше 24 часов (независимо от статуса) пачками:
+            # короткие транзакции не держат блокировки и не раздувают WAL
+            deleted = 0
+            while True:
+                result = await db.execute(_Q_CLEANUP, {"batch_size": self.CLEANUP_BATCH_SIZE})
+                await db.commit()
+                deleted += result.rowcount
+                if result.rowcount < self.CLEANUP_BATCH_SIZE:
+                    break
+                # Отдаем управление event loop между пачками
+                await asyncio.sleep(0)
 
-            deleted = result.rowcount
             if deleted > 0:
                 logger.info(f"[OTP] Удалено {deleted} истекших кодов")
 
@@ -6,39 +6,139 @@ Unified Payment Provider Service
 - O!Dengi (Legacy support)
 
 Автоматически выбирает провайдера на основе настроек конфигурации.
+Провайдер выбирается один раз при создании сервиса: каждая реализация
+(ObankProvider / OdengiProvider) содержит только свою ветку логики.
 """
 
-from decimal import Decimal
-from typing import Dict, Any, Optional, Union
+from abc import ABC, abstractmethod
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Awaitable, Callable, ClassVar, Dict, Mapping, Optional, Tuple, Type
 from datetime import datetime, timezone
+from functools import lru_cache
+from types import MappingProxyType
+import asyncio
 import logging
+import random
+import time
+
+import httpx
 
 from app.core.config import settings
+from app.core.security_middleware import CircuitBreaker, CircuitOpenError
 
 logger = logging.getLogger(__name__)
 
-class PaymentProviderService:
+# Маппинг статусов провайдеров -> (статус, числовой статус для обратной совместимости)
+# OBANK (обновлённые)
+_OBANK_STATUS: Dict[str, Tuple[str, int]] = {
+    'processing': ("processing", 0),
+    'completed': ("approved", 1),
+    'failed': ("canceled", 2),
+    'cancelled': ("canceled", 2)
+}
+# ТЕКСТОВЫЕ статусы ODENGI (как возвращает API)
+_ODENGI_STATUS: Dict[str, Tuple[str, int]] = {
+    'processing': ("processing", 0),
+    'approved': ("approved", 1),
+    'canceled': ("canceled", 2)
+}
+_DEFAULT_STATUS: Tuple[str, int] = ("processing", 0)
+
+# Защита от деградации провайдера: после серии сетевых ошибок подряд запросы
+# сразу отклоняются (CircuitOpenError) вместо ожидания таймаута
+_BREAKER_FAILURES = 5
+_BREAKER_OPEN_SECONDS = 30
+_UPSTREAM_ATTEMPTS = 3
+# Повтор безопасен только если запрос гарантированно не дошел до провайдера...
+_RETRY_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout)
+# ...или операция идемпотентна (проверка статуса)
+_RETRY_IDEMPOTENT = (httpx.TransportError,)
+
+# Пустой ответ провайдера (только чтение) - без аллокации {} на каждый вызов
+_EMPTY: Mapping[str, Any] = MappingProxyType({})
+
+# Денежные множители: копейки O!Dengi (x100) и тыйыны OBANK (x1000)
+_HUNDRED: Decimal = Decimal(100)
+_THOUSAND: Decimal = Decimal(1000)
+
+
+def _to_decimal(value: Any) -> Decimal:
+    """Приводит сумму к Decimal без двоичной погрешности float"""
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+# Кэш статусов платежей: фронтенд и ретраи webhook опрашивают один и тот же платеж
+# много раз подряд. Незавершенные статусы живут недолго, финальные не меняются
+_STATUS_TTL_PENDING = 3.0
+_STATUS_TTL_FINAL = 60.0
+_FINAL_STATUSES = frozenset(("approved", "canceled"))
+_STATUS_CACHE_MAX = 10000
+# (provider, invoice_id) -> (expires_at по time.monotonic(), результат)
+_status_cache: Dict[Tuple[str, str], Tuple[float, Dict[str, Any]]] = {}
+# (provider, invoice_id) -> future выполняющейся проверки
+_status_inflight: Dict[Tuple[str, str], "asyncio.Future"] = {}
+
+
+def _prune_status_cache(now: float) -> None:
+    """Удаляет истекшие записи, при переполнении очищает кэш целиком"""
+    for key in [k for k, (expires_at, _) in _status_cache.items() if expires_at <= now]:
+        del _status_cache[key]
+    if len(_status_cache) >= _STATUS_CACHE_MAX:
+        _status_cache.clear()
+
+
+class PaymentProviderService(ABC):
     """Унифицированный сервис для работы с платежными провайдерами"""
-    
-    def __init__(self, force_provider: Optional[str] = None):
+
+    # Экземпляров 1-2 на процесс (см. фабрики ниже), атрибуты фиксированы - без __dict__
+    __slots__ = ("service", "_breaker")
+
+    provider: ClassVar[str] = ""
+
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None) -> None:
         """
         Инициализация провайдера
-        
+
         Args:
-            force_provider: Принудительно использовать конкретный провайдер ("OBANK" или "ODENGI")
-                           Если None - использует настройку из config
+            http_client: Общий HTTP клиент приложения (если API провайдера поддерживает set_client)
         """
-        self.provider = force_provider or settings.PAYMENT_PROVIDER
-        
-        if self.provider == "OBANK":
-            from app.services.obank_service import obank_service
-            self.service = obank_service
-        else:  # O!Dengi
-            from app.crud.ocpp_service import odengi_service
-            self.service = odengi_service
-        
-        logger.info(f"Инициализирован платежный провайдер: {self.provider}")
-    
+        self.service = self._load_service()
+        if http_client is not None:
+            set_client = getattr(self.service, 'set_client', None)
+            if set_client is not None:
+                set_client(http_client)
+        self._breaker = CircuitBreaker(
+            failure_threshold=_BREAKER_FAILURES,
+            timeout=_BREAKER_OPEN_SECONDS,
+            expected_exceptions=(httpx.HTTPError,)
+        )
+        logger.info("Инициализирован платежный провайдер: %s", self.provider)
+
+    @staticmethod
+    @abstractmethod
+    def _load_service() -> Any:
+        """Возвращает клиент API провайдера"""
+
+    async def _call_upstream(
+        self,
+        func: Callable[..., Awaitable[Dict[str, Any]]],
+        *args: Any,
+        retry_on: Tuple[Type[BaseException], ...] = _RETRY_NOT_SENT,
+        **kwargs: Any
+    ) -> Dict[str, Any]:
+        """Вызов API провайдера через circuit breaker с повтором (full jitter) на retry_on"""
+        for attempt in range(_UPSTREAM_ATTEMPTS):
+            try:
+                return await self._breaker.call_async(func, *args, **kwargs)
+            except retry_on as e:
+                if attempt == _UPSTREAM_ATTEMPTS - 1 or self._breaker.state == "open":
+                    raise
+                delay = random.uniform(0, 0.1 * 2 ** attempt)
+                logger.warning("%s upstream error (%s), retry in %.2fs", self.provider, e, delay)
+                await asyncio.sleep(delay)
+        # Недостижимо: последняя попытка либо вернула ответ, либо пробросила исключение
+        raise RuntimeError("upstream retry loop exhausted")
+
+    @abstractmethod
     async def create_payment(
         self,
         amount: Decimal,
@@ -52,7 +152,7 @@ class PaymentProviderService:
     ) -> Dict[str, Any]:
         """
         Создает платеж у выбранного провайдера
-        
+
         Args:
             amount: Сумма платежа в сомах
             order_id: Уникальный ID заказа
@@ -61,149 +161,82 @@ class PaymentProviderService:
             redirect_url: URL для редиректа
             description: Описание платежа
             client_id: ID клиента (опционально)
-            
+
         Returns:
             Dict с данными платежа
         """
-        if self.provider == "OBANK":
-            # Создаем платежную страницу OBANK
-            response = await self.service.create_payment_page(
-                amount=amount,
-                order_id=order_id,
-                email=email,
-                notify_url=notify_url,
-                redirect_url=redirect_url,
-                **kwargs
-            )
-            
-            # Извлекаем данные из ответа OBANK
-            data = response.get('data', {})
-            return {
-                "success": True,
-                "payment_url": data.get('pay-url', ''),
-                "auth_key": data.get('auth-key', ''),
-                "invoice_id": data.get('auth-key', ''),  # Используем auth-key как invoice_id
-                "provider": "OBANK",
-                "status": "pending"
-            }
-            
-        else:  # O!Dengi
-            # Конвертируем сумму в копейки для O!Dengi
-            amount_kopecks = int(amount * 100)
-            
-            response = await self.service.create_invoice(
-                order_id=order_id,
-                description=description,
-                amount_kopecks=amount_kopecks
-            )
-            
-            # ODENGI возвращает invoice_id в поле data согласно документации
-            data = response.get('data', {})
-            invoice_id = (data.get('invoice_id') or 
-                         response.get('invoice_id') or
-                         response.get('id') or
-                         order_id)  # fallback к order_id если API не вернул ID
-            
-            logger.info(f"📱 ODENGI extracted invoice_id: {invoice_id}")
-            
-            payment_url = (response.get('url') or 
-                          response.get('pay_url') or
-                          response.get('data', {}).get('url') or '')
-            
-            return {
-                "success": True,
-                "payment_url": payment_url,
-                "invoice_id": invoice_id,
-                "provider": "ODENGI",
-                "status": "processing",
-                "raw_response": response  # Для дебага
-            }
-    
+
     async def check_payment_status(
-        self, 
-        invoice_id: str, 
+        self,
+        invoice_id: str,
         order_id: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         Проверяет статус платежа у провайдера
-        
+
+        Ответы кэшируются на короткий TTL, одновременные запросы одного платежа
+        объединяются в один запрос к провайдеру. Если провайдер недоступен,
+        возвращается последний известный ответ с "stale": True.
+
         Args:
             invoice_id: ID платежа у провайдера
             order_id: ID заказа (для O!Dengi)
-            
+
         Returns:
             Dict со статусом платежа
         """
-        if self.provider == "OBANK":
-            # Для OBANK используем auth_key
-            response = await self.service.check_payment_status(auth_key=invoice_id)
-            
-            # Парсим ответ OBANK
-            data = response.get('data', {})
-            obank_status = data.get('status', 'processing')
-            
-            # Маппинг статусов OBANK (обновлённые)
-            status_mapping = {
-                'processing': {"status": "processing", "numeric": 0},
-                'completed': {"status": "approved", "numeric": 1},
-                'failed': {"status": "canceled", "numeric": 2},
-                'cancelled': {"status": "canceled", "numeric": 2}
-            }
-            
-            mapped = status_mapping.get(obank_status, {"status": "processing", "numeric": 0})
-            paid_amount = None
-            
-            if mapped["status"] == "approved":
-                # Конвертируем из тыйынов в сомы
-                paid_amount = float(data.get('sum', 0)) / 1000
-            
-            return {
-                "success": True,
-                "status": mapped["status"],
-                "numeric_status": mapped["numeric"],
-                "paid_amount": paid_amount,
-                "provider": "OBANK",
-                "raw_response": response
-            }
-            
-        else:  # O!Dengi
-            response = await self.service.get_payment_status(
-                invoice_id=invoice_id,
-                order_id=order_id
-            )
-            
-            # ODENGI возвращает текстовый статус в data.status
-            data = response.get('data', {})
-            status_text = data.get('status', 'processing')
-            paid_amount = None
-            
-            if data.get('amount'):
-                # Конвертируем из копеек в сомы
-                paid_amount = data.get('amount', 0) / 100
-            
-            # Маппинг ТЕКСТОВЫХ статусов ODENGI (как возвращает API)
-            status_mapping = {
-                'processing': "processing",
-                'approved': "approved", 
-                'canceled': "canceled"
-            }
-            
-            # Числовой статус для обратной совместимости
-            numeric_mapping = {
-                'processing': 0,
-                'approved': 1,
-                'canceled': 2
-            }
-            
-            return {
-                "success": True,
-                "status": status_mapping.get(status_text, "processing"),
-                "numeric_status": numeric_mapping.get(status_text, 0),
-                "paid_amount": paid_amount,
-                "provider": "ODENGI",
-                "raw_response": response
-            }
-    
+        key = (self.provider, invoice_id)
+        now = time.monotonic()
+
+        cached = _status_cache.get(key)
+        if cached is not None and cached[0] > now:
+            # Копия: кэшированный ответ не должен меняться вызывающим кодом
+            return cached[1].copy()
+
+        # Проверка уже выполняется - ждем ее результат вместо второго запроса
+        inflight = _status_inflight.get(key)
+        if inflight is not None:
+            return (await asyncio.shield(inflight)).copy()
+
+        future = asyncio.get_running_loop().create_future()
+        _status_inflight[key] = future
+        try:
+            result = await self._fetch_payment_status(invoice_id, order_id)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            if cached is None:
+                future.set_exception(e)
+                # Исключение уже передано ожидающим, не оставляем его "непрочитанным"
+                future.exception()
+                raise
+            # Провайдер недоступен - отдаем последний успешный ответ
+            logger.warning("%s status check failed (%s), serving stale %s", self.provider, e, invoice_id)
+            result = cached[1].copy()
+            result["stale"] = True
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            _status_inflight.pop(key, None)
+
+        ttl = _STATUS_TTL_FINAL if result.get("status") in _FINAL_STATUSES else _STATUS_TTL_PENDING
+        if len(_status_cache) >= _STATUS_CACHE_MAX:
+            _prune_status_cache(now)
+        _status_cache[key] = (time.monotonic() + ttl, result)
+        future.set_result(result)
+        # Ожидающие получают копии (см. выше), в кэше остается оригинал
+        return result.copy()
+
+    @abstractmethod
+    async def _fetch_payment_status(
+        self,
+        invoice_id: str,
+        order_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Запрос статуса платежа у провайдера (без кэша)"""
+
     async def create_h2h_payment(
         self,
         amount: Decimal,
@@ -216,7 +249,7 @@ class PaymentProviderService:
     ) -> Dict[str, Any]:
         """
         Создает H2H платеж картой (только OBANK)
-        
+
         Args:
             amount: Сумма платежа в сомах
             order_id: Уникальный ID заказа
@@ -224,17 +257,208 @@ class PaymentProviderService:
             email: Email клиента
             phone_number: Телефон клиента
             description: Описание платежа
-            
+
         Returns:
             Dict с результатом платежа
         """
-        if self.provider != "OBANK":
-            return {
-                "success": False,
-                "error": "h2h_not_supported",
-                "message": f"H2H платежи поддерживаются только провайдером OBANK, текущий: {self.provider}"
-            }
-        
+        return {
+            "success": False,
+            "error": "h2h_not_supported",
+            "message": f"H2H платежи поддерживаются только провайдером OBANK, текущий: {self.provider}"
+        }
+
+    async def create_token_payment(
+        self,
+        amount: Decimal,
+        order_id: str,
+        card_token: str,
+        email: str,
+        description: str = "",
+        **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Создает платеж по токену карты (только OBANK)
+
+        Args:
+            amount: Сумма платежа в сомах
+            order_id: Уникальный ID заказа
+            card_token: Токен сохраненной карты
+            email: Email клиента
+            description: Описание платежа
+
+        Returns:
+            Dict с результатом платежа
+        """
+        return {
+            "success": False,
+            "error": "token_not_supported",
+            "message": f"Token платежи поддерживаются только провайдером OBANK, текущий: {self.provider}"
+        }
+
+    async def create_token(self, days: int = 14) -> Dict[str, Any]:
+        """
+        Создает токен для сохранения карт (только OBANK)
+
+        Args:
+            days: Количество дней действия токена
+
+        Returns:
+            Dict с токеном
+        """
+        return {
+            "success": False,
+            "error": "token_creation_not_supported",
+            "message": f"Создание токенов поддерживается только провайдером OBANK, текущий: {self.provider}"
+        }
+
+    async def check_h2h_status(self, auth_key: str) -> Dict[str, Any]:
+        """
+        Проверяет статус H2H платежа (только OBANK)
+
+        Args:
+            auth_key: Ключ аутентификации H2H платежа
+
+        Returns:
+            Dict со статусом платежа
+        """
+        return {
+            "success": False,
+            "error": "h2h_status_not_supported",
+            "message": f"Проверка H2H статуса поддерживается только провайдером OBANK, текущий: {self.provider}"
+        }
+
+    @abstractmethod
+    async def cancel_payment(
+        self,
+        transaction_id: str,
+        refund_amount: Decimal
+    ) -> Dict[str, Any]:
+        """
+        Отменяет платеж и возвращает средства
+
+        Args:
+            transaction_id: ID транзакции для отмены
+            refund_amount: Сумма возврата в сомах
+
+        Returns:
+            Dict с результатом отмены
+        """
+
+    def get_webhook_verification_method(self) -> str:
+        """Возвращает метод верификации webhook для текущего провайдера"""
+        return self.provider
+
+    @abstractmethod
+    def verify_webhook(self, payload: bytes, signature: str, **kwargs) -> bool:
+        """
+        Верифицирует webhook от провайдера
+
+        Args:
+            payload: Тело запроса
+            signature: Подпись запроса
+
+        Returns:
+            bool: True если подпись корректна
+        """
+
+    def get_provider_name(self) -> str:
+        """Возвращает название текущего провайдера"""
+        return self.provider
+
+    @abstractmethod
+    def get_currency_code(self) -> str:
+        """Возвращает код валюты для текущего провайдера"""
+
+
+class ObankProvider(PaymentProviderService):
+    """OBANK: платежные страницы, H2H и токены карт"""
+
+    __slots__ = ()
+
+    provider = "OBANK"
+
+    # Шаблоны ответов: копия шаблона дешевле сборки dict литерала на каждый вызов
+    _PAGE_TMPL: ClassVar[Dict[str, Any]] = {"success": True, "payment_url": "", "auth_key": "", "invoice_id": "",
+                                            "provider": "OBANK", "status": "pending"}
+    _STATUS_TMPL: ClassVar[Dict[str, Any]] = {"success": True, "status": None, "numeric_status": None,
+                                              "paid_amount": None, "provider": "OBANK", "raw_response": None}
+
+    @staticmethod
+    def _load_service() -> Any:
+        from app.services.obank_service import obank_service
+        return obank_service
+
+    async def create_payment(
+        self,
+        amount: Decimal,
+        order_id: str,
+        email: str,
+        notify_url: str,
+        redirect_url: str,
+        description: str = "",
+        client_id: Optional[str] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        # Создаем платежную страницу OBANK
+        response = await self._call_upstream(
+            self.service.create_payment_page,
+            amount=amount,
+            order_id=order_id,
+            email=email,
+            notify_url=notify_url,
+            redirect_url=redirect_url,
+            **kwargs
+        )
+
+        # Извлекаем данные из ответа OBANK
+        data: Mapping[str, Any] = response.get('data') or _EMPTY
+        auth_key = data.get('auth-key', '')
+        result = self._PAGE_TMPL.copy()
+        result["payment_url"] = data.get('pay-url', '')
+        result["auth_key"] = auth_key
+        result["invoice_id"] = auth_key  # Используем auth-key как invoice_id
+        return result
+
+    async def _fetch_payment_status(
+        self,
+        invoice_id: str,
+        order_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        # Для OBANK используем auth_key
+        response = await self._call_upstream(
+            self.service.check_payment_status,
+            auth_key=invoice_id,
+            retry_on=_RETRY_IDEMPOTENT
+        )
+
+        # Парсим ответ OBANK
+        data: Mapping[str, Any] = response.get('data') or _EMPTY
+        obank_status = data.get('status', 'processing')
+
+        status, numeric_status = _OBANK_STATUS.get(obank_status, _DEFAULT_STATUS)
+        paid_amount: Optional[float] = None
+
+        if status == "approved":
+            # Конвертируем из тыйынов в сомы
+            paid_amount = float(_to_decimal(data.get('sum', 0)) / _THOUSAND)
+
+        result = self._STATUS_TMPL.copy()
+        result["status"] = status
+        result["numeric_status"] = numeric_status
+        result["paid_amount"] = paid_amount
+        result["raw_response"] = response
+        return result
+
+    async def create_h2h_payment(
+        self,
+        amount: Decimal,
+        order_id: str,
+        card_data: Dict[str, str],
+        email: str,
+        phone_number: Optional[str] = None,
+        description: str = "",
+        **kwargs
+    ) -> Dict[str, Any]:
         try:
             response = await self.service.create_h2h_payment(
                 amount_kgs=float(amount),
@@ -249,7 +473,7 @@ class PaymentProviderService:
                     "phone": phone_number or '+996700000000'
                 }
             )
-            
+
             if response.get('success'):
                 return {
                     "success": True,
@@ -265,15 +489,15 @@ class PaymentProviderService:
                     "error": response.get('error', 'h2h_creation_failed'),
                     "message": response.get('message', 'Ошибка создания H2H платежа')
                 }
-                
+
         except Exception as e:
-            logger.error(f"H2H payment creation error: {e}")
+            logger.error("H2H payment creation error: %s", e)
             return {
                 "success": False,
                 "error": "h2h_exception",
                 "message": str(e)
             }
-    
+
     async def create_token_payment(
         self,
         amount: Decimal,
@@ -283,33 +507,13 @@ class PaymentProviderService:
         description: str = "",
         **kwargs
     ) -> Dict[str, Any]:
-        """
-        Создает платеж по токену карты (только OBANK)
-        
-        Args:
-            amount: Сумма платежа в сомах
-            order_id: Уникальный ID заказа
-            card_token: Токен сохраненной карты
-            email: Email клиента
-            description: Описание платежа
-            
-        Returns:
-            Dict с результатом платежа
-        """
-        if self.provider != "OBANK":
-            return {
-                "success": False,
-                "error": "token_not_supported",
-                "message": f"Token платежи поддерживаются только провайдером OBANK, текущий: {self.provider}"
-            }
-        
         try:
             response = await self.service.create_token_payment(
                 amount_kgs=float(amount),
                 client_id=order_id,
                 card_token=card_token
             )
-            
+
             if response.get('success'):
                 return {
                     "success": True,
@@ -325,35 +529,19 @@ class PaymentProviderService:
                     "error": response.get('error', 'token_payment_failed'),
                     "message": response.get('message', 'Ошибка создания Token платежа')
                 }
-                
+
         except Exception as e:
-            logger.error(f"Token payment creation error: {e}")
+            logger.error("Token payment creation error: %s", e)
             return {
                 "success": False,
-                "error": "token_exception", 
+                "error": "token_exception",
                 "message": str(e)
             }
-    
+
     async def create_token(self, days: int = 14) -> Dict[str, Any]:
-        """
-        Создает токен для сохранения карт (только OBANK)
-        
-        Args:
-            days: Количество дней действия токена
-            
-        Returns:
-            Dict с токеном
-        """
-        if self.provider != "OBANK":
-            return {
-                "success": False,
-                "error": "token_creation_not_supported",
-                "message": f"Создание токенов поддерживается только провайдером OBANK, текущий: {self.provider}"
-            }
-        
         try:
             response = await self.service.create_token(days=days)
-            
+
             if response.get('success'):
                 return {
                     "success": True,
@@ -368,44 +556,28 @@ class PaymentProviderService:
                     "error": response.get('error', 'token_creation_failed'),
                     "message": response.get('message', 'Ошибка создания токена')
                 }
-                
+
         except Exception as e:
-            logger.error(f"Token creation error: {e}")
+            logger.error("Token creation error: %s", e)
             return {
                 "success": False,
                 "error": "token_creation_exception",
                 "message": str(e)
             }
-    
+
     async def check_h2h_status(self, auth_key: str) -> Dict[str, Any]:
-        """
-        Проверяет статус H2H платежа (только OBANK)
-        
-        Args:
-            auth_key: Ключ аутентификации H2H платежа
-            
-        Returns:
-            Dict со статусом платежа
-        """
-        if self.provider != "OBANK":
-            return {
-                "success": False,
-                "error": "h2h_status_not_supported",
-                "message": f"Проверка H2H статуса поддерживается только провайдером OBANK, текущий: {self.provider}"
-            }
-        
         try:
             response = await self.service.check_h2h_status(transaction_id=auth_key)
-            
+
             return {
                 "success": True,
                 "status": response.get('status', 'processing'),
                 "provider": "OBANK",
                 "raw_response": response
             }
-            
+
         except Exception as e:
-            logger.error(f"H2H status check error: {e}")
+            logger.error("H2H status check error: %s", e)
             return {
                 "success": False,
                 "error": "h2h_status_exception",
@@ -413,91 +585,179 @@ class PaymentProviderService:
             }
 
     async def cancel_payment(
-        self, 
-        transaction_id: str, 
+        self,
+        transaction_id: str,
         refund_amount: Decimal
     ) -> Dict[str, Any]:
-        """
-        Отменяет платеж и возвращает средства
-        
-        Args:
-            transaction_id: ID транзакции для отмены
-            refund_amount: Сумма возврата в сомах
-            
-        Returns:
-            Dict с результатом отмены
-        """
-        if self.provider == "OBANK":
-            response = await self.service.cancel_payment(
-                transaction_id=transaction_id,
-                refund_amount=refund_amount
-            )
-            
-            return {
-                "success": response.get('state') == '0',
-                "refund_id": response.get('id'),
-                "refund_amount": float(response.get('sum', 0)) / 1000,
-                "provider": "OBANK",
-                "raw_response": response
-            }
-            
-        else:  # O!Dengi
-            # O!Dengi не поддерживает API отмены
-            # Возвращаем статус что нужно делать вручную
-            return {
-                "success": False,
-                "error": "manual_refund_required",
-                "message": "O!Dengi требует ручной возврат через личный кабинет",
-                "provider": "ODENGI"
-            }
-    
-    def get_webhook_verification_method(self) -> str:
-        """Возвращает метод верификации webhook для текущего провайдера"""
-        return self.provider
-    
+        response = await self._call_upstream(
+            self.service.cancel_payment,
+            transaction_id=transaction_id,
+            refund_amount=refund_amount
+        )
+
+        return {
+            "success": response.get('state') == '0',
+            "refund_id": response.get('id'),
+            "refund_amount": float(_to_decimal(response.get('sum', 0)) / _THOUSAND),
+            "provider": "OBANK",
+            "raw_response": response
+        }
+
     def verify_webhook(self, payload: bytes, signature: str, **kwargs) -> bool:
-        """
-        Верифицирует webhook от провайдера
-        
-        Args:
-            payload: Тело запроса
-            signature: Подпись запроса
-            
-        Returns:
-            bool: True если подпись корректна
-        """
-        if self.provider == "OBANK":
-            # OBANK использует SSL сертификаты для аутентификации
-            # Дополнительная верификация не требуется если соединение установлено
-            return True
-            
-        else:  # O!Dengi
-            if hasattr(self.service, 'verify_webhook_signature'):
-                return self.service.verify_webhook_signature(payload, signature)
-            return False
-    
-    def get_provider_name(self) -> str:
-        """Возвращает название текущего провайдера"""
-        return self.provider
-    
+        # OBANK использует SSL сертификаты для аутентификации
+        # Дополнительная верификация не требуется если соединение установлено
+        return True
+
     def get_currency_code(self) -> str:
-        """Возвращает код валюты для текущего провайдера"""
-        if self.provider == "OBANK":
-            return "417"  # KGS код для OBANK
-        else:
-            return "KGS"  # Для O!Dengi
+        return "417"  # KGS код для OBANK
+
+
+class OdengiProvider(PaymentProviderService):
+    """O!Dengi: QR платежи (invoice)"""
+
+    __slots__ = ("_verify",)
+
+    provider = "ODENGI"
+
+    _INVOICE_TMPL: ClassVar[Dict[str, Any]] = {"success": True, "payment_url": "", "invoice_id": None,
+                                               "provider": "ODENGI", "status": "processing", "raw_response": None}
+    _STATUS_TMPL: ClassVar[Dict[str, Any]] = {"success": True, "status": None, "numeric_status": None,
+                                              "paid_amount": None, "provider": "ODENGI", "raw_response": None}
+    _MANUAL_REFUND: ClassVar[Dict[str, Any]] = {
+        "success": False,
+        "error": "manual_refund_required",
+        "message": "O!Dengi требует ручной возврат через личный кабинет",
+        "provider": "ODENGI"
+    }
+
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None) -> None:
+        super().__init__(http_client)
+        # Проверка подписи webhook определяется один раз, а не на каждый запрос
+        self._verify = getattr(self.service, 'verify_webhook_signature', None)
+
+    @staticmethod
+    def _load_service() -> Any:
+        from app.crud.ocpp_service import odengi_service
+        return odengi_service
+
+    async def create_payment(
+        self,
+        amount: Decimal,
+        order_id: str,
+        email: str,
+        notify_url: str,
+        redirect_url: str,
+        description: str = "",
+        client_id: Optional[str] = None,
+        **kwargs
+    ) -> Dict[str, Any]:
+        # Конвертируем сумму в копейки для O!Dengi
+        amount_kopecks: int = int((_to_decimal(amount) * _HUNDRED).to_integral_value(rounding=ROUND_HALF_UP))
+
+        response = await self._call_upstream(
+            self.service.create_invoice,
+            order_id=order_id,
+            description=description,
+            amount_kopecks=amount_kopecks
+        )
+
+        # ODENGI возвращает invoice_id в поле data согласно документации
+        data: Mapping[str, Any] = response.get('data') or _EMPTY
+        invoice_id = (data.get('invoice_id') or
+                     response.get('invoice_id') or
+                     response.get('id') or
+                     order_id)  # fallback к order_id если API не вернул ID
+
+        logger.info("📱 ODENGI extracted invoice_id: %s", invoice_id)
+
+        payment_url = (response.get('url') or
+                      response.get('pay_url') or
+                      data.get('url') or '')
+
+        result = self._INVOICE_TMPL.copy()
+        result["payment_url"] = payment_url
+        result["invoice_id"] = invoice_id
+        result["raw_response"] = response  # Для дебага
+        return result
+
+    async def _fetch_payment_status(
+        self,
+        invoice_id: str,
+        order_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        response = await self._call_upstream(
+            self.service.get_payment_status,
+            invoice_id=invoice_id,
+            order_id=order_id,
+            retry_on=_RETRY_IDEMPOTENT
+        )
+
+        # ODENGI возвращает текстовый статус в data.status
+        data: Mapping[str, Any] = response.get('data') or _EMPTY
+        status_text = data.get('status', 'processing')
+        paid_amount: Optional[float] = None
+
+        if data.get('amount'):
+            # Конвертируем из копеек в сомы
+            paid_amount = float(_to_decimal(data.get('amount', 0)) / _HUNDRED)
+
+        status, numeric_status = _ODENGI_STATUS.get(status_text, _DEFAULT_STATUS)
+
+        result = self._STATUS_TMPL.copy()
+        result["status"] = status
+        result["numeric_status"] = numeric_status
+        result["paid_amount"] = paid_amount
+        result["raw_response"] = response
+        return result
+
+    async def cancel_payment(
+        self,
+        transaction_id: str,
+        refund_amount: Decimal
+    ) -> Dict[str, Any]:
+        # O!Dengi не поддерживает API отмены
+        # Возвращаем статус что нужно делать вручную
+        return self._MANUAL_REFUND.copy()
+
+    def verify_webhook(self, payload: bytes, signature: str, **kwargs) -> bool:
+        return self._verify(payload, signature) if self._verify else False
+
+    def get_currency_code(self) -> str:
+        return "KGS"  # Для O!Dengi
+
+
+def _create_provider(provider: str) -> PaymentProviderService:
+    """Реализация для провайдера ("OBANK" или "ODENGI"), общая с QR/card фабриками"""
+    return _PROVIDER_FACTORIES.get(provider, get_qr_payment_service)()
 
 # Ленивая инициализация - создаем экземпляр только при первом обращении
-_payment_provider_service = None
+_payment_provider_service: Optional[PaymentProviderService] = None
 
 def get_payment_provider_service() -> PaymentProviderService:
     """Получение сервиса с настройками по умолчанию"""
-    return PaymentProviderService()
+    global _payment_provider_service
+    if _payment_provider_service is None:
+        _payment_provider_service = _create_provider(settings.PAYMENT_PROVIDER)
+    return _payment_provider_service
 
+def __getattr__(name: str) -> PaymentProviderService:
+    """`payment_provider_service` создается при первом обращении, а не при импорте модуля"""
+    if name == "payment_provider_service":
+        return get_payment_provider_service()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@lru_cache(maxsize=None)
 def get_qr_payment_service() -> PaymentProviderService:
     """Получение сервиса для QR платежей (O!Dengi)"""
-    return PaymentProviderService(force_provider="ODENGI")
+    return OdengiProvider()
 
+@lru_cache(maxsize=None)
 def get_card_payment_service() -> PaymentProviderService:
     """Получение сервиса для платежей картами (OBANK)"""
-    return PaymentProviderService(force_provider="OBANK") 
\ No newline at end of file
+    return ObankProvider()
+
+# Провайдер -> фабрика его (единственного) экземпляра; неизвестный провайдер -> O!Dengi
+_PROVIDER_FACTORIES: Dict[str, Callable[[], PaymentProviderService]] = {
+    "OBANK": get_card_payment_service,
+    "ODENGI": get_qr_payment_service,
+}
@@ -2,19 +2,49 @@
 Сервис динамического ценообразования для EvPower
 Обрабатывает все виды тарификации: по энергии, времени, фиксированные платы
 """
-from typing import Dict, Any, Optional, List, Tuple
+from typing import Dict, Any, Hashable, Optional, List, Set, Tuple, Union
 from datetime import datetime, timezone, time, date, timedelta
-from decimal import Decimal
+from decimal import Context, Decimal, ROUND_HALF_UP, localcontext
 from sqlalchemy.orm import Session
-from sqlalchemy import text
-from dataclasses import dataclass
+from sqlalchemy import (
+    Boolean, Date, DateTime, Float, Integer, String, Time, bindparam, text
+)
+from dataclasses import dataclass, fields, replace
+import asyncio
 import logging
 import json
-import hashlib
+import os
+import queue
+import random
+import threading
+import weakref
+from collections import OrderedDict
+from time import monotonic as _monotonic
 from enum import Enum
+import redis as redis_sync
+from redis.exceptions import RedisError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+# Decimal неизменяем - общие константы вместо разбора литерала на каждом расчете
+_ZERO = Decimal('0')
+_ONE = Decimal('1')
+_HUNDRED = Decimal('100')
+_DEFAULT_RATE_PER_KWH = Decimal('13.5')
+# Денежная арифметика: 12 значащих цифр достаточно для сумм в сомах,
+# короче коэффициенты - дешевле операции (по умолчанию 28)
+_MONEY_CONTEXT = Context(prec=12, rounding=ROUND_HALF_UP)
+
+
+def _to_decimal(value: Any) -> Decimal:
+    """numeric из БД уже Decimal; float/int (в т.ч. из JSON) - без двоичной погрешности"""
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
 
 class TariffType(str, Enum):
     PER_KWH = 'per_kwh'
@@ -28,9 +58,22 @@ class DiscountType(str, Enum):
     FIXED = 'fixed'
 
 
-@dataclass
+# Справочники для описания правила (не пересоздаются на каждый расчет)
+_DAY_NAMES = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+_TARIFF_NAMES = {
+    TariffType.PER_KWH: 'Тариф за энергию',
+    TariffType.PER_MINUTE: 'Поминутный тариф',
+    TariffType.SESSION_FEE: 'Фиксированная плата',
+    TariffType.PARKING_FEE: 'Плата за парковку'
+}
+
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class PricingResult:
-    """Результат расчета тарифа"""
+    """
+    Результат расчета тарифа. Неизменяемый: один объект из кэша отдается всем
+    вызывающим процесса - измененную копию строить через dataclasses.replace
+    """
     rate_per_kwh: Decimal
     rate_per_minute: Decimal
     session_fee: Decimal
@@ -51,7 +94,8 @@ class PricingResult:
             "parking_fee_per_minute": float(self.parking_fee_per_minute),
             "currency": self.currency,
             "active_rule": self.active_rule,
-            "rule_details": self.rule_details,
+            # Копия: rule_details общий для всех получателей кэшированного результата
+            "rule_details": dict(self.rule_details),
             "time_based": self.time_based,
             "next_rate_change": self.next_rate_change.isoformat() if self.next_rate_change else None,
             "tariff_plan_id": self.tariff_plan_id,
@@ -59,7 +103,11 @@ class PricingResult:
         }
 
 
-@dataclass
+# Поля данных PricingResult (в __slots__ есть еще __weakref__)
+_PRICING_FIELDS = tuple(f.name for f in fields(PricingResult))
+
+
+@dataclass(slots=True)
 class SessionCost:
     """Стоимость сессии зарядки"""
     total: Decimal
@@ -70,31 +118,673 @@ class SessionCost:
     promo_code_applied: Optional[str]
 
 
+def _json_list(value: Any) -> List[Dict[str, Any]]:
+    """json_agg колонка: драйвер возвращает уже разобранный список (или строку), NULL -> []"""
+    if not value:
+        return []
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def _dumps_json(value: Any) -> str:
+    """JSON для колонок истории: orjson (C, в разы быстрее json), иначе stdlib"""
+    if orjson is not None:
+        return orjson.dumps(value, default=str).decode()
+    return json.dumps(value, default=str)
+
+
+def _parse_time(value: Any) -> Optional[time]:
+    """Время из JSON ('HH:MM:SS') в time"""
+    if value is None or isinstance(value, time):
+        return value
+    return time.fromisoformat(value)
+
+
+_ALL_DAYS_MASK = 0b1111111  # Пн = бит 0 ... Вс = бит 6
+
+
+def _days_mask(days_of_week: Optional[List[int]]) -> int:
+    """Дни недели (1=Пн..7=Вс) в битовую маску; не заданы - все дни"""
+    if not days_of_week:
+        return _ALL_DAYS_MASK
+    mask = 0
+    for day in days_of_week:
+        mask |= 1 << (day - 1)
+    return mask
+
+
+def _time_window(start: Optional[time], end: Optional[time]) -> Optional[Tuple[int, int]]:
+    """Временное окно правила в секундах от начала суток; None - без ограничения"""
+    if not start or not end:
+        return None
+    return (
+        start.hour * 3600 + start.minute * 60 + start.second,
+        end.hour * 3600 + end.minute * 60 + end.second
+    )
+
+
+def _windows_overlap(
+    window1: Optional[Tuple[int, int]],
+    window2: Optional[Tuple[int, int]]
+) -> bool:
+    """Пересекаются ли окна; окна через полночь упрощенно считаются пересекающимися"""
+    if window1 is None or window2 is None:
+        return True
+    start1, end1 = window1
+    start2, end2 = window2
+    if start1 < end1 and start2 < end2:
+        return not (end1 <= start2 or end2 <= start1)
+    return True
+
+
+# ============================================================================
+# SQL-запросы расчета тарифа
+# ============================================================================
+# Собираются один раз при импорте: SQLAlchemy кэширует компиляцию по объекту
+# запроса, типы параметров заданы явно и не выводятся на каждом вызове
+
+_PRICING_CONTEXT_STMT = text("""
+    WITH station AS (
+        SELECT
+            s.id,
+            s.price_per_kwh,
+            s.session_fee,
+            s.currency,
+            s.tariff_plan_id,
+            tp.name as tariff_plan_name
+        FROM stations s
+        LEFT JOIN tariff_plans tp ON s.tariff_plan_id = tp.id
+        WHERE s.id = :station_id
+    ),
+    client AS (
+        SELECT
+            ct.tariff_plan_id,
+            ct.discount_percent,
+            ct.fixed_rate_per_kwh,
+            tp.name
+        FROM client_tariffs ct
+        LEFT JOIN tariff_plans tp ON ct.tariff_plan_id = tp.id
+        WHERE ct.client_id = :client_id
+            AND ct.is_active = true
+            AND ct.valid_from <= :now
+            AND (ct.valid_until IS NULL OR ct.valid_until > :now)
+            -- У станции с индивидуальной ценой клиентский тариф не нужен
+            AND NOT EXISTS (SELECT 1 FROM station WHERE price_per_kwh > 0)
+        ORDER BY ct.created_at DESC
+        LIMIT 1
+    ),
+    -- Клиентский план подбирается без фильтра по коннектору, план станции - с ним
+    plans AS (
+        SELECT 'client' as scope, tariff_plan_id, CAST(NULL AS text) as connector_type
+        FROM client WHERE tariff_plan_id IS NOT NULL
+        UNION ALL
+        SELECT 'station', tariff_plan_id, CAST(:connector_type AS text)
+        FROM station WHERE tariff_plan_id IS NOT NULL AND COALESCE(price_per_kwh, 0) <= 0
+    ),
+    rules AS (
+        SELECT p.scope, r.*
+        FROM plans p
+        JOIN tariff_rules r ON r.tariff_plan_id = p.tariff_plan_id
+        WHERE r.is_active = true
+            AND (r.valid_from IS NULL OR r.valid_from <= :current_date)
+            AND (r.valid_until IS NULL OR r.valid_until >= :current_date)
+            AND (r.connector_type = 'ALL' OR r.connector_type = p.connector_type OR p.connector_type IS NULL)
+            AND (r.power_range_min IS NULL OR r.power_range_min <= :power_kw)
+            AND (r.power_range_max IS NULL OR r.power_range_max >= :power_kw)
+            AND (
+                r.days_mask IS NULL
+                OR (r.days_mask & :weekday_bit) <> 0
+                OR (r.is_weekend = :is_weekend AND r.is_weekend IS NOT NULL)
+            )
+            -- Временное окно, в т.ч. через полночь (22:00 - 06:00)
+            AND (
+                r.time_start IS NULL OR r.time_end IS NULL
+                OR (r.time_start < r.time_end AND :current_time BETWEEN r.time_start AND r.time_end)
+                OR (r.time_start >= r.time_end AND (:current_time >= r.time_start OR :current_time <= r.time_end))
+            )
+    ),
+    -- Для каждого плана только правило с наивысшим приоритетом
+    best_rules AS (
+        SELECT DISTINCT ON (scope)
+            scope,
+            json_build_object(
+                'id', id, 'name', name, 'tariff_type', tariff_type,
+                'connector_type', connector_type, 'power_range_min', power_range_min,
+                'power_range_max', power_range_max, 'price', price, 'currency', currency,
+                'time_start', time_start, 'time_end', time_end, 'is_weekend', is_weekend,
+                'priority', priority, 'min_duration', min_duration_minutes,
+                'max_duration', max_duration_minutes, 'valid_from', valid_from,
+                'valid_until', valid_until, 'days_of_week', days_of_week,
+                'tariff_plan_id', tariff_plan_id
+            ) as rule
+        FROM rules
+        ORDER BY scope, priority DESC, created_at DESC
+    )
+    SELECT
+        st.id,
+        st.price_per_kwh,
+        st.session_fee,
+        st.currency,
+        st.tariff_plan_id,
+        st.tariff_plan_name,
+        cl.tariff_plan_id,
+        cl.discount_percent,
+        cl.fixed_rate_per_kwh,
+        cl.name,
+        (SELECT rule FROM best_rules WHERE scope = 'client'),
+        (SELECT rule FROM best_rules WHERE scope = 'station'),
+        (
+            SELECT json_agg(json_build_object(
+                'id', tr.id, 'tariff_plan_id', tr.tariff_plan_id, 'time_start', tr.time_start,
+                'days_mask', tr.days_mask, 'is_weekend', tr.is_weekend
+            ) ORDER BY tr.time_start)
+            FROM tariff_rules tr
+            WHERE tr.tariff_plan_id IN (SELECT tariff_plan_id FROM plans)
+                AND tr.is_active = true
+                AND tr.time_start IS NOT NULL
+        )
+    FROM station st
+    LEFT JOIN client cl ON true
+""").bindparams(
+    bindparam("station_id", type_=String),
+    bindparam("client_id", type_=String),
+    bindparam("now", type_=DateTime(timezone=True)),
+    bindparam("connector_type", type_=String),
+    bindparam("current_date", type_=Date),
+    bindparam("current_time", type_=Time),
+    bindparam("power_kw", type_=Float),
+    bindparam("weekday_bit", type_=Integer),
+    bindparam("is_weekend", type_=Boolean)
+)
+
+# Промо-код и число его использований клиентом (0 без клиента) одной строкой
+_PROMO_STMT = text("""
+    SELECT
+        p.id, p.discount_type, p.discount_value,
+        p.max_discount_amount, p.min_charge_amount,
+        p.usage_limit, p.usage_count, p.client_usage_limit,
+        CASE WHEN CAST(:client_id AS text) IS NULL THEN 0 ELSE (
+            SELECT COUNT(*)
+            FROM promo_code_usage u
+            WHERE u.promo_code_id = p.id
+                AND u.client_id = :client_id
+        ) END as client_usage
+    FROM promo_codes p
+    WHERE p.code = :code
+        AND p.is_active = true
+        AND p.valid_from <= NOW()
+        AND p.valid_until >= NOW()
+""").bindparams(
+    bindparam("code", type_=String),
+    bindparam("client_id", type_=String)
+)
+
+# Аналитика: история фильтруется один раз, сводка и топ правил считаются
+# по одной выборке (топ - json-массивом в той же строке)
+_PRICING_ANALYTICS_STMT = text("""
+    WITH history AS (
+        SELECT station_id, rule_id, rule_name, rate_per_kwh
+        FROM pricing_history
+        WHERE calculation_time BETWEEN :date_from AND :date_to
+            AND (CAST(:station_id AS text) IS NULL OR station_id = :station_id)
+    ),
+    top_rules AS (
+        SELECT
+            rule_name as name,
+            COUNT(*) as usage_count,
+            AVG(rate_per_kwh) as avg_rate
+        FROM history
+        GROUP BY rule_name
+        ORDER BY usage_count DESC
+        LIMIT 10
+    )
+    SELECT
+        COUNT(*) as total_calculations,
+        COUNT(DISTINCT station_id) as unique_stations,
+        COUNT(DISTINCT rule_id) as unique_rules,
+        AVG(rate_per_kwh) as avg_rate_per_kwh,
+        MIN(rate_per_kwh) as min_rate_per_kwh,
+        MAX(rate_per_kwh) as max_rate_per_kwh,
+        (SELECT json_agg(t ORDER BY t.usage_count DESC) FROM top_rules t) as top_rules
+    FROM history
+""").bindparams(
+    bindparam("date_from", type_=Date),
+    bindparam("date_to", type_=Date),
+    bindparam("station_id", type_=String)
+)
+
+
+# ============================================================================
+# Фоновая запись pricing_history
+# ============================================================================
+# INSERT истории не нужен ответу API: записи копятся в очереди и пишутся пачками
+# (один multi-VALUES INSERT) отдельным потоком со своей сессией БД
+
+_HISTORY_QUEUE_SIZE = 10000
+_HISTORY_BATCH_SIZE = 500
+_HISTORY_FLUSH_INTERVAL = 0.2  # секунд ожидания первой записи пачки
+# Доля записываемых расчетов (1.0 - все); попадания в кэш не пишутся никогда
+_HISTORY_SAMPLE_RATE = float(os.getenv("PRICING_HISTORY_SAMPLE_RATE", "1.0"))
+
+_HISTORY_COLUMNS = (
+    "station_id", "tariff_plan_id", "rule_id",
+    "calculation_time", "rate_per_kwh", "rate_per_minute",
+    "session_fee", "parking_fee_per_minute", "currency",
+    "rule_name", "rule_details"
+)
+_HISTORY_PARAMS = (
+    "station_id", "tariff_plan_id", "rule_id",
+    "calculation_time", "rate_per_kwh", "rate_per_minute",
+    "session_fee", "parking_fee", "currency",
+    "rule_name", "rule_details"
+)
+
+_history_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=_HISTORY_QUEUE_SIZE)
+_history_writer: Optional[threading.Thread] = None
+_history_writer_lock = threading.Lock()
+
+
+def _ensure_history_writer() -> None:
+    """Запускает поток записи истории при первой записи"""
+    global _history_writer
+    if _history_writer is not None:
+        return
+    with _history_writer_lock:
+        if _history_writer is None:
+            _history_writer = threading.Thread(
+                target=_history_writer_loop, name="pricing-history-writer", daemon=True
+            )
+            _history_writer.start()
+
+
+def _drain_history_batch() -> List[Dict[str, Any]]:
+    """Ждет первую запись и добирает без ожидания до _HISTORY_BATCH_SIZE"""
+    try:
+        batch = [_history_queue.get(timeout=_HISTORY_FLUSH_INTERVAL)]
+    except queue.Empty:
+        return []
+    while len(batch) < _HISTORY_BATCH_SIZE:
+        try:
+            batch.append(_history_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _flush_history(batch: List[Dict[str, Any]]) -> None:
+    """Пишет пачку записей истории одним INSERT"""
+    from app.db.session import get_session_local
+    
+    values = []
+    params: Dict[str, Any] = {}
+    for i, record in enumerate(batch):
+        values.append("(" + ", ".join(f":{name}_{i}" for name in _HISTORY_PARAMS) + ")")
+        for name in _HISTORY_PARAMS:
+            params[f"{name}_{i}"] = record[name]
+        params[f"rule_details_{i}"] = _dumps_json(record["rule_details"])
+    
+    with get_session_local()() as db:
+        db.execute(text(
+            f"INSERT INTO pricing_history ({', '.join(_HISTORY_COLUMNS)}) VALUES {', '.join(values)}"
+        ), params)
+        db.commit()
+    _bump_analytics_versions({record["station_id"] for record in batch})
+
+
+def _history_writer_loop() -> None:
+    while True:
+        batch = _drain_history_batch()
+        if not batch:
+            continue
+        try:
+            _flush_history(batch)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить историю тарифов ({len(batch)} записей): {e}")
+
+
+def _value_fingerprint(value: Any) -> Optional[Tuple]:
+    """Поля PricingResult кортежем (для дедупликации в кэше); None - не дедуплицируется"""
+    if not isinstance(value, PricingResult):
+        return None
+    try:
+        fingerprint = tuple(
+            tuple(sorted(v.items())) if isinstance(v, dict) else v
+            for v in (getattr(value, name) for name in _PRICING_FIELDS)
+        )
+        hash(fingerprint)
+    except TypeError:
+        return None
+    return fingerprint
+
+
 class PricingCache:
-    """Кэш для тарифов"""
-    def __init__(self, ttl_seconds: int = 300):
-        self._cache: Dict[str, Tuple[Any, datetime]] = {}
+    """Кэш для тарифов (TTL по time.monotonic + ограничение размера по LRU)"""
+    def __init__(self, ttl_seconds: int = 300, max_size: int = 10000):
+        # key -> (value, monotonic время истечения); порядок - от давно использованных к свежим
+        self._cache: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        # Ключи различаются минутой расчета, а результат для станции обычно тот же:
+        # одинаковые результаты хранятся одним объектом (пока на него ссылается кэш)
+        self._interned: "weakref.WeakValueDictionary[Tuple, Any]" = weakref.WeakValueDictionary()
         self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        # Кэш общий для потоков пула sync эндпоинтов
+        self._lock = threading.Lock()
     
-    def get(self, key: str) -> Optional[Any]:
-        if key in self._cache:
-            value, timestamp = self._cache[key]
-            if (datetime.now() - timestamp).total_seconds() < self.ttl_seconds:
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if _monotonic() < expires_at:
+                self._cache.move_to_end(key)
                 return value
-            else:
-                del self._cache[key]
-        return None
+            del self._cache[key]
+            return None
     
-    def set(self, key: str, value: Any) -> None:
-        self._cache[key] = (value, datetime.now())
+    def set(self, key: Hashable, value: Any) -> None:
+        fingerprint = _value_fingerprint(value)
+        with self._lock:
+            if fingerprint is not None:
+                value = self._interned.setdefault(fingerprint, value)
+            self._cache[key] = (value, _monotonic() + self.ttl_seconds)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
     
     def clear(self) -> None:
-        self._cache.clear()
+        with self._lock:
+            self._cache.clear()
+            self._interned.clear()
+    
+    def invalidate(self, first_arg: Any, last_from: Any = None) -> int:
+        """
+        Удаляет записи, ключ которых начинается с first_arg (например station_id);
+        с last_from - только те, у которых последний элемент ключа >= last_from
+        """
+        with self._lock:
+            keys = [
+                k for k in self._cache
+                if isinstance(k, tuple) and k and k[0] == first_arg
+                and (last_from is None or k[-1] >= last_from)
+            ]
+            for key in keys:
+                del self._cache[key]
+            return len(keys)
     
-    def make_key(self, *args) -> str:
-        """Создает ключ кэша из аргументов"""
-        key_str = json.dumps(args, sort_keys=True, default=str)
-        return hashlib.md5(key_str.encode()).hexdigest()
+    def make_key(self, *args) -> Tuple:
+        """Создает ключ кэша из аргументов (кортеж хэшируется словарем напрямую)"""
+        return tuple(tuple(a) if isinstance(a, list) else a for a in args)
+
+
+# Кэши тарифов общие для процесса (по TTL): PricingService создается на каждый запрос,
+# и собственный кэш экземпляра не переживал бы запрос
+_shared_caches: Dict[int, PricingCache] = {}
+_shared_caches_lock = threading.Lock()
+
+
+def _get_shared_cache(ttl_seconds: int) -> PricingCache:
+    cache = _shared_caches.get(ttl_seconds)
+    if cache is None:
+        with _shared_caches_lock:
+            cache = _shared_caches.setdefault(ttl_seconds, PricingCache(ttl_seconds))
+    return cache
+
+
+# ============================================================================
+# L2 кэш тарифов в Redis
+# ============================================================================
+# PricingCache живет в памяти процесса: при промахе результат берется из Redis,
+# чтобы первый запрос к станции в каждом воркере не шел в БД. Отказ Redis на
+# расчет не влияет: короткие таймауты, после ошибки L2 пропускается на время.
+# Клиент синхронный: из event loop L2 вызывается только в пуле потоков
+# (PricingService.calculate_pricing_async). Настройки - PRICING_REDIS_CACHE_* в Settings.
+# Ключи записей станции хранятся в множестве pricing_keys:{station_id} - для сброса
+
+_REDIS_TIMEOUT = 0.1  # секунд: кэш не должен тормозить расчет
+_REDIS_RETRY_AFTER = 30.0
+_redis_retry_at = 0.0
+_redis_client: Optional["redis_sync.Redis"] = None
+_DECIMAL_FIELDS = ('rate_per_kwh', 'rate_per_minute', 'session_fee', 'parking_fee_per_minute')
+
+
+_REDIS_STATIONS_KEY = "pricing_keys"
+
+
+def _redis_key(key: Tuple) -> str:
+    return "pricing:" + ":".join("" if part is None else str(part) for part in key)
+
+
+def _redis_station_keys(station_id: str) -> str:
+    """Множество ключей L2 станции"""
+    return f"{_REDIS_STATIONS_KEY}:{station_id}"
+
+
+def _redis_cache_client() -> Optional["redis_sync.Redis"]:
+    """Клиент L2, если кэш включен и не отключен после ошибки"""
+    global _redis_client
+    if _redis_client is None:
+        from app.core.config import settings
+        if not settings.PRICING_REDIS_CACHE_ENABLED:
+            return None
+        _redis_client = redis_sync.from_url(
+            settings.REDIS_URL,
+            decode_responses=True,
+            socket_timeout=_REDIS_TIMEOUT,
+            socket_connect_timeout=_REDIS_TIMEOUT
+        )
+    if _monotonic() < _redis_retry_at:
+        return None
+    return _redis_client
+
+
+def _redis_cache_failed(e: Exception) -> None:
+    global _redis_retry_at
+    _redis_retry_at = _monotonic() + _REDIS_RETRY_AFTER
+    logger.warning("L2 кэш тарифов недоступен, пропускаем %.0f с: %s", _REDIS_RETRY_AFTER, e)
+
+
+def _redis_cache_get(key: Tuple) -> Optional[PricingResult]:
+    """Результат из L2; None при промахе или недоступности Redis"""
+    client = _redis_cache_client()
+    if client is None:
+        return None
+    try:
+        blob = client.get(_redis_key(key))
+    except RedisError as e:
+        _redis_cache_failed(e)
+        return None
+    if not blob:
+        return None
+    try:
+        data = orjson.loads(blob) if orjson is not None else json.loads(blob)
+        for name in _DECIMAL_FIELDS:
+            data[name] = Decimal(data[name])
+        if data['next_rate_change']:
+            data['next_rate_change'] = datetime.fromisoformat(data['next_rate_change'])
+        return PricingResult(**data)
+    except (ValueError, TypeError, KeyError, ArithmeticError) as e:
+        logger.warning("Некорректная запись тарифа в Redis %s: %s", _redis_key(key), e)
+        return None
+
+
+def _redis_cache_set(key: Tuple, result: PricingResult) -> None:
+    """Кладет результат в L2 (Decimal - строкой, без потери точности)"""
+    from app.core.config import settings
+
+    client = _redis_cache_client()
+    if client is None:
+        return
+    ttl = settings.PRICING_REDIS_CACHE_TTL
+    redis_key = _redis_key(key)
+    station_keys = _redis_station_keys(key[0])
+    blob = _dumps_json({name: getattr(result, name) for name in _PRICING_FIELDS})
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.setex(redis_key, ttl, blob)
+        # Списки ключей живут не дольше самих записей
+        pipe.sadd(station_keys, redis_key)
+        pipe.expire(station_keys, ttl)
+        pipe.sadd(_REDIS_STATIONS_KEY, station_keys)
+        pipe.expire(_REDIS_STATIONS_KEY, ttl)
+        pipe.execute()
+    except RedisError as e:
+        _redis_cache_failed(e)
+
+
+def _redis_cache_delete(station_id: Optional[str]) -> None:
+    """Удаляет записи L2 станции (None - всех станций)"""
+    client = _redis_cache_client()
+    if client is None:
+        return
+    try:
+        if station_id is None:
+            key_sets = list(client.smembers(_REDIS_STATIONS_KEY)) + [_REDIS_STATIONS_KEY]
+        else:
+            key_sets = [_redis_station_keys(station_id)]
+        pipe = client.pipeline(transaction=False)
+        for key_set in key_sets:
+            pipe.smembers(key_set)
+        keys = [key for members in pipe.execute() for key in members]
+        client.delete(*keys, *key_sets)
+    except RedisError as e:
+        _redis_cache_failed(e)
+
+
+# ============================================================================
+# Кэш аналитики тарифов
+# ============================================================================
+# Агрегат по pricing_history за период дорогой, а дашборд опрашивает его
+# постоянно: результат живет в памяти процесса и в Redis (общий для воркеров).
+# История пишется только "сейчас": периоды, закончившиеся до сегодня, не меняются.
+# Ключ аналитики текущего периода включает версию станции в Redis, которую
+# поднимает запись истории - устаревшие записи просто перестают читаться
+
+_ANALYTICS_CACHE_TTL = int(os.getenv("PRICING_ANALYTICS_CACHE_TTL", "60"))
+_analytics_cache = PricingCache(ttl_seconds=_ANALYTICS_CACHE_TTL, max_size=1000)
+
+
+def _analytics_version_key(station_id: Optional[str]) -> str:
+    # station_id None - аналитика по всем станциям
+    return "pricing_stats_ver:" + ("" if station_id is None else str(station_id))
+
+
+def _analytics_redis_key(client: "redis_sync.Redis", key: Tuple) -> str:
+    """Ключ (station_id, date_from, date_to) в Redis; для текущего периода - с версией"""
+    name = "pricing_stats:" + ":".join("" if part is None else str(part) for part in key)
+    if key[2] < date.today():
+        return name
+    version = client.get(_analytics_version_key(key[0]))
+    return f"{name}:v{int(version or 0)}"
+
+
+def _redis_analytics_get(key: Tuple) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Аналитика из Redis и ее ключ (для записи после промаха);
+    (None, None) при недоступности Redis
+    """
+    client = _redis_cache_client()
+    if client is None:
+        return None, None
+    try:
+        redis_key = _analytics_redis_key(client, key)
+        blob = client.get(redis_key)
+    except RedisError as e:
+        _redis_cache_failed(e)
+        return None, None
+    if not blob:
+        return None, redis_key
+    try:
+        return (orjson.loads(blob) if orjson is not None else json.loads(blob)), redis_key
+    except ValueError as e:
+        logger.warning("Некорректная запись аналитики в Redis %s: %s", redis_key, e)
+        return None, redis_key
+
+
+def _redis_analytics_set(redis_key: str, analytics: Dict[str, Any]) -> None:
+    client = _redis_cache_client()
+    if client is None:
+        return
+    try:
+        client.setex(redis_key, _ANALYTICS_CACHE_TTL, _dumps_json(analytics))
+    except RedisError as e:
+        _redis_cache_failed(e)
+
+
+def _bump_analytics_versions(station_ids: Set[str]) -> None:
+    """После записи истории: аналитика текущего периода станций и по всем станциям устарела"""
+    client = _redis_cache_client()
+    if client is None:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        for station_id in {None, *station_ids}:
+            pipe.incr(_analytics_version_key(station_id))
+        pipe.execute()
+    except RedisError as e:
+        _redis_cache_failed(e)
+
+
+def invalidate_pricing_analytics(station_id: Optional[str]) -> None:
+    """Сбрасывает аналитику текущего периода станции и по всем станциям в памяти процесса"""
+    today = date.today()
+    removed = _analytics_cache.invalidate(station_id, today)
+    if station_id is not None:
+        removed += _analytics_cache.invalidate(None, today)
+    logger.debug("Кэш аналитики тарифов сброшен (станция %s, %d записей)", station_id, removed)
+
+
+# ============================================================================
+# Сброс кэша аналитики по LISTEN/NOTIFY
+# ============================================================================
+# Триггер pricing_history (миграция 009) шлет NOTIFY со station_id новых записей:
+# аналитика сбрасывается сразу после записи истории, а не по TTL.
+# TTL остается страховкой на время переподключения
+
+_HISTORY_LISTEN_ENABLED = os.getenv("PRICING_HISTORY_LISTEN_ENABLED", "true").lower() == "true"
+_HISTORY_NOTIFY_CHANNEL = "pricing_history_change"
+_HISTORY_LISTEN_RETRY = 30.0  # секунд между попытками переподключения
+_HISTORY_LISTEN_PING = 60.0  # обрыв TCP заметен только при обмене с сервером
+
+
+async def listen_pricing_history_changes() -> None:
+    """
+    Фоновая задача (lifespan): LISTEN pricing_history_change и сброс кэша аналитики.
+    LISTEN требует постоянного соединения - DATABASE_URL должен вести напрямую
+    в Postgres или в pgbouncer в режиме session.
+    """
+    if not _HISTORY_LISTEN_ENABLED:
+        return
+
+    import asyncpg
+    from app.core.config import settings
+
+    dsn = os.getenv("DATABASE_URL", settings.DATABASE_URL)
+
+    def on_notify(connection, pid, channel, payload):
+        # Только память процесса: записи в Redis устаревают по версии (_bump_analytics_versions)
+        invalidate_pricing_analytics(payload or None)
+
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn)
+            await conn.add_listener(_HISTORY_NOTIFY_CHANNEL, on_notify)
+            # Пока соединения не было, уведомления могли быть пропущены
+            _analytics_cache.clear()
+            logger.info("LISTEN %s: кэш аналитики тарифов сбрасывается по записи истории",
+                        _HISTORY_NOTIFY_CHANNEL)
+            while True:
+                await asyncio.sleep(_HISTORY_LISTEN_PING)
+                await conn.execute("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("LISTEN %s недоступен, повтор через %.0f с: %s",
+                           _HISTORY_NOTIFY_CHANNEL, _HISTORY_LISTEN_RETRY, e)
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(_HISTORY_LISTEN_RETRY)
 
 
 class PricingService:
@@ -102,7 +792,7 @@ class PricingService:
     
     def __init__(self, db: Session, cache_ttl: int = 300):
         self.db = db
-        self._cache = PricingCache(cache_ttl)
+        self._cache = _get_shared_cache(cache_ttl)
     
     def calculate_pricing(
         self, 
@@ -115,15 +805,15 @@ class PricingService:
     ) -> PricingResult:
         """
         Рассчитывает актуальные тарифы для станции
+        (кэш процесса; L2 в Redis - через calculate_pricing_async)
         """
         if not calculation_time:
             calculation_time = datetime.now(timezone.utc)
         
         # Проверяем кэш
         if not skip_cache:
-            cache_key = self._cache.make_key(
-                station_id, connector_type, power_kw, 
-                calculation_time.replace(second=0, microsecond=0), client_id
+            cache_key = self._pricing_cache_key(
+                station_id, connector_type, power_kw, calculation_time, client_id
             )
             cached = self._cache.get(cache_key)
             if cached:
@@ -139,11 +829,60 @@ class PricingService:
         if not skip_cache:
             self._cache.set(cache_key, result)
         
-        # Сохраняем историю расчета
-        self._save_pricing_history(result, station_id, calculation_time)
+        # Сохраняем историю расчета (только новых, попадания в кэш вернулись выше)
+        if _HISTORY_SAMPLE_RATE >= 1.0 or random.random() < _HISTORY_SAMPLE_RATE:
+            self._save_pricing_history(result, station_id, calculation_time)
+        
+        return result
+    
+    async def calculate_pricing_async(
+        self,
+        station_id: str,
+        connector_type: Optional[str] = None,
+        power_kw: Optional[float] = None,
+        client_id: Optional[str] = None
+    ) -> PricingResult:
+        """
+        calculate_pricing для вызова из event loop: при промахе кэша процесса
+        результат берется из L2 в Redis (запросы к Redis - в пуле потоков)
+        """
+        calculation_time = datetime.now(timezone.utc)
+        cache_key = self._pricing_cache_key(
+            station_id, connector_type, power_kw, calculation_time, client_id
+        )
+        cached = self._cache.get(cache_key)
+        if cached:
+            return cached
+        
+        # L2: результат, уже рассчитанный другим воркером
+        if _redis_cache_client() is not None:
+            cached = await asyncio.to_thread(_redis_cache_get, cache_key)
+            if cached:
+                self._cache.set(cache_key, cached)
+                return cached
         
+        result = self.calculate_pricing(
+            station_id, connector_type, power_kw, calculation_time, client_id
+        )
+        if _redis_cache_client() is not None:
+            # Запись в L2 не задерживает ответ
+            asyncio.get_running_loop().run_in_executor(None, _redis_cache_set, cache_key, result)
         return result
     
+    def _pricing_cache_key(
+        self,
+        station_id: str,
+        connector_type: Optional[str],
+        power_kw: Optional[float],
+        calculation_time: datetime,
+        client_id: Optional[str]
+    ) -> Tuple:
+        # Минута расчета целым числом: дешевле хэшируется, чем datetime
+        return self._cache.make_key(
+            station_id, connector_type, power_kw,
+            int(calculation_time.timestamp() // 60), client_id
+        )
+    
     def _calculate_pricing_internal(
         self,
         station_id: str,
@@ -154,26 +893,23 @@ class PricingService:
     ) -> PricingResult:
         """Внутренний метод расчета тарифов"""
         
-        # 1. Получаем данные станции
-        station_data = self._get_station_data(station_id)
-        if not station_data:
+        # 1. Одним запросом получаем станцию, клиентский тариф и правила планов
+        context = self._load_pricing_context(
+            station_id, connector_type, power_kw, calculation_time, client_id
+        )
+        if not context:
             raise ValueError(f"Станция {station_id} не найдена")
+        station_data = context['station']
         
-        # 2. Проверяем клиентский тариф (VIP, корпоративный)
-        if client_id:
-            client_pricing = self._get_client_pricing(client_id, station_id, calculation_time)
-            if client_pricing:
-                logger.info(f"Применяем клиентский тариф для {client_id}")
-                return client_pricing
-        
-        # 3. Проверяем индивидуальные цены станции
+        # 2. Индивидуальная цена станции перекрывает клиентский тариф и план
+        #    (клиентский тариф и правила для такой станции запрос не выбирает)
         if station_data['price_per_kwh'] and station_data['price_per_kwh'] > 0:
             logger.info(f"Используем индивидуальную цену станции: {station_data['price_per_kwh']} {station_data['currency']}/кВт⋅ч")
             return PricingResult(
-                rate_per_kwh=Decimal(str(station_data['price_per_kwh'])),
-                rate_per_minute=Decimal('0'),
-                session_fee=Decimal(str(station_data['session_fee'] or 0)),
-                parking_fee_per_minute=Decimal('0'),
+                rate_per_kwh=_to_decimal(station_data['price_per_kwh']),
+                rate_per_minute=_ZERO,
+                session_fee=_to_decimal(station_data['session_fee'] or _ZERO),
+                parking_fee_per_minute=_ZERO,
                 currency=station_data['currency'],
                 active_rule="Индивидуальный тариф станции",
                 rule_details={"type": "station_specific", "station_id": station_id},
@@ -183,185 +919,134 @@ class PricingService:
                 rule_id=None
             )
         
+        # 3. Проверяем клиентский тариф (VIP, корпоративный)
+        if client_id and context['client']:
+            client_pricing = self._get_client_pricing(client_id, context, calculation_time)
+            if client_pricing:
+                logger.info(f"Применяем клиентский тариф для {client_id}")
+                return client_pricing
+        
         # 4. Ищем применимое правило из тарифного плана
         if station_data['tariff_plan_id']:
-            rule = self._find_applicable_rule(
-                station_data['tariff_plan_id'],
-                connector_type,
-                power_kw,
-                calculation_time
-            )
+            rule = context['station_rule']
             
             if rule:
-                return self._build_pricing_from_rule(rule, calculation_time)
+                return self._build_pricing_from_rule(rule, calculation_time, context['change_points'])
         
         # 5. Возвращаем базовый тариф
         logger.warning(f"Используем базовый тариф для станции {station_id}")
         return self._get_default_pricing()
     
-    def _get_station_data(self, station_id: str) -> Optional[Dict[str, Any]]:
-        """Получает данные станции"""
-        result = self.db.execute(text("""
-            SELECT 
-                s.id,
-                s.price_per_kwh,
-                s.session_fee,
-                s.currency,
-                s.tariff_plan_id,
-                tp.name as tariff_plan_name
-            FROM stations s
-            LEFT JOIN tariff_plans tp ON s.tariff_plan_id = tp.id
-            WHERE s.id = :station_id
-        """), {"station_id": station_id}).fetchone()
+    def _load_pricing_context(
+        self,
+        station_id: str,
+        connector_type: Optional[str],
+        power_kw: Optional[float],
+        calculation_time: datetime,
+        client_id: Optional[str]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Загружает все данные для расчета тарифа за один запрос к БД:
+        станцию, клиентский тариф, применимое сейчас правило клиентского плана
+        и плана станции (с наивысшим приоритетом) и точки смены тарифа
+        """
+        weekday = calculation_time.isoweekday()  # 1=Пн, 7=Вс
+        
+        result = self.db.execute(_PRICING_CONTEXT_STMT, {
+            "station_id": station_id,
+            "client_id": client_id,
+            "now": calculation_time,
+            "connector_type": connector_type,
+            "current_date": calculation_time.date(),
+            "current_time": calculation_time.time(),
+            "power_kw": power_kw or 0,
+            "weekday_bit": 1 << (weekday - 1),
+            "is_weekend": weekday >= 6
+        }).fetchone()
         
         if not result:
             return None
         
+        # Индексы: 0-5 станция, 6-9 клиентский тариф (NULL если нет),
+        #          10 правило клиентского плана, 11 правило плана станции, 12 точки смены тарифа
         return {
-            'id': result[0],
-            'price_per_kwh': result[1],
-            'session_fee': result[2],
-            'currency': result[3] or 'KGS',
-            'tariff_plan_id': result[4],
-            'tariff_plan_name': result[5]
+            'station': {
+                'id': result[0],
+                'price_per_kwh': result[1],
+                'session_fee': result[2],
+                'currency': result[3] or 'KGS',
+                'tariff_plan_id': result[4],
+                'tariff_plan_name': result[5]
+            },
+            'client': {
+                'tariff_plan_id': result[6],
+                'discount_percent': result[7],
+                'fixed_rate_per_kwh': result[8],
+                'tariff_plan_name': result[9]
+            } if (result[6] or result[8]) else None,
+            'client_rule': self._rule_from_json(result[10]),
+            'station_rule': self._rule_from_json(result[11]),
+            'change_points': [
+                {**point, 'time_start': _parse_time(point['time_start'])}
+                for point in _json_list(result[12])
+            ]
         }
     
+    @staticmethod
+    def _rule_from_json(data: Any) -> Optional[Dict[str, Any]]:
+        """Правило из json_build_object: время приводится к time, валюта по умолчанию KGS"""
+        if not data:
+            return None
+        rule = dict(json.loads(data) if isinstance(data, str) else data)
+        rule['currency'] = rule.get('currency') or 'KGS'
+        rule['time_start'] = _parse_time(rule.get('time_start'))
+        rule['time_end'] = _parse_time(rule.get('time_end'))
+        return rule
+    
     def _get_client_pricing(
         self, 
         client_id: str, 
-        station_id: str,
+        context: Dict[str, Any],
         calculation_time: datetime
     ) -> Optional[PricingResult]:
         """Получает специальный тариф для клиента"""
-        result = self.db.execute(text("""
-            SELECT 
-                ct.tariff_plan_id,
-                ct.discount_percent,
-                ct.fixed_rate_per_kwh,
-                tp.name
-            FROM client_tariffs ct
-            LEFT JOIN tariff_plans tp ON ct.tariff_plan_id = tp.id
-            WHERE ct.client_id = :client_id
-                AND ct.is_active = true
-                AND ct.valid_from <= :now
-                AND (ct.valid_until IS NULL OR ct.valid_until > :now)
-            ORDER BY ct.created_at DESC
-            LIMIT 1
-        """), {
-            "client_id": client_id,
-            "now": calculation_time
-        }).fetchone()
-        
-        if not result:
-            return None
+        client = context['client']
         
         # Если есть фиксированная цена
-        if result[2]:
+        if client['fixed_rate_per_kwh']:
             return PricingResult(
-                rate_per_kwh=Decimal(str(result[2])),
-                rate_per_minute=Decimal('0'),
-                session_fee=Decimal('0'),
-                parking_fee_per_minute=Decimal('0'),
+                rate_per_kwh=_to_decimal(client['fixed_rate_per_kwh']),
+                rate_per_minute=_ZERO,
+                session_fee=_ZERO,
+                parking_fee_per_minute=_ZERO,
                 currency='KGS',
                 active_rule=f"Специальный тариф клиента",
                 rule_details={"type": "client_fixed", "client_id": client_id},
                 time_based=False,
                 next_rate_change=None,
-                tariff_plan_id=result[0],
+                tariff_plan_id=client['tariff_plan_id'],
                 rule_id=None
             )
         
         # Если есть тарифный план со скидкой
-        if result[0]:
-            rule = self._find_applicable_rule(
-                result[0], None, None, calculation_time
-            )
+        if client['tariff_plan_id']:
+            rule = context['client_rule']
             if rule:
-                pricing = self._build_pricing_from_rule(rule, calculation_time)
+                pricing = self._build_pricing_from_rule(rule, calculation_time, context['change_points'])
                 # Применяем скидку
-                if result[1]:
-                    discount_multiplier = Decimal('1') - (Decimal(str(result[1])) / Decimal('100'))
-                    pricing.rate_per_kwh *= discount_multiplier
-                    pricing.rate_per_minute *= discount_multiplier
-                    pricing.active_rule = f"{pricing.active_rule} (скидка {result[1]}%)"
+                discount = client['discount_percent']
+                if discount:
+                    discount_multiplier = _ONE - (_to_decimal(discount) / _HUNDRED)
+                    pricing = replace(
+                        pricing,
+                        rate_per_kwh=pricing.rate_per_kwh * discount_multiplier,
+                        rate_per_minute=pricing.rate_per_minute * discount_multiplier,
+                        active_rule=f"{pricing.active_rule} (скидка {discount}%)"
+                    )
                 return pricing
         
         return None
     
-    def _find_applicable_rule(
-        self,
-        tariff_plan_id: str,
-        connector_type: Optional[str],
-        power_kw: Optional[float],
-        calculation_time: datetime
-    ) -> Optional[Dict[str, Any]]:
-        """Находит применимое правило тарификации"""
-        
-        current_date = calculation_time.date()
-        current_time = calculation_time.time()
-        weekday = calculation_time.isoweekday()  # 1=Пн, 7=Вс
-        is_weekend = weekday >= 6
-        
-        query = text("""
-            SELECT 
-                id, name, tariff_type, connector_type,
-                power_range_min, power_range_max, price, currency,
-                time_start, time_end, is_weekend, priority,
-                min_duration_minutes, max_duration_minutes,
-                valid_from, valid_until, days_of_week
-            FROM tariff_rules
-            WHERE tariff_plan_id = :tariff_plan_id
-                AND is_active = true
-                AND (valid_from IS NULL OR valid_from <= :current_date)
-                AND (valid_until IS NULL OR valid_until >= :current_date)
-                AND (connector_type = 'ALL' OR connector_type = :connector_type OR :connector_type IS NULL)
-                AND (power_range_min IS NULL OR power_range_min <= :power_kw OR :power_kw IS NULL)
-                AND (power_range_max IS NULL OR power_range_max >= :power_kw OR :power_kw IS NULL)
-                AND (
-                    days_of_week IS NULL 
-                    OR :weekday = ANY(days_of_week)
-                    OR (is_weekend = :is_weekend AND is_weekend IS NOT NULL)
-                )
-            ORDER BY priority DESC, created_at DESC
-        """)
-        
-        results = self.db.execute(query, {
-            "tariff_plan_id": tariff_plan_id,
-            "current_date": current_date,
-            "connector_type": connector_type,
-            "power_kw": power_kw or 0,
-            "weekday": weekday,
-            "is_weekend": is_weekend
-        }).fetchall()
-        
-        # Фильтруем по времени
-        for row in results:
-            time_start = row[8]
-            time_end = row[9]
-            
-            if self._is_time_in_range(current_time, time_start, time_end):
-                return {
-                    'id': row[0],
-                    'name': row[1],
-                    'tariff_type': row[2],
-                    'connector_type': row[3],
-                    'power_range_min': row[4],
-                    'power_range_max': row[5],
-                    'price': row[6],
-                    'currency': row[7] or 'KGS',
-                    'time_start': time_start,
-                    'time_end': time_end,
-                    'is_weekend': row[10],
-                    'priority': row[11],
-                    'min_duration': row[12],
-                    'max_duration': row[13],
-                    'valid_from': row[14],
-                    'valid_until': row[15],
-                    'days_of_week': row[16]
-                }
-        
-        return None
-    
     def _is_time_in_range(
         self, 
         current: time, 
@@ -382,47 +1067,43 @@ class PricingService:
     def _build_pricing_from_rule(
         self, 
         rule: Dict[str, Any], 
-        calculation_time: datetime
+        calculation_time: datetime,
+        change_points: Optional[List[Dict[str, Any]]] = None
     ) -> PricingResult:
         """Строит результат из правила"""
         
         # Определяем когда будет следующее изменение тарифа
         next_change = self._calculate_next_rate_change(
-            rule, calculation_time, rule.get('tariff_plan_id')
+            rule, calculation_time, rule.get('tariff_plan_id'), change_points or []
         )
         
         # Формируем описание правила
         rule_description = self._format_rule_description(rule)
         
-        # Распределяем цены по типам
-        pricing = PricingResult(
-            rate_per_kwh=Decimal('0'),
-            rate_per_minute=Decimal('0'),
-            session_fee=Decimal('0'),
-            parking_fee_per_minute=Decimal('0'),
+        # Цена идет в поле своего типа, остальные - нули
+        price = _to_decimal(rule['price'])
+        tariff_type = rule['tariff_type']
+        
+        return PricingResult(
+            rate_per_kwh=price if tariff_type == TariffType.PER_KWH else _ZERO,
+            rate_per_minute=price if tariff_type == TariffType.PER_MINUTE else _ZERO,
+            session_fee=price if tariff_type == TariffType.SESSION_FEE else _ZERO,
+            parking_fee_per_minute=price if tariff_type == TariffType.PARKING_FEE else _ZERO,
             currency=rule['currency'],
             active_rule=rule_description,
-            rule_details=rule,
+            # Только идентификация правила: полное правило (с time/date) не копируется
+            # в кэш и не сериализуется в историю на каждый расчет
+            rule_details={
+                'type': 'tariff_rule',
+                'rule_id': rule['id'],
+                'name': rule.get('name'),
+                'tariff_type': rule['tariff_type']
+            },
             time_based=bool(rule.get('time_start') and rule.get('time_end')),
             next_rate_change=next_change,
             tariff_plan_id=rule.get('tariff_plan_id'),
             rule_id=rule['id']
         )
-        
-        # Устанавливаем цену в зависимости от типа
-        price = Decimal(str(rule['price']))
-        tariff_type = rule['tariff_type']
-        
-        if tariff_type == TariffType.PER_KWH:
-            pricing.rate_per_kwh = price
-        elif tariff_type == TariffType.PER_MINUTE:
-            pricing.rate_per_minute = price
-        elif tariff_type == TariffType.SESSION_FEE:
-            pricing.session_fee = price
-        elif tariff_type == TariffType.PARKING_FEE:
-            pricing.parking_fee_per_minute = price
-        
-        return pricing
     
     def _format_rule_description(self, rule: Dict[str, Any]) -> str:
         """Форматирует описание правила"""
@@ -435,20 +1116,13 @@ class PricingService:
             parts.append(f"{rule['time_start'].strftime('%H:%M')}-{rule['time_end'].strftime('%H:%M')}")
         
         if rule.get('days_of_week'):
-            days = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-            selected_days = [days[d-1] for d in sorted(rule['days_of_week'])]
+            selected_days = [_DAY_NAMES[d-1] for d in sorted(rule['days_of_week'])]
             parts.append(f"({','.join(selected_days)})")
         elif rule.get('is_weekend'):
             parts.append("Выходные")
         
         if not parts:
-            tariff_names = {
-                TariffType.PER_KWH: 'Тариф за энергию',
-                TariffType.PER_MINUTE: 'Поминутный тариф',
-                TariffType.SESSION_FEE: 'Фиксированная плата',
-                TariffType.PARKING_FEE: 'Плата за парковку'
-            }
-            parts.append(tariff_names.get(rule['tariff_type'], 'Специальный тариф'))
+            parts.append(_TARIFF_NAMES.get(rule['tariff_type'], 'Специальный тариф'))
         
         return ' - '.join(parts)
     
@@ -456,26 +1130,20 @@ class PricingService:
         self,
         current_rule: Dict[str, Any],
         calculation_time: datetime,
-        tariff_plan_id: Optional[str]
+        tariff_plan_id: Optional[str],
+        change_points: List[Dict[str, Any]]
     ) -> Optional[datetime]:
         """Рассчитывает время следующего изменения тарифа"""
         
         if not tariff_plan_id or not current_rule.get('time_end'):
             return None
         
-        # Получаем все правила для этого плана
-        next_rules = self.db.execute(text("""
-            SELECT time_start, days_of_week, is_weekend
-            FROM tariff_rules
-            WHERE tariff_plan_id = :plan_id
-                AND is_active = true
-                AND id != :current_id
-                AND time_start IS NOT NULL
-            ORDER BY time_start
-        """), {
-            "plan_id": tariff_plan_id,
-            "current_id": current_rule['id']
-        }).fetchall()
+        # Остальные правила этого плана (загружены вместе с контекстом тарифа)
+        next_rules = [
+            (point['time_start'], point['days_mask'], point['is_weekend'])
+            for point in change_points
+            if point['tariff_plan_id'] == tariff_plan_id and point['id'] != current_rule['id']
+        ]
         
         # Находим ближайшее изменение
         current_time = calculation_time.time()
@@ -508,10 +1176,10 @@ class PricingService:
                 )
         
         # Проверяем начало других правил
-        for rule_start, days_of_week, is_weekend in next_rules:
+        for rule_start, days_mask, is_weekend in next_rules:
             if rule_start > current_time:
                 # Может быть сегодня
-                if self._is_rule_applicable_on_day(current_weekday, days_of_week, is_weekend):
+                if self._is_rule_applicable_on_day(current_weekday, days_mask, is_weekend):
                     candidates.append(
                         calculation_time.replace(
                             hour=rule_start.hour,
@@ -529,12 +1197,12 @@ class PricingService:
     def _is_rule_applicable_on_day(
         self,
         weekday: int,
-        days_of_week: Optional[List[int]],
+        days_mask: Optional[int],
         is_weekend: Optional[bool]
     ) -> bool:
-        """Проверяет применимость правила в конкретный день"""
-        if days_of_week:
-            return weekday in days_of_week
+        """Проверяет применимость правила в конкретный день (days_mask: Пн = бит 0)"""
+        if days_mask:
+            return (days_mask & (1 << (weekday - 1))) != 0
         if is_weekend is not None:
             return (weekday >= 6) == is_weekend
         return True
@@ -542,10 +1210,10 @@ class PricingService:
     def _get_default_pricing(self) -> PricingResult:
         """Возвращает базовый тариф"""
         return PricingResult(
-            rate_per_kwh=Decimal('13.5'),
-            rate_per_minute=Decimal('0'),
-            session_fee=Decimal('0'),
-            parking_fee_per_minute=Decimal('0'),
+            rate_per_kwh=_DEFAULT_RATE_PER_KWH,
+            rate_per_minute=_ZERO,
+            session_fee=_ZERO,
+            parking_fee_per_minute=_ZERO,
             currency='KGS',
             active_rule='Базовый тариф',
             rule_details={'type': 'default'},
@@ -561,21 +1229,10 @@ class PricingService:
         station_id: str,
         calculation_time: datetime
     ) -> None:
-        """Сохраняет историю расчета тарифа"""
+        """Ставит запись истории расчета тарифа в очередь фоновой записи"""
+        _ensure_history_writer()
         try:
-            self.db.execute(text("""
-                INSERT INTO pricing_history (
-                    station_id, tariff_plan_id, rule_id,
-                    calculation_time, rate_per_kwh, rate_per_minute,
-                    session_fee, parking_fee_per_minute, currency,
-                    rule_name, rule_details
-                ) VALUES (
-                    :station_id, :tariff_plan_id, :rule_id,
-                    :calculation_time, :rate_per_kwh, :rate_per_minute,
-                    :session_fee, :parking_fee, :currency,
-                    :rule_name, :rule_details
-                )
-            """), {
+            _history_queue.put_nowait({
                 "station_id": station_id,
                 "tariff_plan_id": pricing.tariff_plan_id,
                 "rule_id": pricing.rule_id,
@@ -586,14 +1243,14 @@ class PricingService:
                 "parking_fee": pricing.parking_fee_per_minute,
                 "currency": pricing.currency,
                 "rule_name": pricing.active_rule,
-                "rule_details": json.dumps(pricing.rule_details)
+                "rule_details": pricing.rule_details
             })
-        except Exception as e:
-            logger.warning(f"Не удалось сохранить историю тарифа: {e}")
+        except queue.Full:
+            logger.warning(f"Очередь истории тарифов переполнена, запись для станции {station_id} пропущена")
     
     def calculate_session_cost(
         self,
-        energy_kwh: float,
+        energy_kwh: Union[float, Decimal],
         duration_minutes: int,
         pricing: PricingResult,
         promo_code: Optional[str] = None,
@@ -602,21 +1259,23 @@ class PricingService:
         """Рассчитывает полную стоимость сессии"""
         
         breakdown = {}
+        energy_cost = time_cost = session_fee = _ZERO
         
         # Базовые расчеты
-        if pricing.rate_per_kwh > 0:
-            breakdown['energy_cost'] = Decimal(str(energy_kwh)) * pricing.rate_per_kwh
-        
-        if pricing.rate_per_minute > 0:
-            breakdown['time_cost'] = Decimal(str(duration_minutes)) * pricing.rate_per_minute
-        
-        if pricing.session_fee > 0:
-            breakdown['session_fee'] = pricing.session_fee
-        
-        base_amount = sum(breakdown.values())
+        with localcontext(_MONEY_CONTEXT):
+            if pricing.rate_per_kwh > 0:
+                energy_cost = breakdown['energy_cost'] = _to_decimal(energy_kwh) * pricing.rate_per_kwh
+            
+            if pricing.rate_per_minute > 0:
+                time_cost = breakdown['time_cost'] = Decimal(duration_minutes) * pricing.rate_per_minute
+            
+            if pricing.session_fee > 0:
+                session_fee = breakdown['session_fee'] = pricing.session_fee
+            
+            base_amount = energy_cost + time_cost + session_fee
         
         # Применяем промо-код
-        discount_amount = Decimal('0')
+        discount_amount = _ZERO
         promo_applied = None
         
         if promo_code:
@@ -627,7 +1286,8 @@ class PricingService:
                 discount_amount = discount['amount']
                 promo_applied = discount['code']
         
-        final_amount = base_amount - discount_amount
+        with localcontext(_MONEY_CONTEXT):
+            final_amount = base_amount - discount_amount
         
         return SessionCost(
             total=final_amount,
@@ -638,6 +1298,25 @@ class PricingService:
             promo_code_applied=promo_applied
         )
     
+    def calculate_session_costs_batch(
+        self,
+        energies_kwh: List[Union[float, Decimal]],
+        durations_minutes: List[int],
+        pricings: List[PricingResult]
+    ) -> List[Decimal]:
+        """
+        Базовая стоимость (без промо-кодов) пачки сессий - для биллинга и отчетов.
+        Та же арифметика, что в calculate_session_cost, без построения SessionCost
+        """
+        with localcontext(_MONEY_CONTEXT):
+            return [
+                _to_decimal(energy_kwh) * pricing.rate_per_kwh
+                + Decimal(duration_minutes) * pricing.rate_per_minute
+                + pricing.session_fee
+                for energy_kwh, duration_minutes, pricing
+                in zip(energies_kwh, durations_minutes, pricings, strict=True)
+            ]
+    
     def _apply_promo_code(
         self,
         code: str,
@@ -646,18 +1325,11 @@ class PricingService:
     ) -> Optional[Dict[str, Any]]:
         """Применяет промо-код"""
         
-        # Получаем информацию о промо-коде
-        promo = self.db.execute(text("""
-            SELECT 
-                id, discount_type, discount_value,
-                max_discount_amount, min_charge_amount,
-                usage_limit, usage_count, client_usage_limit
-            FROM promo_codes
-            WHERE code = :code
-                AND is_active = true
-                AND valid_from <= NOW()
-                AND valid_until >= NOW()
-        """), {"code": code}).fetchone()
+        # Промо-код вместе с использованиями клиентом - один запрос
+        promo = self.db.execute(_PROMO_STMT, {
+            "code": code,
+            "client_id": client_id
+        }).fetchone()
         
         if not promo:
             return None
@@ -665,7 +1337,7 @@ class PricingService:
         promo_id = promo[0]
         
         # Проверяем минимальную сумму
-        if promo[4] and amount < Decimal(str(promo[4])):
+        if promo[4] and amount < _to_decimal(promo[4]):
             return None
         
         # Проверяем общий лимит использований
@@ -673,27 +1345,16 @@ class PricingService:
             return None
         
         # Проверяем лимит для клиента
-        if client_id and promo[7]:
-            client_usage = self.db.execute(text("""
-                SELECT COUNT(*)
-                FROM promo_code_usage
-                WHERE promo_code_id = :promo_id
-                    AND client_id = :client_id
-            """), {
-                "promo_id": promo_id,
-                "client_id": client_id
-            }).scalar()
-            
-            if client_usage >= promo[7]:
-                return None
+        if client_id and promo[7] and promo[8] >= promo[7]:
+            return None
         
         # Рассчитываем скидку
         if promo[1] == DiscountType.PERCENT:
-            discount = amount * (Decimal(str(promo[2])) / Decimal('100'))
+            discount = amount * (_to_decimal(promo[2]) / _HUNDRED)
             if promo[3]:  # max_discount_amount
-                discount = min(discount, Decimal(str(promo[3])))
+                discount = min(discount, _to_decimal(promo[3]))
         else:  # FIXED
-            discount = min(Decimal(str(promo[2])), amount)
+            discount = min(_to_decimal(promo[2]), amount)
         
         return {
             'id': promo_id,
@@ -747,7 +1408,7 @@ class PricingService:
         # Получаем существующие правила
         existing = self.db.execute(text("""
             SELECT name, connector_type, time_start, time_end, 
-                   days_of_week, is_weekend, priority
+                   days_mask, is_weekend, priority
             FROM tariff_rules
             WHERE tariff_plan_id = :plan_id
                 AND is_active = true
@@ -757,108 +1418,71 @@ class PricingService:
             "rule_id": rule_data.get('id')
         }).fetchall()
         
+        # Новое правило кодируется один раз: окно - секунды суток, дни - битовая маска
+        priority = rule_data.get('priority')
+        connector = rule_data.get('connector_type')
+        window = _time_window(
+            _parse_time(rule_data.get('time_start')),
+            _parse_time(rule_data.get('time_end'))
+        )
+        days = _days_mask(rule_data.get('days_of_week'))
+        
         for rule in existing:
-            # Проверяем пересечение по приоритету
-            if rule[6] == rule_data.get('priority'):
-                # Проверяем пересечение по другим параметрам
-                if self._rules_overlap(rule, rule_data):
-                    conflicts.append(rule[0])
+            # Конфликт возможен только при равном приоритете
+            if rule[6] != priority:
+                continue
+            # Тип коннектора
+            if rule[1] != 'ALL' and connector != 'ALL' and rule[1] != connector:
+                continue
+            # Дни недели
+            if not (rule[4] or _ALL_DAYS_MASK) & days:
+                continue
+            # Время
+            if _windows_overlap(_time_window(rule[2], rule[3]), window):
+                conflicts.append(rule[0])
         
         return conflicts
     
-    def _rules_overlap(
-        self,
-        rule1: tuple,
-        rule2: Dict[str, Any]
-    ) -> bool:
-        """Проверяет пересечение двух правил"""
-        
-        # Проверяем тип коннектора
-        if rule1[1] != 'ALL' and rule2.get('connector_type') != 'ALL':
-            if rule1[1] != rule2.get('connector_type'):
-                return False
-        
-        # Проверяем время
-        if rule1[2] and rule1[3] and rule2.get('time_start') and rule2.get('time_end'):
-            # Проверяем пересечение временных диапазонов
-            if not self._time_ranges_overlap(
-                rule1[2], rule1[3],
-                rule2['time_start'], rule2['time_end']
-            ):
-                return False
-        
-        # Проверяем дни недели
-        if rule1[4] and rule2.get('days_of_week'):
-            if not set(rule1[4]) & set(rule2['days_of_week']):
-                return False
-        
-        return True
-    
-    def _time_ranges_overlap(
-        self,
-        start1: time, end1: time,
-        start2: time, end2: time
-    ) -> bool:
-        """Проверяет пересечение временных диапазонов"""
-        
-        # Обычные диапазоны
-        if start1 < end1 and start2 < end2:
-            return not (end1 <= start2 or end2 <= start1)
-        
-        # Один или оба диапазона через полночь
-        return True  # Упрощенно считаем что пересекаются
-    
     def get_pricing_analytics(
         self,
         station_id: Optional[str] = None,
         date_from: Optional[date] = None,
         date_to: Optional[date] = None
     ) -> Dict[str, Any]:
-        """Получает аналитику по применению тарифов"""
+        """
+        Получает аналитику по применению тарифов
+        (кэшируется на PRICING_ANALYTICS_CACHE_TTL секунд, результат не изменять)
+        """
         
         if not date_from:
             date_from = date.today() - timedelta(days=30)
         if not date_to:
             date_to = date.today()
         
-        # Получаем статистику из истории
-        query = text("""
-            SELECT 
-                COUNT(*) as total_calculations,
-                COUNT(DISTINCT station_id) as unique_stations,
-                COUNT(DISTINCT rule_id) as unique_rules,
-                AVG(rate_per_kwh) as avg_rate_per_kwh,
-                MIN(rate_per_kwh) as min_rate_per_kwh,
-                MAX(rate_per_kwh) as max_rate_per_kwh
-            FROM pricing_history
-            WHERE calculation_time BETWEEN :date_from AND :date_to
-                AND (:station_id IS NULL OR station_id = :station_id)
-        """)
-        
-        stats = self.db.execute(query, {
+        cache_key = (station_id, date_from, date_to)
+        analytics = _analytics_cache.get(cache_key)
+        if analytics is None:
+            analytics, redis_key = _redis_analytics_get(cache_key)
+            if analytics is None:
+                analytics = self._query_pricing_analytics(station_id, date_from, date_to)
+                if redis_key is not None:
+                    _redis_analytics_set(redis_key, analytics)
+            _analytics_cache.set(cache_key, analytics)
+        return analytics
+    
+    def _query_pricing_analytics(
+        self,
+        station_id: Optional[str],
+        date_from: date,
+        date_to: date
+    ) -> Dict[str, Any]:
+        # Статистика и топ правил за один проход по истории
+        stats = self.db.execute(_PRICING_ANALYTICS_STMT, {
             "date_from": date_from,
             "date_to": date_to,
             "station_id": station_id
         }).fetchone()
         
-        # Получаем топ правил
-        top_rules = self.db.execute(text("""
-            SELECT 
-                rule_name,
-                COUNT(*) as usage_count,
-                AVG(rate_per_kwh) as avg_rate
-            FROM pricing_history
-            WHERE calculation_time BETWEEN :date_from AND :date_to
-                AND (:station_id IS NULL OR station_id = :station_id)
-            GROUP BY rule_name
-            ORDER BY usage_count DESC
-            LIMIT 10
-        """), {
-            "date_from": date_from,
-            "date_to": date_to,
-            "station_id": station_id
-        }).fetchall()
-        
         return {
             'period': {
                 'from': date_from.isoformat(),
@@ -874,15 +1498,24 @@ class PricingService:
             },
             'top_rules': [
                 {
-                    'name': rule[0],
-                    'usage_count': rule[1],
-                    'avg_rate': float(rule[2] or 0)
+                    'name': rule['name'],
+                    'usage_count': rule['usage_count'],
+                    'avg_rate': float(rule['avg_rate'] or 0)
                 }
-                for rule in top_rules
+                for rule in _json_list(stats[6])
             ]
         }
     
     def clear_cache(self) -> None:
-        """Очищает кэш тарифов"""
+        """Очищает кэш тарифов (процесса и L2 в Redis) и аналитики"""
         self._cache.clear()
-        logger.info("Кэш тарифов очищен")
\ No newline at end of file
+        _redis_cache_delete(None)
+        _analytics_cache.clear()
+        logger.info("Кэш тарифов очищен")
+    
+    def invalidate_station(self, station_id: str) -> None:
+        """Сбрасывает кэшированные тарифы станции (после изменения цены или тарифного плана)"""
+        removed = self._cache.invalidate(station_id)
+        # Иначе следующий промах кэша процесса вернул бы устаревший тариф из L2
+        _redis_cache_delete(station_id)
+        logger.info(f"Кэш тарифов станции {station_id} сброшен ({removed} записей)")
\ No newline at end of file
@@ -1,18 +1,114 @@
 """
 Сервис для отправки Web Push Notifications
 """
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
+from urllib.parse import urlparse
+import asyncio
 import json
 import logging
+import os
+import time
+import httpx
 from sqlalchemy.orm import Session
 from sqlalchemy import text
-from pywebpush import webpush, WebPushException
+from py_vapid import Vapid
+from pywebpush import WebPusher, WebPushException
+try:
+    # HTTP/2 в httpx требует пакет h2 (httpx[http2])
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    _HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from app.core.config import settings
+from app.core.security_middleware import CircuitBreaker, CircuitOpenError
 from app.db.session import get_db
 
 logger = logging.getLogger(__name__)
 
+# JWT VAPID действует 12 часов; перевыпускается за 5 минут до истечения
+_VAPID_JWT_LIFETIME = 12 * 60 * 60
+_VAPID_JWT_REFRESH_MARGIN = 5 * 60
+
+# Circuit breaker на push-сервис (origin): после серии отказов отправки в него
+# пропускаются без шифрования, подписи и соединения
+_BREAKER_FAILURES = 5
+_BREAKER_OPEN_SECONDS = 30
+
+
+class PushServiceUnavailable(WebPushException):
+    """Push-сервис перегружен или недоступен (429, 5xx) - отказ сервиса, а не подписки"""
+
+
+# Статическая часть уведомлений (title, icon, actions) по типу события;
+# body и data собираются при отправке. Шаблоны не изменять - общие для всех вызовов
+_CLIENT_NOTIFICATION_TEMPLATES: Dict[str, Dict[str, Any]] = {
+    "charging_started": {
+        "title": "Зарядка началась",
+        "icon": "/icons/charging-start.png",
+        "actions": [
+            {"action": "view", "title": "Открыть"}
+        ]
+    },
+    "charging_completed": {
+        "title": "Зарядка завершена",
+        "icon": "/icons/charging-complete.png",
+        "actions": [
+            {"action": "view_history", "title": "Посмотреть"}
+        ]
+    },
+    "charging_error": {
+        "title": "Ошибка зарядки",
+        "icon": "/icons/charging-error.png",
+        "require_interaction": True
+    },
+    "low_balance_warning": {
+        "title": "⚠️ Низкий баланс",
+        "icon": "/icons/low-balance.png",
+        "actions": [
+            {"action": "topup", "title": "Пополнить"}
+        ],
+        "require_interaction": True  # Важное уведомление
+    },
+    "payment_confirmed": {
+        "title": "Баланс пополнен",
+        "icon": "/icons/payment-success.png"
+    }
+}
+
+_OWNER_NOTIFICATION_TEMPLATES: Dict[str, Dict[str, Any]] = {
+    "new_session": {
+        "title": "Новая зарядка",
+        "icon": "/icons/session-new.png",
+        "actions": [
+            {"action": "view_station", "title": "Открыть станцию"}
+        ]
+    },
+    "session_completed": {
+        "title": "Зарядка завершена",
+        "icon": "/icons/session-complete.png"
+    },
+    "station_offline": {
+        "title": "Станция оффлайн",
+        "icon": "/icons/station-offline.png",
+        "actions": [
+            {"action": "view_station", "title": "Проверить"}
+        ],
+        "require_interaction": True
+    }
+}
+
+
+def _audience(endpoint: str) -> str:
+    """aud для VAPID - origin push-сервиса (scheme://host)"""
+    url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
 
 class PushNotificationService:
     """
@@ -29,6 +125,114 @@ class PushNotificationService:
         }
         self.ttl = settings.PUSH_TTL
         self.max_retries = settings.PUSH_MAX_RETRIES
+        self._vapid: Optional[Vapid] = None
+        # aud -> (заголовки VAPID, exp): подпись ES256 - не на каждую отправку
+        self._jwt_cache: Dict[str, Tuple[Dict[str, str], float]] = {}
+        # Общий HTTP/2 клиент: отправки одному push-сервису (FCM, Mozilla, Apple)
+        # мультиплексируются в одном соединении
+        self._client: Optional[httpx.AsyncClient] = None
+        # aud -> circuit breaker push-сервиса
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Общий HTTP клиент, создается при первой отправке"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=10.0,
+                http2=_HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        """Закрывает общий HTTP клиент (остановка приложения)"""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    def _get_vapid(self) -> Vapid:
+        """VAPID ключ (из строки или PEM файла, как в pywebpush)"""
+        if self._vapid is None:
+            if os.path.isfile(self.vapid_private_key):
+                self._vapid = Vapid.from_file(private_key_file=self.vapid_private_key)
+            else:
+                self._vapid = Vapid.from_string(private_key=self.vapid_private_key)
+        return self._vapid
+
+    def _vapid_headers(self, aud: str) -> Dict[str, str]:
+        """Authorization заголовок VAPID для push-сервиса aud (кэшируется до истечения)"""
+        now = time.time()
+        cached = self._jwt_cache.get(aud)
+        if cached and now < cached[1] - _VAPID_JWT_REFRESH_MARGIN:
+            return cached[0]
+
+        exp = int(now) + _VAPID_JWT_LIFETIME
+        headers = self._get_vapid().sign({**self.vapid_claims, "aud": aud, "exp": exp})
+        self._jwt_cache[aud] = (headers, exp)
+        return headers
+
+    def _get_breaker(self, aud: str) -> CircuitBreaker:
+        """Circuit breaker push-сервиса aud (404/410 подписки его не размыкают)"""
+        breaker = self._breakers.get(aud)
+        if breaker is None:
+            breaker = self._breakers[aud] = CircuitBreaker(
+                failure_threshold=_BREAKER_FAILURES,
+                timeout=_BREAKER_OPEN_SECONDS,
+                expected_exceptions=(PushServiceUnavailable, httpx.TransportError)
+            )
+        return breaker
+
+    async def _encrypt(self, sub: Any, payload: bytes) -> bytes:
+        """Шифрует payload ключами подписки (aes128gcm)"""
+        subscription_info = {
+            "endpoint": sub.endpoint,
+            "keys": {
+                "p256dh": sub.p256dh_key,
+                "auth": sub.auth_key
+            }
+        }
+        # ECDH + AES-GCM - синхронная CPU работа, в пуле потоков не блокирует event loop
+        encoded = await asyncio.to_thread(
+            WebPusher(subscription_info).encode, payload, "aes128gcm"
+        )
+        return encoded["body"]
+
+    async def _send_one(
+        self,
+        client: httpx.AsyncClient,
+        sub: Any,
+        aud: str,
+        payload: bytes,
+        bodies: Dict[Tuple[str, str], "asyncio.Task[bytes]"]
+    ) -> None:
+        """Шифрует payload ключами подписки и отправляет в push-сервис aud"""
+        # Шифрование - одно на ключи (p256dh, auth): повторные подписки
+        # того же браузера получают тот же шифротекст
+        keys = (sub.p256dh_key, sub.auth_key)
+        body = bodies.get(keys)
+        if body is None:
+            body = bodies[keys] = asyncio.create_task(self._encrypt(sub, payload))
+
+        response = await client.post(
+            sub.endpoint,
+            content=await body,
+            headers={
+                # JWT VAPID подписывается один раз на push-сервис, а не на подписку
+                **self._vapid_headers(aud),
+                "Content-Encoding": "aes128gcm",
+                "TTL": str(self.ttl)
+            }
+        )
+        if response.status_code == 429 or response.status_code >= 500:
+            raise PushServiceUnavailable(
+                f"Push service unavailable: {response.status_code} {response.reason_phrase}",
+                response=response
+            )
+        if response.status_code > 202:
+            raise WebPushException(
+                f"Push failed: {response.status_code} {response.reason_phrase}",
+                response=response
+            )
 
     async def send_notification(
         self,
@@ -123,52 +327,61 @@ class PushNotificationService:
 
             sent_count = 0
             failed_count = 0
+            successful_subscriptions = []
             invalid_subscriptions = []
 
-            # Отправить на все subscriptions
-            for sub in subscriptions:
-                try:
-                    subscription_info = {
-                        "endpoint": sub.endpoint,
-                        "keys": {
-                            "p256dh": sub.p256dh_key,
-                            "auth": sub.auth_key
-                        }
-                    }
-
-                    # Отправить через pywebpush
-                    webpush(
-                        subscription_info=subscription_info,
-                        data=json.dumps(notification_payload),
-                        vapid_private_key=self.vapid_private_key,
-                        vapid_claims=self.vapid_claims,
-                        ttl=self.ttl
+            # payload сериализуется один раз на все подписки
+            if orjson is not None:
+                payload = orjson.dumps(notification_payload)
+            else:
+                payload = json.dumps(notification_payload).encode()
+
+            # Отправить на все subscriptions параллельно (один RTT вместо N);
+            # в push-сервис с разомкнутым breaker - без шифрования и запроса
+            client = self._get_client()
+            audiences = [_audience(sub.endpoint) for sub in subscriptions]
+            bodies: Dict[Tuple[str, str], asyncio.Task] = {}
+            results = await asyncio.gather(
+                *[
+                    self._get_breaker(aud).call_async(
+                        self._send_one, client, sub, aud, payload, bodies
                     )
+                    for sub, aud in zip(subscriptions, audiences)
+                ],
+                return_exceptions=True
+            )
 
+            for sub, result in zip(subscriptions, results):
+                if result is None:
                     sent_count += 1
-
-                    # Обновить last_used_at
-                    db.execute(text("""
-                        UPDATE push_subscriptions
-                        SET last_used_at = NOW()
-                        WHERE id = :sub_id
-                    """), {"sub_id": sub.id})
-
+                    successful_subscriptions.append(sub.id)
                     logger.info(f"Push sent successfully to {sub.endpoint[:50]}...")
 
-                except WebPushException as e:
-                    logger.error(f"Failed to send push to {sub.endpoint[:50]}...: {e}")
+                elif isinstance(result, WebPushException):
+                    logger.error(f"Failed to send push to {sub.endpoint[:50]}...: {result}")
                     failed_count += 1
 
                     # Если subscription недействительна (410 Gone или 404) - удалить
-                    if hasattr(e, 'response') and e.response and e.response.status_code in [404, 410]:
+                    if result.response is not None and result.response.status_code in [404, 410]:
                         invalid_subscriptions.append(sub.id)
                         logger.info(f"Marking subscription {sub.id} for removal (invalid endpoint)")
 
-                except Exception as e:
-                    logger.error(f"Unexpected error sending push to {sub.endpoint[:50]}...: {e}")
+                elif isinstance(result, CircuitOpenError):
+                    logger.warning(f"Push service unavailable, skipped {sub.endpoint[:50]}...")
+                    failed_count += 1
+
+                else:
+                    logger.error(f"Unexpected error sending push to {sub.endpoint[:50]}...: {result}")
                     failed_count += 1
 
+            # Обновить last_used_at одним запросом
+            if successful_subscriptions:
+                db.execute(text("""
+                    UPDATE push_subscriptions
+                    SET last_used_at = NOW()
+                    WHERE id = ANY(:ids)
+                """), {"ids": successful_subscriptions})
+
             # Удалить недействительные subscriptions
             if invalid_subscriptions:
                 db.execute(text("""
@@ -266,135 +479,98 @@ class PushNotificationService:
             logger.error(f"Error sending owner push (event: {event_type}): {e}")
             return {"success": False, "error": str(e)}
 
+    @staticmethod
+    def _default_notification_config(params: dict) -> dict:
+        """Уведомление для неизвестного типа события (title/body из параметров)"""
+        return {
+            "title": params.get("title", "Уведомление"),
+            "body": params.get("body", ""),
+            "icon": "/logo-192.png",
+            "data": params.get("data", {})
+        }
+
     def _get_client_notification_config(self, event_type: str, params: dict) -> dict:
         """Получить конфигурацию уведомления для клиента"""
 
-        configs = {
-            "charging_started": {
-                "title": "Зарядка началась",
-                "body": f"Станция {params.get('station_id', 'N/A')}, коннектор {params.get('connector_id', 'N/A')}",
-                "icon": "/icons/charging-start.png",
-                "data": {
-                    "type": "charging_started",
-                    "session_id": params.get("session_id"),
-                    "station_id": params.get("station_id"),
-                    "connector_id": params.get("connector_id")
-                },
-                "actions": [
-                    {"action": "view", "title": "Открыть"}
-                ]
-            },
-            "charging_completed": {
-                "title": "Зарядка завершена",
-                "body": f"{params.get('energy_kwh', 0):.2f} кВт⋅ч за {params.get('amount', 0):.2f} сом",
-                "icon": "/icons/charging-complete.png",
-                "data": {
-                    "type": "charging_completed",
-                    "session_id": params.get("session_id"),
-                    "energy_kwh": params.get("energy_kwh"),
-                    "amount": params.get("amount")
-                },
-                "actions": [
-                    {"action": "view_history", "title": "Посмотреть"}
-                ]
-            },
-            "charging_error": {
-                "title": "Ошибка зарядки",
-                "body": params.get("error_message", "Произошла ошибка при зарядке"),
-                "icon": "/icons/charging-error.png",
-                "data": {
-                    "type": "charging_error",
-                    "session_id": params.get("session_id"),
-                    "error_code": params.get("error_code")
-                },
-                "require_interaction": True
-            },
-            "low_balance_warning": {
-                "title": "⚠️ Низкий баланс",
-                "body": f"Ваш баланс: {params.get('balance', 0):.2f} сом. Пополните для продолжения зарядки.",
-                "icon": "/icons/low-balance.png",
-                "data": {
-                    "type": "low_balance_warning",
-                    "balance": params.get("balance"),
-                    "threshold": params.get("threshold", 50.0)
-                },
-                "actions": [
-                    {"action": "topup", "title": "Пополнить"}
-                ],
-                "require_interaction": True  # Важное уведомление
-            },
-            "payment_confirmed": {
-                "title": "Баланс пополнен",
-                "body": f"Зачислено {params.get('amount', 0):.2f} сом",
-                "icon": "/icons/payment-success.png",
-                "data": {
-                    "type": "payment_confirmed",
-                    "amount": params.get("amount"),
-                    "new_balance": params.get("new_balance")
-                }
+        template = _CLIENT_NOTIFICATION_TEMPLATES.get(event_type)
+        if template is None:
+            return self._default_notification_config(params)
+
+        # Шаблон готов заранее - собираются только body и data события
+        if event_type == "charging_started":
+            body = f"Станция {params.get('station_id', 'N/A')}, коннектор {params.get('connector_id', 'N/A')}"
+            data = {
+                "type": "charging_started",
+                "session_id": params.get("session_id"),
+                "station_id": params.get("station_id"),
+                "connector_id": params.get("connector_id")
+            }
+        elif event_type == "charging_completed":
+            body = f"{params.get('energy_kwh', 0):.2f} кВт⋅ч за {params.get('amount', 0):.2f} сом"
+            data = {
+                "type": "charging_completed",
+                "session_id": params.get("session_id"),
+                "energy_kwh": params.get("energy_kwh"),
+                "amount": params.get("amount")
+            }
+        elif event_type == "charging_error":
+            body = params.get("error_message", "Произошла ошибка при зарядке")
+            data = {
+                "type": "charging_error",
+                "session_id": params.get("session_id"),
+                "error_code": params.get("error_code")
+            }
+        elif event_type == "low_balance_warning":
+            body = f"Ваш баланс: {params.get('balance', 0):.2f} сом. Пополните для продолжения зарядки."
+            data = {
+                "type": "low_balance_warning",
+                "balance": params.get("balance"),
+                "threshold": params.get("threshold", 50.0)
+            }
+        else:  # payment_confirmed
+            body = f"Зачислено {params.get('amount', 0):.2f} сом"
+            data = {
+                "type": "payment_confirmed",
+                "amount": params.get("amount"),
+                "new_balance": params.get("new_balance")
             }
-        }
 
-        return configs.get(event_type, {
-            "title": params.get("title", "Уведомление"),
-            "body": params.get("body", ""),
-            "icon": "/logo-192.png",
-            "data": params.get("data", {})
-        })
+        return {**template, "body": body, "data": data}
 
     def _get_owner_notification_config(self, event_type: str, params: dict) -> dict:
         """Получить конфигурацию уведомления для владельца"""
 
+        template = _OWNER_NOTIFICATION_TEMPLATES.get(event_type)
+        if template is None:
+            return self._default_notification_config(params)
+
         station_name = params.get("station_name", params.get("station_id", "N/A"))
 
-        configs = {
-            "new_session": {
-                "title": "Новая зарядка",
-                "body": f"Станция {station_name}, коннектор {params.get('connector_id', 'N/A')}",
-                "icon": "/icons/session-new.png",
-                "data": {
-                    "type": "new_session",
-                    "session_id": params.get("session_id"),
-                    "station_id": params.get("station_id"),
-                    "location_id": params.get("location_id")
-                },
-                "actions": [
-                    {"action": "view_station", "title": "Открыть станцию"}
-                ]
-            },
-            "session_completed": {
-                "title": "Зарядка завершена",
-                "body": f"{params.get('energy_kwh', 0):.2f} кВт⋅ч, доход {params.get('amount', 0):.2f} сом",
-                "icon": "/icons/session-complete.png",
-                "data": {
-                    "type": "session_completed",
-                    "session_id": params.get("session_id"),
-                    "energy_kwh": params.get("energy_kwh"),
-                    "amount": params.get("amount")
-                }
-            },
-            "station_offline": {
-                "title": "Станция оффлайн",
-                "body": f"{station_name} не отвечает",
-                "icon": "/icons/station-offline.png",
-                "data": {
-                    "type": "station_offline",
-                    "station_id": params.get("station_id"),
-                    "offline_since": params.get("offline_since")
-                },
-                "actions": [
-                    {"action": "view_station", "title": "Проверить"}
-                ],
-                "require_interaction": True
+        if event_type == "new_session":
+            body = f"Станция {station_name}, коннектор {params.get('connector_id', 'N/A')}"
+            data = {
+                "type": "new_session",
+                "session_id": params.get("session_id"),
+                "station_id": params.get("station_id"),
+                "location_id": params.get("location_id")
+            }
+        elif event_type == "session_completed":
+            body = f"{params.get('energy_kwh', 0):.2f} кВт⋅ч, доход {params.get('amount', 0):.2f} сом"
+            data = {
+                "type": "session_completed",
+                "session_id": params.get("session_id"),
+                "energy_kwh": params.get("energy_kwh"),
+                "amount": params.get("amount")
+            }
+        else:  # station_offline
+            body = f"{station_name} не отвечает"
+            data = {
+                "type": "station_offline",
+                "station_id": params.get("station_id"),
+                "offline_since": params.get("offline_since")
             }
-        }
 
-        return configs.get(event_type, {
-            "title": params.get("title", "Уведомление"),
-            "body": params.get("body", ""),
-            "icon": "/logo-192.png",
-            "data": params.get("data", {})
-        })
+        return {**template, "body": body, "data": data}
 
 
 # Singleton instance
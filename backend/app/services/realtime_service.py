@@ -1,253 +1,466 @@
 """
 Сервис для отправки Realtime обновлений через WebSocket
 """
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Mapping, List, Set, Tuple, Union
+import asyncio
 import json
 import logging
+import os
+from collections import OrderedDict
 from datetime import datetime
-from sqlalchemy.orm import Session
+from time import monotonic as _monotonic
 from sqlalchemy import text
+from sqlalchemy.engine import RowMapping
+from sqlalchemy.ext.asyncio import AsyncSession
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from app.db.session import get_async_session_local
 from ocpp_ws_server.redis_manager import redis_manager
 
 logger = logging.getLogger(__name__)
 
+# Окно объединения обновлений локации: серия StatusNotification станций одной
+# локации дает один пересчет агрегатов и одно событие location_status_update
+_LOCATION_DEBOUNCE_SECONDS = float(os.getenv("REALTIME_LOCATION_DEBOUNCE_MS", "250")) / 1000
+# location_id -> отложенное обновление
+_pending_location_updates: Dict[str, asyncio.TimerHandle] = {}
+# Ссылки на запущенные отложенные обновления (задачу без ссылки может собрать GC)
+_location_update_tasks: Set[asyncio.Task] = set()
+
+# Последнее опубликованное состояние коннектора/станции (без timestamp): повторы
+# с тем же состоянием (MeterValues, повторный StatusNotification) не публикуются.
+# Не дольше окна REALTIME_DEDUP_SECONDS - затем состояние отправляется снова
+# (станция могла переподключиться к другому воркеру и опубликовать иное)
+_DEDUP_SECONDS = float(os.getenv("REALTIME_DEDUP_SECONDS", "60"))
+_DEDUP_MAX_KEYS = 10000
+# ключ события -> (fingerprint, monotonic время публикации); LRU
+_last_published: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+
+
+def _state_changed(key: str, data: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+    """
+    Новое состояние (key, fingerprint), если событие отличается от опубликованного,
+    иначе None. Запоминается через _remember_published только после публикации
+    """
+    fingerprint = hash(tuple(
+        (name, tuple(value.items()) if isinstance(value, dict) else value)
+        for name, value in data.items()
+        if name != "timestamp"
+    ))
+    last = _last_published.get(key)
+    if last is not None and last[0] == fingerprint and _monotonic() - last[1] < _DEDUP_SECONDS:
+        return None
+    return key, fingerprint
+
+
+def _remember_published(states: List[Tuple[str, int]]) -> None:
+    """Запоминает опубликованные состояния (ошибка публикации не должна их подавлять)"""
+    now = _monotonic()
+    for key, fingerprint in states:
+        _last_published[key] = (fingerprint, now)
+        _last_published.move_to_end(key)
+    while len(_last_published) > _DEDUP_MAX_KEYS:
+        _last_published.popitem(last=False)
+
+
+def _dumps(data: Dict[str, Any]) -> Union[bytes, str]:
+    """
+    Сериализация события: orjson (C, datetime нативно) или stdlib json.
+    Формат datetime одинаковый - ISO 8601 без таймзоны (utcnow).
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, default=_json_default)
+
+
+def _json_default(value: Any) -> str:
+    """datetime - ISO 8601 (как orjson), UUID и прочее - строкой"""
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def _loads(value: Any) -> Optional[Dict[str, Any]]:
+    """json колонка (row_to_json): asyncpg возвращает ее текстом"""
+    if value is None or isinstance(value, dict):
+        return value
+    return orjson.loads(value) if orjson is not None else json.loads(value)
+
+
+async def _fetch_one(
+    db: Optional[AsyncSession], statement: Any, params: Dict[str, Any]
+) -> Optional[RowMapping]:
+    """
+    Первая строка запроса через AsyncSession (asyncpg) - event loop не блокируется.
+    Без переданной сессии открывает свою: broadcast запускается задачей после
+    того, как сессия обработчика OCPP уже закрыта.
+    """
+    if db is not None:
+        return (await db.execute(statement, params)).mappings().first()
+    async with get_async_session_local()() as session:
+        return (await session.execute(statement, params)).mappings().first()
+
+
+# Статус станции и счетчики коннекторов (s.id = :station_id):
+# коннекторы станции агрегируются одним проходом (LATERAL + FILTER)
+_STATION_STATUS_SQL = """
+    SELECT
+        s.id,
+        s.serial_number,
+        s.location_id,
+        s.status,
+        s.last_heartbeat_at,
+        CASE
+            WHEN s.status = 'maintenance' THEN 'maintenance'
+            WHEN s.last_heartbeat_at IS NULL OR
+                 s.last_heartbeat_at < NOW() - INTERVAL '5 minutes' THEN 'offline'
+            WHEN cnt.available_connectors > 0 THEN 'available'
+            ELSE 'occupied'
+        END as calculated_status,
+        cnt.available_connectors,
+        cnt.occupied_connectors
+    FROM stations s
+    LEFT JOIN LATERAL (
+        SELECT
+            COUNT(*) FILTER (WHERE c.status = 'available') as available_connectors,
+            COUNT(*) FILTER (WHERE c.status = 'occupied') as occupied_connectors
+        FROM connectors c
+        WHERE c.station_id = s.id AND c.status IN ('available', 'occupied')
+    ) cnt ON true
+    WHERE s.id = :station_id
+"""
+
+# Агрегаты локации; {location_id} - параметр или подзапрос из объединенного запроса.
+# Коннекторы считаются одним проходом на станцию (LATERAL + FILTER), локация -
+# одним GROUP BY; неактивные станции учитываются только в счетчиках коннекторов
+_LOCATION_STATUS_SQL = """
+    WITH station_statuses AS (
+        SELECT
+            s.id as station_id,
+            s.status,
+            CASE
+                WHEN s.status = 'maintenance' THEN 'maintenance'
+                WHEN s.last_heartbeat_at IS NULL OR
+                     s.last_heartbeat_at < NOW() - INTERVAL '5 minutes' THEN 'offline'
+                WHEN cnt.available_connectors > 0 THEN 'available'
+                WHEN cnt.occupied_connectors > 0 THEN 'occupied'
+                ELSE 'offline'
+            END as calculated_status,
+            cnt.total_connectors,
+            cnt.available_connectors,
+            cnt.occupied_connectors,
+            cnt.faulted_connectors
+        FROM stations s
+        LEFT JOIN LATERAL (
+            SELECT
+                COUNT(*) as total_connectors,
+                COUNT(*) FILTER (WHERE c.status = 'available') as available_connectors,
+                COUNT(*) FILTER (WHERE c.status = 'occupied') as occupied_connectors,
+                COUNT(*) FILTER (WHERE c.status = 'faulted') as faulted_connectors
+            FROM connectors c
+            WHERE c.station_id = s.id
+        ) cnt ON true
+        WHERE s.location_id = {location_id}
+    )
+    SELECT
+        l.id,
+        l.name,
+        COUNT(ss.station_id) FILTER (WHERE ss.status != 'inactive') as total_stations,
+        COUNT(ss.station_id) FILTER (WHERE ss.status != 'inactive' AND ss.calculated_status = 'available') as available_stations,
+        COUNT(ss.station_id) FILTER (WHERE ss.status != 'inactive' AND ss.calculated_status = 'occupied') as occupied_stations,
+        COUNT(ss.station_id) FILTER (WHERE ss.status != 'inactive' AND ss.calculated_status = 'offline') as offline_stations,
+        COUNT(ss.station_id) FILTER (WHERE ss.status != 'inactive' AND ss.calculated_status = 'maintenance') as maintenance_stations,
+        COALESCE(SUM(ss.total_connectors), 0)::bigint as total_connectors,
+        COALESCE(SUM(ss.available_connectors), 0)::bigint as available_connectors,
+        COALESCE(SUM(ss.occupied_connectors), 0)::bigint as occupied_connectors,
+        COALESCE(SUM(ss.faulted_connectors), 0)::bigint as faulted_connectors
+    FROM locations l
+    LEFT JOIN station_statuses ss ON true
+    WHERE l.id = {location_id} AND l.status = 'active'
+    GROUP BY l.id, l.name
+"""
+
+# Запросы собираются один раз при импорте: текст SQL неизменен, и asyncpg
+# переиспользует подготовленные на соединении statements (кэш диалекта asyncpg).
+# Каждая сущность возвращается одной json-колонкой (ключи = имена колонок),
+# отсутствующая строка -> NULL
+_LOCATION_UPDATE_STMT = text(
+    "WITH loc AS (" + _LOCATION_STATUS_SQL.format(location_id=":location_id") + ")\n"
+    "SELECT (SELECT row_to_json(loc) FROM loc) AS location"
+)
+
+_STATION_UPDATE_STMT = text(
+    "WITH stn AS (" + _STATION_STATUS_SQL + ")\n"
+    "SELECT (SELECT row_to_json(stn) FROM stn) AS station"
+)
+
+# Коннектор + станция за один запрос (StatusNotification);
+# агрегаты локации - отдельным объединенным обновлением
+_CONNECTOR_UPDATE_STMT = text(
+    """
+    WITH conn AS (
+        SELECT
+            c.id,
+            c.connector_number,
+            c.status,
+            c.error_code,
+            c.connector_type,
+            c.power_kw
+        FROM connectors c
+        WHERE c.station_id = :station_id
+        AND c.connector_number = :connector_id
+    ),
+    """
+    "stn AS (" + _STATION_STATUS_SQL + ")\n"
+    "SELECT (SELECT row_to_json(conn) FROM conn) AS connector,\n"
+    "       (SELECT row_to_json(stn) FROM stn) AS station"
+)
+
+# Сессия зарядки со станцией
+_SESSION_UPDATE_STMT = text("""
+    SELECT
+        cs.id,
+        cs.user_id,
+        cs.station_id,
+        cs.start_time,
+        cs.stop_time,
+        cs.energy,
+        cs.amount,
+        cs.status,
+        s.location_id,
+        s.serial_number
+    FROM charging_sessions cs
+    JOIN stations s ON cs.station_id = s.id
+    WHERE cs.id = :session_id
+""")
+
+
+def _location_update_data(loc: Mapping[str, Any]) -> Dict[str, Any]:
+    """Событие location_status_update из строки агрегатов локации"""
+    total_stations = loc["total_stations"]
+    available_stations = loc["available_stations"]
+    occupied_stations = loc["occupied_stations"]
+    offline_stations = loc["offline_stations"]
+    maintenance_stations = loc["maintenance_stations"]
+
+    # Вычисляем статус локации
+    if total_stations == 0:
+        location_status = "offline"
+    elif offline_stations > 0:
+        location_status = "offline"
+    elif maintenance_stations > 0:
+        location_status = "maintenance"
+    elif occupied_stations == total_stations:
+        location_status = "occupied"
+    elif available_stations == total_stations:
+        location_status = "available"
+    elif available_stations > 0:
+        location_status = "partial"
+    else:
+        location_status = "offline"
+
+    return {
+        "type": "location_status_update",
+        "location_id": loc["id"],
+        "location_name": loc["name"],
+        "status": location_status,
+        "stations_summary": {
+            "total": total_stations,
+            "available": available_stations,
+            "occupied": occupied_stations,
+            "offline": offline_stations,
+            "maintenance": maintenance_stations
+        },
+        "connectors_summary": {
+            "total": loc["total_connectors"],
+            "available": loc["available_connectors"],
+            "occupied": loc["occupied_connectors"],
+            "faulted": loc["faulted_connectors"]
+        },
+        "timestamp": datetime.utcnow()
+    }
+
+
+def _station_update_data(stn: Mapping[str, Any]) -> Dict[str, Any]:
+    """Событие station_status_update из строки станции"""
+    return {
+        "type": "station_status_update",
+        "station_id": stn["id"],
+        "serial_number": stn["serial_number"],
+        "location_id": stn["location_id"],
+        "status": stn["calculated_status"],
+        "available_connectors": stn["available_connectors"],
+        "occupied_connectors": stn["occupied_connectors"],
+        "timestamp": datetime.utcnow()
+    }
+
 
 class RealtimeService:
     """
     Сервис для отправки обновлений статусов в реальном времени
     """
-    
+
     @staticmethod
-    async def broadcast_location_update(db: Session, location_id: str):
+    def _location_messages(
+        loc: Optional[Mapping[str, Any]]
+    ) -> List[Tuple[str, Union[bytes, str]]]:
+        """Сообщения с агрегатами локации (если локация активна)"""
+        if not loc:
+            return []
+
+        message = _dumps(_location_update_data(loc))
+        return [
+            # Подписчики локации
+            (f"location_updates:{loc['id']}", message),
+            # Общий канал всех локаций
+            ("location_updates:all", message),
+        ]
+
+    @staticmethod
+    def _station_messages(
+        stn: Mapping[str, Any],
+        states: List[Tuple[str, int]]
+    ) -> List[Tuple[str, Union[bytes, str]]]:
+        """
+        Сообщения со статусом станции (для станции и ее локации); пусто, если не изменился.
+        Новое состояние добавляется в states - запомнить после публикации
+        """
+        update_data = _station_update_data(stn)
+        state = _state_changed(f"station_updates:{stn['id']}", update_data)
+        if state is None:
+            return []
+        states.append(state)
+
+        message = _dumps(update_data)
+        messages = [(f"station_updates:{stn['id']}", message)]
+        if stn["location_id"]:
+            messages.append((f"location_stations:{stn['location_id']}", message))
+        return messages
+
+    @staticmethod
+    def schedule_location_update(location_id: str) -> None:
+        """
+        Обновление статуса локации через REALTIME_LOCATION_DEBOUNCE_MS.
+        Повторные вызовы до отправки не создают новых событий - подписчики
+        получают одно итоговое состояние локации.
+        """
+        if location_id in _pending_location_updates:
+            return
+
+        def start() -> None:
+            task = asyncio.create_task(RealtimeService._flush_location_update(location_id))
+            _location_update_tasks.add(task)
+            task.add_done_callback(_location_update_tasks.discard)
+
+        _pending_location_updates[location_id] = asyncio.get_running_loop().call_later(
+            _LOCATION_DEBOUNCE_SECONDS, start
+        )
+
+    @staticmethod
+    async def _flush_location_update(location_id: str) -> None:
+        """Отложенное обновление локации"""
+        # Изменения во время запроса запланируют следующее обновление
+        _pending_location_updates.pop(location_id, None)
+        await RealtimeService.broadcast_location_update(location_id)
+
+    @staticmethod
+    async def broadcast_location_update(location_id: str, db: Optional[AsyncSession] = None):
         """
         Отправляет обновление статуса локации всем подписчикам
         """
         try:
-            # Получаем актуальный статус локации с агрегацией
-            query = text("""
-                WITH station_statuses AS (
-                    SELECT
-                        s.id as station_id,
-                        CASE
-                            WHEN s.status = 'maintenance' THEN 'maintenance'
-                            WHEN s.last_heartbeat_at IS NULL OR
-                                 s.last_heartbeat_at < NOW() - INTERVAL '5 minutes' THEN 'offline'
-                            WHEN EXISTS (
-                                SELECT 1 FROM connectors c
-                                WHERE c.station_id = s.id
-                                AND c.status = 'available'
-                            ) THEN 'available'
-                            WHEN EXISTS (
-                                SELECT 1 FROM connectors c
-                                WHERE c.station_id = s.id
-                                AND c.status = 'occupied'
-                            ) THEN 'occupied'
-                            ELSE 'offline'
-                        END as calculated_status
-                    FROM stations s
-                    WHERE s.location_id = :location_id AND s.status != 'inactive'
-                )
-                SELECT
-                    l.id,
-                    l.name,
-                    COUNT(DISTINCT ss.station_id) as total_stations,
-                    COUNT(DISTINCT CASE WHEN ss.calculated_status = 'available' THEN ss.station_id END) as available_stations,
-                    COUNT(DISTINCT CASE WHEN ss.calculated_status = 'occupied' THEN ss.station_id END) as occupied_stations,
-                    COUNT(DISTINCT CASE WHEN ss.calculated_status = 'offline' THEN ss.station_id END) as offline_stations,
-                    COUNT(DISTINCT CASE WHEN ss.calculated_status = 'maintenance' THEN ss.station_id END) as maintenance_stations,
-                    (SELECT COUNT(*) FROM connectors c JOIN stations s ON c.station_id = s.id WHERE s.location_id = :location_id) as total_connectors,
-                    (SELECT COUNT(*) FROM connectors c JOIN stations s ON c.station_id = s.id WHERE s.location_id = :location_id AND c.status = 'available') as available_connectors,
-                    (SELECT COUNT(*) FROM connectors c JOIN stations s ON c.station_id = s.id WHERE s.location_id = :location_id AND c.status = 'occupied') as occupied_connectors,
-                    (SELECT COUNT(*) FROM connectors c JOIN stations s ON c.station_id = s.id WHERE s.location_id = :location_id AND c.status = 'faulted') as faulted_connectors
-                FROM locations l
-                LEFT JOIN station_statuses ss ON true
-                WHERE l.id = :location_id AND l.status = 'active'
-                GROUP BY l.id, l.name
-            """)
-            
-            result = db.execute(query, {"location_id": location_id}).fetchone()
-
-            if result:
-                # Индексы: 0=id, 1=name, 2=total, 3=available, 4=occupied, 5=offline, 6=maintenance,
-                #          7=total_conn, 8=available_conn, 9=occupied_conn, 10=faulted_conn
-                total_stations = result[2]
-                available_stations = result[3]
-                occupied_stations = result[4]
-                offline_stations = result[5]
-                maintenance_stations = result[6]
-
-                # Вычисляем статус локации
-                if total_stations == 0:
-                    location_status = "offline"
-                elif offline_stations > 0:
-                    location_status = "offline"
-                elif maintenance_stations > 0:
-                    location_status = "maintenance"
-                elif occupied_stations == total_stations:
-                    location_status = "occupied"
-                elif available_stations == total_stations:
-                    location_status = "available"
-                elif available_stations > 0:
-                    location_status = "partial"
-                else:
-                    location_status = "offline"
+            # Актуальный статус локации с агрегацией
+            row = await _fetch_one(db, _LOCATION_UPDATE_STMT, {"location_id": location_id})
 
-                update_data = {
-                    "type": "location_status_update",
-                    "location_id": result[0],
-                    "location_name": result[1],
-                    "status": location_status,
-                    "stations_summary": {
-                        "total": total_stations,
-                        "available": available_stations,
-                        "occupied": occupied_stations,
-                        "offline": offline_stations,
-                        "maintenance": maintenance_stations
-                    },
-                    "connectors_summary": {
-                        "total": result[7],
-                        "available": result[8],
-                        "occupied": result[9],
-                        "faulted": result[10]
-                    },
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-                
-                # Публикуем через Redis для всех подписчиков
-                channel = f"location_updates:{location_id}"
-                await redis_manager.publish(channel, json.dumps(update_data))
-                
-                # Также публикуем в общий канал всех локаций
-                await redis_manager.publish("location_updates:all", json.dumps(update_data))
-                
+            messages = RealtimeService._location_messages(_loads(row["location"]) if row else None)
+            if messages:
+                await redis_manager.publish_many(messages)
                 logger.info(f"Отправлено обновление статуса локации {location_id}")
-                
+
         except Exception as e:
             logger.error(f"Ошибка отправки обновления локации {location_id}: {e}")
-    
+
     @staticmethod
-    async def broadcast_station_update(db: Session, station_id: str):
+    async def broadcast_station_update(station_id: str, db: Optional[AsyncSession] = None):
         """
         Отправляет обновление статуса станции всем подписчикам
         """
         try:
-            # Получаем информацию о станции
-            query = text("""
-                SELECT 
-                    s.id,
-                    s.serial_number,
-                    s.location_id,
-                    s.status,
-                    s.last_heartbeat_at,
-                    CASE 
-                        WHEN s.status = 'maintenance' THEN 'maintenance'
-                        WHEN s.last_heartbeat_at IS NULL OR 
-                             s.last_heartbeat_at < NOW() - INTERVAL '5 minutes' THEN 'offline'
-                        WHEN EXISTS (
-                            SELECT 1 FROM connectors c 
-                            WHERE c.station_id = s.id 
-                            AND c.status = 'available'
-                        ) THEN 'available'
-                        ELSE 'occupied'
-                    END as calculated_status,
-                    (
-                        SELECT COUNT(*) FROM connectors c 
-                        WHERE c.station_id = s.id AND c.status = 'available'
-                    ) as available_connectors,
-                    (
-                        SELECT COUNT(*) FROM connectors c 
-                        WHERE c.station_id = s.id AND c.status = 'occupied'
-                    ) as occupied_connectors
-                FROM stations s
-                WHERE s.id = :station_id
-            """)
-            
-            result = db.execute(query, {"station_id": station_id}).fetchone()
-            
-            if result:
-                update_data = {
-                    "type": "station_status_update",
-                    "station_id": result[0],
-                    "serial_number": result[1],
-                    "location_id": result[2],
-                    "status": result[5],
-                    "available_connectors": result[6],
-                    "occupied_connectors": result[7],
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-                
-                # Публикуем для станции
-                channel = f"station_updates:{station_id}"
-                await redis_manager.publish(channel, json.dumps(update_data))
-                
-                # Публикуем для локации
-                if result[2]:  # location_id
-                    location_channel = f"location_stations:{result[2]}"
-                    await redis_manager.publish(location_channel, json.dumps(update_data))
-                    
-                    # Также обновляем статус самой локации
-                    await RealtimeService.broadcast_location_update(db, result[2])
-                
+            row = await _fetch_one(db, _STATION_UPDATE_STMT, {"station_id": station_id})
+
+            stn = _loads(row["station"]) if row else None
+            states: List[Tuple[str, int]] = []
+            messages = RealtimeService._station_messages(stn, states) if stn else []
+            if messages:
+                await redis_manager.publish_many(messages)
+                _remember_published(states)
+                # Также обновляем статус самой локации (объединенно)
+                if stn["location_id"]:
+                    RealtimeService.schedule_location_update(stn["location_id"])
                 logger.info(f"Отправлено обновление статуса станции {station_id}")
-                
+
         except Exception as e:
             logger.error(f"Ошибка отправки обновления станции {station_id}: {e}")
-    
+
     @staticmethod
-    async def broadcast_connector_update(db: Session, station_id: str, connector_id: int):
+    async def broadcast_connector_update(
+        station_id: str, connector_id: int, db: Optional[AsyncSession] = None
+    ):
         """
         Отправляет обновление статуса коннектора всем подписчикам
+        (коннектор и станция - одним запросом)
         """
         try:
-            # Получаем информацию о коннекторе
-            query = text("""
-                SELECT 
-                    c.id,
-                    c.connector_number,
-                    c.status,
-                    c.error_code,
-                    c.connector_type,
-                    c.power_kw,
-                    s.location_id
-                FROM connectors c
-                JOIN stations s ON c.station_id = s.id
-                WHERE c.station_id = :station_id 
-                AND c.connector_number = :connector_id
-            """)
-            
-            result = db.execute(query, {
-                "station_id": station_id, 
+            row = await _fetch_one(db, _CONNECTOR_UPDATE_STMT, {
+                "station_id": station_id,
                 "connector_id": connector_id
-            }).fetchone()
-            
-            if result:
+            })
+
+            if row and row["connector"]:
+                conn, stn = _loads(row["connector"]), _loads(row["station"])
                 update_data = {
                     "type": "connector_status_update",
-                    "connector_id": result[1],
+                    "connector_id": conn["connector_number"],
                     "station_id": station_id,
-                    "location_id": result[6],
-                    "status": result[2],
-                    "error_code": result[3],
-                    "connector_type": result[4],
-                    "power_kw": float(result[5]) if result[5] else 0,
-                    "timestamp": datetime.utcnow().isoformat()
+                    "location_id": stn["location_id"] if stn else None,
+                    "status": conn["status"],
+                    "error_code": conn["error_code"],
+                    "connector_type": conn["connector_type"],
+                    "power_kw": float(conn["power_kw"]) if conn["power_kw"] else 0,
+                    "timestamp": datetime.utcnow()
                 }
-                
-                # Публикуем для коннектора
+
+                # Коннектор и станция - одним pipeline (только изменившиеся)
                 channel = f"connector_updates:{station_id}:{connector_id}"
-                await redis_manager.publish(channel, json.dumps(update_data))
-                
-                # Также обновляем статус станции
-                await RealtimeService.broadcast_station_update(db, station_id)
-                
+                messages = []
+                states: List[Tuple[str, int]] = []
+                state = _state_changed(channel, update_data)
+                if state is not None:
+                    states.append(state)
+                    messages.append((channel, _dumps(update_data)))
+                if stn:
+                    messages.extend(RealtimeService._station_messages(stn, states))
+                if not messages:
+                    logger.debug(f"Состояние коннектора {station_id}:{connector_id} не изменилось")
+                    return
+
+                await redis_manager.publish_many(messages)
+                _remember_published(states)
+                # Также обновляем статус самой локации (объединенно)
+                if stn and stn["location_id"]:
+                    RealtimeService.schedule_location_update(stn["location_id"])
+
                 logger.info(f"Отправлено обновление статуса коннектора {station_id}:{connector_id}")
-                
+
         except Exception as e:
             logger.error(f"Ошибка отправки обновления коннектора {station_id}:{connector_id}: {e}")
-    
+
     @staticmethod
-    async def broadcast_charging_session_update(db: Session, session_id: str, event_type: str):
+    async def broadcast_charging_session_update(
+        session_id: str, event_type: str, db: Optional[AsyncSession] = None
+    ):
         """
         Отправляет обновление сессии зарядки
         
@@ -255,48 +468,30 @@ class RealtimeService:
         """
         try:
             # Получаем информацию о сессии
-            query = text("""
-                SELECT 
-                    cs.id,
-                    cs.user_id,
-                    cs.station_id,
-                    cs.start_time,
-                    cs.stop_time,
-                    cs.energy,
-                    cs.amount,
-                    cs.status,
-                    s.location_id,
-                    s.serial_number
-                FROM charging_sessions cs
-                JOIN stations s ON cs.station_id = s.id
-                WHERE cs.id = :session_id
-            """)
+            row = await _fetch_one(db, _SESSION_UPDATE_STMT, {"session_id": session_id})
             
-            result = db.execute(query, {"session_id": session_id}).fetchone()
-            
-            if result:
+            if row:
                 update_data = {
                     "type": "charging_session_update",
                     "event": event_type,
-                    "session_id": result[0],
-                    "client_id": result[1],
-                    "station_id": result[2],
-                    "location_id": result[8],
-                    "status": result[7],
-                    "energy_kwh": float(result[5]) if result[5] else 0,
-                    "amount": float(result[6]) if result[6] else 0,
-                    "start_time": result[3].isoformat() if result[3] else None,
-                    "stop_time": result[4].isoformat() if result[4] else None,
-                    "timestamp": datetime.utcnow().isoformat()
+                    "session_id": row["id"],
+                    "client_id": row["user_id"],
+                    "station_id": row["station_id"],
+                    "location_id": row["location_id"],
+                    "status": row["status"],
+                    "energy_kwh": float(row["energy"]) if row["energy"] else 0,
+                    "amount": float(row["amount"]) if row["amount"] else 0,
+                    "start_time": row["start_time"],
+                    "stop_time": row["stop_time"],
+                    "timestamp": datetime.utcnow()
                 }
                 
-                # Публикуем для клиента
-                client_channel = f"client_sessions:{result[1]}"
-                await redis_manager.publish(client_channel, json.dumps(update_data))
-                
-                # Публикуем для станции
-                station_channel = f"station_sessions:{result[2]}"
-                await redis_manager.publish(station_channel, json.dumps(update_data))
+                # Публикуем для клиента и станции одним pipeline
+                message = _dumps(update_data)
+                await redis_manager.publish_many([
+                    (f"client_sessions:{row['user_id']}", message),
+                    (f"station_sessions:{row['station_id']}", message),
+                ])
                 
                 logger.info(f"Отправлено обновление сессии {session_id} (событие: {event_type})")
                 
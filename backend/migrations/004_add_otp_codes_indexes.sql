@@ -0,0 +1,20 @@
+-- Migration: индексы для горячих запросов OTP (otp_service.py)
+-- Description: rate limit, поиск действительного кода и очистка без seq scan / сортировки
+-- Date: 2026-10-18
+--
+-- ⚠️ CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции:
+--    в Supabase SQL Editor запускать каждый оператор отдельно.
+
+-- check_rate_limit: WHERE phone = :phone ORDER BY created_at DESC LIMIT 1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS otp_codes_phone_created_idx
+    ON otp_codes (phone, created_at DESC);
+
+-- verify: WHERE phone = :phone AND purpose = :purpose AND verified_at IS NULL
+--         AND expires_at > NOW() ORDER BY created_at DESC LIMIT 1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS otp_codes_phone_purpose_created_idx
+    ON otp_codes (phone, purpose, created_at DESC)
+    WHERE verified_at IS NULL;
+
+-- cleanup_expired: WHERE created_at < NOW() - INTERVAL '24 hours'
+CREATE INDEX CONCURRENTLY IF NOT EXISTS otp_codes_created_idx
+    ON otp_codes (created_at);
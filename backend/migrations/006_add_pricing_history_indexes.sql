@@ -0,0 +1,15 @@
+-- Migration: индексы истории тарифов
+-- Description: аналитика (_PRICING_ANALYTICS_STMT) - по станции и периоду;
+--              покрывающий индекс правил тарифа создается в 007 (нужна days_mask)
+-- Date: 2026-10-18
+--
+-- ⚠️ CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции:
+--    в Supabase SQL Editor запускать каждый оператор отдельно.
+
+-- 1. История тарифов: аналитика по станции за период
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pricing_history_station_time_idx
+    ON pricing_history (station_id, calculation_time);
+
+-- 2. История тарифов: аналитика по всем станциям за период
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pricing_history_time_idx
+    ON pricing_history (calculation_time);
@@ -0,0 +1,57 @@
+-- Migration: битовая маска дней недели в tariff_rules
+-- Description: days_mask (Пн = бит 0 ... Вс = бит 6) вместо поиска по массиву
+--              days_of_week: фильтр дня - одна операция (days_mask & :weekday_bit)
+-- Date: 2026-10-18
+--
+-- days_of_week остается источником данных (админка, описание правила),
+-- days_mask поддерживается триггером. NULL - правило без ограничения по дням,
+-- 0 - пустой массив (как и раньше, не совпадает ни с одним днем)
+--
+-- ⚠️ Шаги 1-3 выполнять одной транзакцией, шаг 4 (CONCURRENTLY) - отдельно.
+-- Проверка: EXPLAIN (ANALYZE, BUFFERS) запроса контекста тарифа -
+--           "Index Only Scan using tariff_rules_lookup_idx" (после VACUUM tariff_rules)
+
+-- 1. Колонка
+ALTER TABLE tariff_rules ADD COLUMN IF NOT EXISTS days_mask smallint;
+
+-- 2. Заполнение существующих правил
+UPDATE tariff_rules
+SET days_mask = (
+    SELECT COALESCE(bit_or(1 << (d - 1)), 0)::smallint
+    FROM unnest(days_of_week) AS d
+)
+WHERE days_of_week IS NOT NULL;
+
+-- 3. Синхронизация при изменении days_of_week
+CREATE OR REPLACE FUNCTION tariff_rules_sync_days_mask()
+RETURNS trigger AS $$
+BEGIN
+    IF NEW.days_of_week IS NULL THEN
+        NEW.days_mask := NULL;
+    ELSE
+        NEW.days_mask := (
+            SELECT COALESCE(bit_or(1 << (d - 1)), 0)::smallint
+            FROM unnest(NEW.days_of_week) AS d
+        );
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tariff_rules_days_mask_trg ON tariff_rules;
+CREATE TRIGGER tariff_rules_days_mask_trg
+    BEFORE INSERT OR UPDATE OF days_of_week ON tariff_rules
+    FOR EACH ROW EXECUTE FUNCTION tariff_rules_sync_days_mask();
+
+-- 4. Правила тарифного плана в порядке приоритета + все колонки фильтров и ответа:
+--    подбор правила (_PRICING_CONTEXT_STMT) читает их прямо из индекса
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tariff_rules_lookup_idx
+    ON tariff_rules (tariff_plan_id, priority DESC, created_at DESC)
+    INCLUDE (
+        id, name, tariff_type, connector_type,
+        power_range_min, power_range_max, price, currency,
+        time_start, time_end, is_weekend, days_of_week, days_mask,
+        min_duration_minutes, max_duration_minutes,
+        valid_from, valid_until
+    )
+    WHERE is_active = true;
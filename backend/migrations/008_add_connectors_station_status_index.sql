@@ -0,0 +1,12 @@
+-- Migration: индекс коннекторов станции по статусу (realtime_service.py)
+-- Description: счетчики available/occupied коннекторов станции для realtime
+--              событий (LATERAL + COUNT FILTER) читаются из одного индекса
+-- Date: 2026-10-18
+--
+-- ⚠️ CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции:
+--    в Supabase SQL Editor запускать каждый оператор отдельно.
+
+-- _STATION_STATUS_SQL: WHERE c.station_id = ... AND c.status IN ('available', 'occupied')
+CREATE INDEX CONCURRENTLY IF NOT EXISTS connectors_station_status_idx
+    ON connectors (station_id, status)
+    WHERE status IN ('available', 'occupied');
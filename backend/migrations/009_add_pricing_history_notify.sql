@@ -0,0 +1,23 @@
+-- Migration: NOTIFY об изменении истории тарифов (pricing_service.py)
+-- Description: после INSERT в pricing_history отправляется pg_notify
+--              'pricing_history_change' со station_id новых записей -
+--              воркеры сбрасывают кэш аналитики (listen_pricing_history_changes)
+-- Date: 2026-10-18
+--
+-- Триггер уровня оператора: пачка истории (один multi-VALUES INSERT) дает
+-- по одному уведомлению на станцию, а не на строку
+
+CREATE OR REPLACE FUNCTION pricing_history_notify_change()
+RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('pricing_history_change', COALESCE(changed.station_id::text, ''))
+    FROM (SELECT DISTINCT station_id FROM new_rows) AS changed;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pricing_history_notify_change_trg ON pricing_history;
+CREATE TRIGGER pricing_history_notify_change_trg
+    AFTER INSERT ON pricing_history
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION pricing_history_notify_change();
@@ -0,0 +1,15 @@
+-- Migration: последовательность ID транзакций OBANK (obank_service.py)
+-- Description: ID H2H и токен-платежей берутся из nextval - уникальны для всех
+--              воркеров и реплик (счетчик в памяти процесса этого не гарантировал)
+-- Date: 2026-10-18
+--
+-- Длина ID - 10 цифр, как у прежних ID по Unix времени (int(timestamp)), которые
+-- OBANK принимал. Начало выше любого выданного так ID (2e9 секунд - 2033 год),
+-- MAXVALUE не дает ID стать длиннее: при исчерпании nextval вернет ошибку
+
+CREATE SEQUENCE IF NOT EXISTS obank_transaction_id_seq
+    AS bigint
+    START WITH 2000000000
+    MINVALUE 2000000000
+    MAXVALUE 9999999999
+    NO CYCLE;
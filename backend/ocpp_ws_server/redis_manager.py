@@ -6,7 +6,7 @@ import json
 import os
 import logging
 import asyncio
-from typing import Optional, Set, Dict, AsyncGenerator
+from typing import Optional, Set, Dict, AsyncGenerator, List, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
@@ -327,6 +327,21 @@ class RedisOcppManager:
         result = await self.redis.publish(channel, message)
         logger.info(f"📢 Published to {channel}, subscribers: {result}")
 
+    async def publish_many(self, messages: List[Tuple[str, Union[str, bytes]]]):
+        """
+        Публикация нескольких сообщений за один round-trip (pipeline без MULTI).
+
+        Args:
+            messages: Пары (канал, сообщение)
+        """
+        if not messages:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel, message in messages:
+                pipe.publish(channel, message)
+            results = await pipe.execute()
+        logger.info("📢 Published %d messages, subscribers: %s", len(messages), results)
+
     async def subscribe_and_listen(self, *channels) -> AsyncGenerator[dict, None]:
         """
         Подписка и прослушивание нескольких каналов через Pub/Sub.
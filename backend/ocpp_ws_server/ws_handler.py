@@ -180,7 +180,7 @@ class OCPPChargePoint(CP):
 
                 # Broadcast что станция online для PWA клиентов
                 asyncio.create_task(
-                    RealtimeService.broadcast_station_update(db, self.id)
+                    RealtimeService.broadcast_station_update(self.id)
                 )
                 self.logger.info(f"📡 Broadcast: станция {self.id} online")
 
@@ -343,7 +343,7 @@ class OCPPChargePoint(CP):
 
                     # Broadcast обновления через WebSocket для PWA клиентов
                     asyncio.create_task(
-                        RealtimeService.broadcast_connector_update(db, self.id, connector_id)
+                        RealtimeService.broadcast_connector_update(self.id, connector_id)
                     )
                     self.logger.debug(f"📡 Broadcast обновления коннектора {self.id}:{connector_id}")
 
@@ -1700,9 +1700,8 @@ class OCPPWebSocketHandler:
 
             # Broadcast что станция offline для PWA клиентов
             try:
-                with next(get_db()) as db:
-                    await RealtimeService.broadcast_station_update(db, self.station_id)
-                    self.logger.info(f"📡 Broadcast: станция {self.station_id} offline")
+                await RealtimeService.broadcast_station_update(self.station_id)
+                self.logger.info(f"📡 Broadcast: станция {self.station_id} offline")
             except Exception as broadcast_error:
                 self.logger.warning(f"Не удалось broadcast offline: {broadcast_error}")
 
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Разовый подбор H2H эндпоинта OBANK при подключении нового терминала.
+Отправляет безопасный запрос статуса на каждый кандидат и печатает HTTP ответ.
+Найденный путь прописать в OBANK_H2H_ENDPOINT - в рабочем коде перебора нет.
+"""
+import asyncio
+import logging
+import sys
+
+from app.services.obank_service import OBankService
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+CANDIDATE_ENDPOINTS = ["", "/", "/payment", "/h2h", "/h2h-payment", "/pay", "/process", "/api", "/gateway"]
+
+
+async def probe(endpoints):
+    service = OBankService()
+    try:
+        xml_data = service._create_status_xml("0")
+        for endpoint in endpoints:
+            result = await service._make_request(endpoint, xml_data)
+            status = result.get("error", "OK (XML ответ)")
+            logger.info(f"{service.base_url}{endpoint!s:<14} -> {status}")
+    finally:
+        await service.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(probe(sys.argv[1:] or CANDIDATE_ENDPOINTS))
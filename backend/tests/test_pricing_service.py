@@ -7,12 +7,35 @@ from decimal import Decimal
 from unittest.mock import Mock, MagicMock, patch
 import json
 
+from app.services import pricing_service as pricing_module
 from app.services.pricing_service import (
     PricingService, PricingResult, SessionCost,
     TariffType, DiscountType, PricingCache
 )
 
 
+def make_rule(rule_id, name, price, time_start=None, time_end=None,
+              is_weekend=None, priority=100, connector_type="ALL", tariff_plan_id="plan1"):
+    """Правило тарифа в виде json_build_object из запроса контекста тарифа"""
+    return {
+        "id": rule_id, "name": name, "tariff_type": "per_kwh",
+        "connector_type": connector_type, "power_range_min": 0, "power_range_max": 100,
+        "price": price, "currency": "KGS",
+        "time_start": time_start.isoformat() if time_start else None,
+        "time_end": time_end.isoformat() if time_end else None,
+        "is_weekend": is_weekend, "priority": priority,
+        "min_duration": None, "max_duration": None,
+        "valid_from": None, "valid_until": None, "days_of_week": None,
+        "tariff_plan_id": tariff_plan_id
+    }
+
+
+def make_context_row(station, client=(None, None, None, None),
+                     client_rule=None, station_rule=None, change_points=None):
+    """Строка результата единого запроса контекста тарифа (станция + клиент + правила)"""
+    return (*station, *client, client_rule, station_rule, change_points)
+
+
 class TestPricingCache:
     """Тесты для кэша тарифов"""
     
@@ -45,6 +68,16 @@ class TestPricingCache:
         
         assert key1 == key2  # Одинаковые параметры
         assert key1 != key3  # Разные параметры
+    
+    def test_cache_invalidate_by_station(self):
+        cache = PricingCache()
+        cache.set(cache.make_key("station1", "Type2"), "a")
+        cache.set(cache.make_key("station1", "CCS"), "b")
+        cache.set(cache.make_key("station2", "Type2"), "c")
+        
+        assert cache.invalidate("station1") == 2
+        assert cache.get(cache.make_key("station1", "Type2")) is None
+        assert cache.get(cache.make_key("station2", "Type2")) == "c"
 
 
 class TestPricingService:
@@ -56,21 +89,28 @@ class TestPricingService:
         return MagicMock()
     
     @pytest.fixture
-    def pricing_service(self, mock_db):
+    def pricing_service(self, mock_db, monkeypatch):
         """Экземпляр сервиса с моком БД"""
-        return PricingService(mock_db)
+        # Без L2 кэша в Redis: тесты не зависят от внешнего состояния
+        monkeypatch.setattr(pricing_module, "_redis_cache_client", lambda: None)
+        # Без фоновой записи истории: поток писателя ходил бы в настоящую БД
+        monkeypatch.setattr(pricing_module, "_HISTORY_SAMPLE_RATE", 0.0)
+        service = PricingService(mock_db)
+        # Кэш общий для процесса - не переносим записи между тестами
+        service.clear_cache()
+        return service
     
     def test_station_specific_pricing(self, pricing_service, mock_db):
         """Тест индивидуального тарифа станции"""
         # Мокаем данные станции с индивидуальной ценой
-        mock_db.execute.return_value.fetchone.return_value = (
+        mock_db.execute.return_value.fetchone.return_value = make_context_row((
             "station1",  # id
             15.5,        # price_per_kwh
             2.0,         # session_fee
             "KGS",       # currency
             None,        # tariff_plan_id
             None         # tariff_plan_name
-        )
+        ))
         
         result = pricing_service.calculate_pricing(
             station_id="station1",
@@ -86,28 +126,11 @@ class TestPricingService:
     
     def test_tariff_plan_pricing(self, pricing_service, mock_db):
         """Тест тарифа из тарифного плана"""
-        # Мокаем данные станции с тарифным планом
-        mock_db.execute.return_value.fetchone.side_effect = [
-            # Первый вызов - данные станции
+        # Мокаем данные станции с тарифным планом и его правилом
+        mock_db.execute.return_value.fetchone.return_value = make_context_row(
             ("station1", None, None, "KGS", "plan1", "План 1"),
-            # Второй вызов - правило тарифа
-            (
-                "rule1", "Дневной тариф", "per_kwh", "ALL",
-                0, 100, 12.0, "KGS",
-                time(9, 0), time(18, 0), False, 100,
-                None, None, None, None, None
-            )
-        ]
-        
-        # Мокаем fetchall для правил
-        mock_db.execute.return_value.fetchall.return_value = [
-            (
-                "rule1", "Дневной тариф", "per_kwh", "ALL",
-                0, 100, 12.0, "KGS",
-                time(9, 0), time(18, 0), False, 100,
-                None, None, None, None, None
-            )
-        ]
+            station_rule=make_rule("rule1", "Дневной тариф", 12.0, time(9, 0), time(18, 0), is_weekend=False)
+        )
         
         with patch('app.services.pricing_service.datetime') as mock_datetime:
             mock_datetime.now.return_value = datetime(2024, 1, 15, 14, 0, tzinfo=timezone.utc)
@@ -124,29 +147,14 @@ class TestPricingService:
     def test_weekend_pricing(self, pricing_service, mock_db):
         """Тест тарифа выходного дня"""
         # Мокаем данные для выходного дня
-        mock_db.execute.return_value.fetchone.side_effect = [
+        mock_db.execute.return_value.fetchone.return_value = make_context_row(
             ("station1", None, None, "KGS", "plan1", "План 1"),
-            (
-                "rule_weekend", "Выходной тариф", "per_kwh", "ALL",
-                0, 100, 8.0, "KGS",
-                None, None, True, 100,  # is_weekend = True
-                None, None, None, None, None
-            )
-        ]
-        
-        mock_db.execute.return_value.fetchall.return_value = [
-            (
-                "rule_weekend", "Выходной тариф", "per_kwh", "ALL",
-                0, 100, 8.0, "KGS",
-                None, None, True, 100,
-                None, None, None, None, None
-            )
-        ]
+            station_rule=make_rule("rule_weekend", "Выходной тариф", 8.0, is_weekend=True)  # is_weekend = True
+        )
         
         with patch('app.services.pricing_service.datetime') as mock_datetime:
-            # Суббота
+            # Суббота (20.01.2024): день недели берется из реального datetime
             mock_datetime.now.return_value = datetime(2024, 1, 20, 14, 0, tzinfo=timezone.utc)
-            mock_datetime.now.return_value.isoweekday.return_value = 6
             
             result = pricing_service.calculate_pricing(
                 station_id="station1",
@@ -158,28 +166,14 @@ class TestPricingService:
     
     def test_client_specific_pricing(self, pricing_service, mock_db):
         """Тест клиентского тарифа с скидкой"""
-        mock_db.execute.return_value.fetchone.side_effect = [
+        mock_db.execute.return_value.fetchone.return_value = make_context_row(
             # Данные станции
             ("station1", None, None, "KGS", "plan1", "План 1"),
             # Клиентский тариф со скидкой 20%
             ("plan1", 20.0, None, "VIP План"),
             # Правило тарифа
-            (
-                "rule1", "Базовый", "per_kwh", "ALL",
-                0, 100, 10.0, "KGS",
-                None, None, None, 100,
-                None, None, None, None, None
-            )
-        ]
-        
-        mock_db.execute.return_value.fetchall.return_value = [
-            (
-                "rule1", "Базовый", "per_kwh", "ALL",
-                0, 100, 10.0, "KGS",
-                None, None, None, 100,
-                None, None, None, None, None
-            )
-        ]
+            client_rule=make_rule("rule1", "Базовый", 10.0)
+        )
         
         result = pricing_service.calculate_pricing(
             station_id="station1",
@@ -243,6 +237,29 @@ class TestPricingService:
         assert cost.breakdown['session_fee'] == Decimal('5.0')
         assert cost.final_amount == Decimal('235.0')
     
+    def test_session_costs_batch(self, pricing_service):
+        """Тест пакетного расчета стоимости: совпадает с calculate_session_cost"""
+        pricing = PricingResult(
+            rate_per_kwh=Decimal('10.0'),
+            rate_per_minute=Decimal('0.5'),
+            session_fee=Decimal('5.0'),
+            parking_fee_per_minute=Decimal('0'),
+            currency='KGS',
+            active_rule='Тест',
+            rule_details={},
+            time_based=False,
+            next_rate_change=None,
+            tariff_plan_id=None,
+            rule_id=None
+        )
+        
+        costs = pricing_service.calculate_session_costs_batch(
+            [20.0, Decimal('0.1')], [60, 0], [pricing, pricing]
+        )
+        
+        assert costs == [Decimal('235.0'), Decimal('6.0')]
+        assert costs[0] == pricing_service.calculate_session_cost(20.0, 60, pricing).base_amount
+    
     def test_promo_code_percent_discount(self, pricing_service, mock_db):
         """Тест промо-кода с процентной скидкой"""
         # Мокаем промо-код со скидкой 15%
@@ -254,12 +271,10 @@ class TestPricingService:
             10.0,          # min_charge_amount
             100,           # usage_limit
             5,             # usage_count
-            3              # client_usage_limit
+            3,             # client_usage_limit
+            0              # client_usage (использования клиентом)
         )
         
-        # Мокаем использования клиентом
-        mock_db.execute.return_value.scalar.return_value = 0
-        
         pricing = PricingResult(
             rate_per_kwh=Decimal('10.0'),
             rate_per_minute=Decimal('0'),
@@ -286,14 +301,15 @@ class TestPricingService:
         assert cost.discount_amount == Decimal('30.0')  # 15% от 200
         assert cost.final_amount == Decimal('170.0')
         assert cost.promo_code_applied == "SAVE15"
+        # Промо-код и использования клиентом - одним запросом
+        assert mock_db.execute.call_count == 1
     
     def test_promo_code_max_discount_limit(self, pricing_service, mock_db):
         """Тест ограничения максимальной скидки"""
         # Промо-код 50% но максимум 100 сом
         mock_db.execute.return_value.fetchone.return_value = (
-            "promo2", "percent", 50.0, 100.0, 0, 100, 0, 10
+            "promo2", "percent", 50.0, 100.0, 0, 100, 0, 10, 0
         )
-        mock_db.execute.return_value.scalar.return_value = 0
         
         pricing = PricingResult(
             rate_per_kwh=Decimal('10.0'),
@@ -365,8 +381,8 @@ class TestPricingService:
     def test_fallback_to_default_pricing(self, pricing_service, mock_db):
         """Тест возврата к базовому тарифу при ошибке"""
         # Станция без тарифного плана и индивидуальной цены
-        mock_db.execute.return_value.fetchone.return_value = (
-            "station1", None, None, "KGS", None, None
+        mock_db.execute.return_value.fetchone.return_value = make_context_row(
+            ("station1", None, None, "KGS", None, None)
         )
         
         result = pricing_service.calculate_pricing(
@@ -374,14 +390,14 @@ class TestPricingService:
             skip_cache=True
         )
         
-        assert result.rate_per_kwh == Decimal('9.0')  # Дефолтная цена
+        assert result.rate_per_kwh == Decimal('13.5')  # Дефолтная цена
         assert result.active_rule == "Базовый тариф"
         assert result.rule_details['type'] == 'default'
     
     def test_caching_works(self, pricing_service, mock_db):
         """Тест что кэширование работает"""
-        mock_db.execute.return_value.fetchone.return_value = (
-            "station1", 15.0, 2.0, "KGS", None, None
+        mock_db.execute.return_value.fetchone.return_value = make_context_row(
+            ("station1", 15.0, 2.0, "KGS", None, None)
         )
         
         # Первый вызов - идет в БД
@@ -401,23 +417,21 @@ class TestPricingService:
     
     def test_analytics_aggregation(self, pricing_service, mock_db):
         """Тест аналитики по тарифам"""
-        # Мокаем статистику
+        # Статистика и топ правил приходят одной строкой
         mock_db.execute.return_value.fetchone.return_value = (
             100,    # total_calculations
             5,      # unique_stations
             10,     # unique_rules
             12.5,   # avg_rate_per_kwh
             8.0,    # min_rate_per_kwh
-            20.0    # max_rate_per_kwh
+            20.0,   # max_rate_per_kwh
+            [       # top_rules (json_agg)
+                {"name": "Дневной тариф", "usage_count": 50, "avg_rate": 12.0},
+                {"name": "Ночной тариф", "usage_count": 30, "avg_rate": 8.0},
+                {"name": "Выходной тариф", "usage_count": 20, "avg_rate": 10.0}
+            ]
         )
         
-        # Мокаем топ правил
-        mock_db.execute.return_value.fetchall.return_value = [
-            ("Дневной тариф", 50, 12.0),
-            ("Ночной тариф", 30, 8.0),
-            ("Выходной тариф", 20, 10.0)
-        ]
-        
         analytics = pricing_service.get_pricing_analytics()
         
         assert analytics['statistics']['total_calculations'] == 100
@@ -426,13 +440,21 @@ class TestPricingService:
         assert len(analytics['top_rules']) == 3
         assert analytics['top_rules'][0]['name'] == "Дневной тариф"
         assert analytics['top_rules'][0]['usage_count'] == 50
+        assert mock_db.execute.call_count == 1
+        
+        # Повторный запрос за тот же период - из кэша, без обращения к БД
+        assert pricing_service.get_pricing_analytics() == analytics
+        assert mock_db.execute.call_count == 1
 
 
 class TestComplexScenarios:
     """Тесты сложных сценариев"""
     
     @pytest.fixture
-    def pricing_service(self):
+    def pricing_service(self, monkeypatch):
+        # Как в TestPricingService: без Redis и фоновой записи истории
+        monkeypatch.setattr(pricing_module, "_redis_cache_client", lambda: None)
+        monkeypatch.setattr(pricing_module, "_HISTORY_SAMPLE_RATE", 0.0)
         mock_db = MagicMock()
         return PricingService(mock_db), mock_db
     
@@ -440,30 +462,19 @@ class TestComplexScenarios:
         """Тест выбора правила по приоритету"""
         service, mock_db = pricing_service
         
-        # Мокаем несколько правил с разными приоритетами
-        mock_db.execute.return_value.fetchone.return_value = (
-            "station1", None, None, "KGS", "plan1", "План 1"
-        )
-        
-        mock_db.execute.return_value.fetchall.return_value = [
+        # Правило выбирает SQL: DISTINCT ON плана по убыванию приоритета
+        mock_db.execute.return_value.fetchone.return_value = make_context_row(
+            ("station1", None, None, "KGS", "plan1", "План 1"),
             # Высший приоритет
-            (
-                "rule1", "Приоритетный", "per_kwh", "ALL",
-                0, 100, 15.0, "KGS",
-                time(0, 0), time(23, 59), None, 200,
-                None, None, None, None, None
-            ),
-            # Низший приоритет
-            (
-                "rule2", "Обычный", "per_kwh", "ALL",
-                0, 100, 10.0, "KGS",
-                time(0, 0), time(23, 59), None, 100,
-                None, None, None, None, None
-            )
-        ]
+            station_rule=make_rule("rule1", "Приоритетный", 15.0, time(0, 0), time(23, 59), priority=200)
+        )
         
         result = service.calculate_pricing("station1", skip_cache=True)
         
+        query = str(mock_db.execute.call_args[0][0])
+        assert "DISTINCT ON (scope)" in query
+        assert "ORDER BY scope, priority DESC, created_at DESC" in query
+        
         # Должно выбраться правило с высшим приоритетом
         assert result.rate_per_kwh == Decimal('15.0')
         assert "Приоритетный" in result.active_rule
@@ -472,29 +483,20 @@ class TestComplexScenarios:
         """Тест фильтрации правил по типу коннектора"""
         service, mock_db = pricing_service
         
-        mock_db.execute.return_value.fetchone.return_value = (
-            "station1", None, None, "KGS", "plan1", "План 1"
-        )
-        
-        # Правило только для Type2
-        mock_db.execute.return_value.fetchall.return_value = []
+        station = ("station1", None, None, "KGS", "plan1", "План 1")
         
         # Мокаем запрос с фильтрацией по типу коннектора
         def execute_side_effect(query, params):
             result = MagicMock()
             if params.get('connector_type') == 'CCS':
                 # Нет правил для CCS
-                result.fetchall.return_value = []
+                result.fetchone.return_value = make_context_row(station, station_rule=None)
             else:
                 # Есть правило для Type2
-                result.fetchall.return_value = [
-                    (
-                        "rule1", "Type2 тариф", "per_kwh", "Type2",
-                        0, 100, 12.0, "KGS",
-                        None, None, None, 100,
-                        None, None, None, None, None
-                    )
-                ]
+                result.fetchone.return_value = make_context_row(
+                    station,
+                    station_rule=make_rule("rule1", "Type2 тариф", 12.0, connector_type="Type2")
+                )
             return result
         
         mock_db.execute.side_effect = execute_side_effect
@@ -513,7 +515,7 @@ class TestComplexScenarios:
             connector_type="CCS",
             skip_cache=True
         )
-        assert result.rate_per_kwh == Decimal('9.0')  # Дефолтный
+        assert result.rate_per_kwh == Decimal('13.5')  # Дефолтный
 
 
 if __name__ == "__main__":